@@ -1,5 +1,5 @@
 
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { useAuth } from '../context/useAuth';
 import { useNavigate } from 'react-router-dom';
 import api from '../services/api';
@@ -22,6 +22,15 @@ export default function Dashboard() {
     const [userLocation, setUserLocation] = useState(null);
     const [locationError, setLocationError] = useState(null);
 
+    // Live WebSocket and the topics it should be subscribed to
+    const wsRef = useRef(null);
+    const topicsRef = useRef(['all']);
+    // Last inventory sequence seen from the server, and per product, so reconnects can resume
+    const lastSeqRef = useRef({ epoch: null, seq: 0 });
+    const productSeqRef = useRef({});
+    // Per machine: inventory version and rows from the last fetch, so revisits only pull changes
+    const inventoryCacheRef = useRef({});
+
     // Load Razorpay Script
     const loadRazorpayScript = () => {
         return new Promise((resolve) => {
@@ -126,11 +135,29 @@ export default function Dashboard() {
     };
 
     const fetchInventory = async (machineId) => {
+        const cached = inventoryCacheRef.current[machineId];
         try {
-            setLoading(true);
-            // Assuming products have machine_id. For now filtering frontend since API returns all
-            const res = await api.get('/products');
-            setProducts(res.data.filter(p => !p.machine_id || p.machine_id === machineId));
+            if (cached) {
+                setProducts(cached.products);
+            } else {
+                setLoading(true);
+            }
+            const res = await api.get(`/machines/${machineId}/products`, {
+                params: cached ? { since: cached.version } : {},
+                validateStatus: (status) => status === 200 || status === 304,
+            });
+            if (res.status === 304) return;
+
+            let rows = res.data.products;
+            if (!res.data.full) {
+                // Delta: only the rows that changed since our version
+                const changed = new Map(rows.map(p => [p.id, p]));
+                rows = cached.products.map(p => changed.get(p.id) || p);
+                const known = new Set(cached.products.map(p => p.id));
+                rows = rows.concat(res.data.products.filter(p => !known.has(p.id)));
+            }
+            inventoryCacheRef.current[machineId] = { version: res.data.version, products: rows };
+            setProducts(rows);
         } catch (err) {
             console.error("Failed to fetch inventory", err);
         } finally {
@@ -138,6 +165,33 @@ export default function Dashboard() {
         }
     };
 
+    const trackSequence = (epoch, seq) => {
+        if (lastSeqRef.current.epoch !== epoch) {
+            // New server process, its sequence numbers start over
+            lastSeqRef.current = { epoch, seq: 0 };
+            productSeqRef.current = {};
+        }
+        lastSeqRef.current.seq = Math.max(lastSeqRef.current.seq, seq || 0);
+    };
+
+    // Batched events (e.g. replayed offline sales) carry one entry per product in `items`
+    const eventUpdates = (e) => (e.items || [e]).map(item => ({ product_id: item.product_id, stock: item.stock, seq: e.seq }));
+
+    // Apply absolute stock values, skipping anything older than what a product already shows
+    const applyStockUpdates = (updates) => {
+        const stockById = {};
+        updates.forEach(({ product_id, stock, seq }) => {
+            if ((productSeqRef.current[product_id] || 0) > seq) return;
+            productSeqRef.current[product_id] = seq;
+            stockById[product_id] = stock;
+        });
+        if (Object.keys(stockById).length === 0) return;
+
+        const withStock = (p) => (p.id in stockById ? { ...p, stock: stockById[p.id] } : p);
+        setProducts(prev => prev.map(withStock));
+        setGlobalSearchResults(prev => prev.map(withStock));
+    };
+
     // Global WebSocket Real-Time Sync with Auto-Reconnect
     useEffect(() => {
         let ws;
@@ -145,24 +199,44 @@ export default function Dashboard() {
 
         const connectWebSocket = () => {
             ws = new WebSocket("wss://smart-vending-api.onrender.com/ws");
-
-            ws.onopen = () => console.log("WebSocket Connected: Active");
+            wsRef.current = ws;
+
+            ws.onopen = () => {
+                console.log("WebSocket Connected: Active");
+                // Server subscribes new sockets to 'all', narrow it down if we're inside a machine
+                if (topicsRef.current[0] !== 'all') {
+                    ws.send(JSON.stringify({ action: 'unsubscribe', topics: ['all'] }));
+                    ws.send(JSON.stringify({ action: 'subscribe', topics: topicsRef.current }));
+                }
+                // Catch up on whatever happened while we were disconnected instead of refetching
+                if (lastSeqRef.current.epoch) {
+                    ws.send(JSON.stringify({ action: 'resume', epoch: lastSeqRef.current.epoch, last_seq: lastSeqRef.current.seq }));
+                }
+            };
 
             ws.onmessage = (event) => {
                 const data = JSON.parse(event.data);
-                if (data.action === "inventory_deducted") {
-                    setProducts(prev => prev.map(p =>
-                        p.id === data.product_id && p.stock > 0 ? { ...p, stock: p.stock - 1 } : p
-                    ));
-                    setGlobalSearchResults(prev => prev.map(p =>
-                        p.id === data.product_id && p.stock > 0 ? { ...p, stock: p.stock - 1 } : p
-                    ));
-                    // Show a quick transient UI toast confirming the Sync!
-                    const spanMessage = document.createElement("div");
-                    spanMessage.innerText = "⚡ Offline Hardware Sync Received!";
-                    spanMessage.style = "position:fixed;bottom:20px;right:20px;background:#00e5ff;color:black;padding:12px 24px;border-radius:8px;font-weight:bold;z-index:9999;box-shadow:0 0 20px #00e5ff;";
-                    document.body.appendChild(spanMessage);
-                    setTimeout(() => spanMessage.remove(), 3500);
+                if (data.epoch) trackSequence(data.epoch, data.seq);
+
+                if (data.action === "inventory_reserved" || data.action === "inventory_released") {
+                    // Units held for (or given back by) someone else's checkout
+                    applyStockUpdates(eventUpdates(data));
+                } else if (data.action === "inventory_deducted" || data.action === "inventory_restocked") {
+                    applyStockUpdates(eventUpdates(data));
+                    if (data.action === "inventory_deducted") {
+                        // Show a quick transient UI toast confirming the Sync!
+                        const spanMessage = document.createElement("div");
+                        spanMessage.innerText = "⚡ Offline Hardware Sync Received!";
+                        spanMessage.style = "position:fixed;bottom:20px;right:20px;background:#00e5ff;color:black;padding:12px 24px;border-radius:8px;font-weight:bold;z-index:9999;box-shadow:0 0 20px #00e5ff;";
+                        document.body.appendChild(spanMessage);
+                        setTimeout(() => spanMessage.remove(), 3500);
+                    }
+                } else if (data.action === "replay") {
+                    // Only the events we missed while disconnected
+                    applyStockUpdates(data.events.flatMap(eventUpdates));
+                } else if (data.action === "snapshot") {
+                    // Gap was too large (or the server restarted): absolute stock for everything we watch
+                    applyStockUpdates(data.products.map(p => ({ product_id: p.product_id, stock: p.stock, seq: data.seq })));
                 }
             };
 
@@ -182,6 +256,19 @@ export default function Dashboard() {
         };
     }, []);
 
+    // Only receive events for the machine on screen; global search needs everything
+    useEffect(() => {
+        const topics = view === 'inventory' && selectedMachine ? [`machine:${selectedMachine.id}`] : ['all'];
+        const previous = topicsRef.current;
+        topicsRef.current = topics;
+
+        const ws = wsRef.current;
+        if (ws && ws.readyState === WebSocket.OPEN && previous.join() !== topics.join()) {
+            ws.send(JSON.stringify({ action: 'unsubscribe', topics: previous }));
+            ws.send(JSON.stringify({ action: 'subscribe', topics }));
+        }
+    }, [view, selectedMachine]);
+
     const searchProducts = async (query) => {
         try {
             setLoading(true);
@@ -9,6 +9,7 @@ export default function Profile() {
     const navigate = useNavigate();
     const [profileData, setProfileData] = useState(null);
     const [loading, setLoading] = useState(true);
+    const [loadingMore, setLoadingMore] = useState(false);
 
     useEffect(() => {
         const fetchProfileData = async () => {
@@ -24,6 +25,23 @@ export default function Profile() {
         fetchProfileData();
     }, [user.id]);
 
+    // History is paged newest first; next_cursor is null once everything is loaded
+    const loadMore = async () => {
+        if (!profileData?.next_cursor || loadingMore) return;
+        setLoadingMore(true);
+        try {
+            const res = await api.get(`/${user.id}/purchases`, { params: { before: profileData.next_cursor } });
+            setProfileData(prev => ({
+                ...res.data,
+                history: [...prev.history, ...res.data.history]
+            }));
+        } catch (err) {
+            console.error("Failed to load more purchases", err);
+        } finally {
+            setLoadingMore(false);
+        }
+    };
+
     const handleLogout = () => {
         logout();
         navigate('/');
@@ -82,8 +100,8 @@ export default function Profile() {
 
                 {profileData?.history?.length > 0 ? (
                     <div style={{ display: 'flex', flexDirection: 'column', gap: '15px' }}>
-                        {profileData.history.map((tx, idx) => (
-                            <div key={idx} style={{ background: '#0a0f14', border: '1px solid #1e2d3d', padding: '20px', borderRadius: '12px', display: 'flex', justifyContent: 'space-between', alignItems: 'center', transition: 'transform 0.2s', cursor: 'default' }}
+                        {profileData.history.map((tx) => (
+                            <div key={tx.id} style={{ background: '#0a0f14', border: '1px solid #1e2d3d', padding: '20px', borderRadius: '12px', display: 'flex', justifyContent: 'space-between', alignItems: 'center', transition: 'transform 0.2s', cursor: 'default' }}
                                 onMouseOver={(e) => e.currentTarget.style.borderColor = '#00e5ff'}
                                 onMouseOut={(e) => e.currentTarget.style.borderColor = '#1e2d3d'}
                             >
@@ -101,6 +119,11 @@ export default function Profile() {
                                 </div>
                             </div>
                         ))}
+                        {profileData.next_cursor && (
+                            <button onClick={loadMore} disabled={loadingMore} style={{ background: 'transparent', border: '1px solid #1e2d3d', color: '#00e5ff', padding: '12px', borderRadius: '12px', cursor: loadingMore ? 'default' : 'pointer', fontWeight: 'bold' }}>
+                                {loadingMore ? 'Loading...' : 'Load more'}
+                            </button>
+                        )}
                     </div>
                 ) : (
                     <div style={{ background: 'rgba(255, 255, 255, 0.02)', border: '1px dashed #1e2d3d', padding: '50px', borderRadius: '12px', textAlign: 'center', color: '#8e9aaf' }}>
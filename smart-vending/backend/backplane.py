@@ -0,0 +1,143 @@
+import asyncio
+import json
+import os
+import re
+
+from sqlalchemy import text
+
+from database import DATABASE_URL, engine
+
+# memory (single process, default) | postgres (LISTEN/NOTIFY on DATABASE_URL)
+EVENT_BACKPLANE = os.getenv("EVENT_BACKPLANE", "memory")
+EVENT_CHANNEL = os.getenv("EVENT_CHANNEL", "vending_events")
+
+
+# Broadcasts go through the backplane instead of straight to the local
+# ConnectionManager, so every worker/replica hears about every event and can
+# push it to its own sockets. Envelopes are {"event", "topics", "key"}.
+class InMemoryBackplane:
+    def __init__(self):
+        self.handler = None
+
+    async def start(self, handler):
+        self.handler = handler
+
+    async def stop(self):
+        self.handler = None
+
+    def fits(self, event: dict, topics=(), key: str = None) -> bool:
+        return True
+
+    async def publish(self, event: dict, topics=(), key: str = None):
+        if self.handler is not None:
+            await self.handler({"event": event, "topics": list(topics), "key": key})
+
+
+class PostgresBackplane:
+    # NOTIFY goes out through the normal SQLAlchemy pool; a dedicated psycopg2
+    # connection LISTENs and is watched with loop.add_reader, so no thread blocks.
+    # Notifications are handed to one delivery task in arrival order.
+    RECONNECT_DELAY = 2.0
+    # Postgres rejects NOTIFY payloads of 8000 bytes or more
+    MAX_PAYLOAD = 7999
+
+    def __init__(self, url: str = DATABASE_URL, channel: str = EVENT_CHANNEL):
+        # psycopg2 wants a plain libpq URL, without the SQLAlchemy driver suffix
+        self.dsn = re.sub(r"^postgresql\+\w+://", "postgresql://", url)
+        self.channel = channel
+        self.handler = None
+        self._conn = None
+        self._loop = None
+        self._reconnect = None
+        self._inbox = None
+        self._deliverer = None
+
+    async def start(self, handler):
+        self.handler = handler
+        self._loop = asyncio.get_running_loop()
+        self._inbox = asyncio.Queue()
+        self._deliverer = asyncio.create_task(self._deliver())
+        await self._listen()
+
+    async def stop(self):
+        self.handler = None
+        if self._reconnect is not None:
+            self._reconnect.cancel()
+        if self._deliverer is not None:
+            self._deliverer.cancel()
+            self._deliverer = None
+        self._close()
+
+    async def _listen(self):
+        import psycopg2
+        import psycopg2.extensions
+
+        conn = await asyncio.to_thread(psycopg2.connect, self.dsn)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cur:
+            cur.execute(f'LISTEN "{self.channel}"')
+        self._conn = conn
+        self._loop.add_reader(conn.fileno(), self._on_readable)
+
+    def _close(self):
+        if self._conn is not None:
+            self._loop.remove_reader(self._conn.fileno())
+            self._conn.close()
+            self._conn = None
+
+    def _on_readable(self):
+        try:
+            self._conn.poll()
+        except Exception as e:
+            print(f"Backplane listener lost its connection: {e}")
+            self._close()
+            self._reconnect = asyncio.create_task(self._reconnect_later())
+            return
+
+        while self._conn.notifies:
+            self._inbox.put_nowait(self._conn.notifies.pop(0).payload)
+
+    async def _deliver(self):
+        while True:
+            payload = await self._inbox.get()
+            try:
+                if self.handler is not None:
+                    await self.handler(json.loads(payload))
+            except Exception as e:
+                print(f"Failed to deliver a backplane event: {e}")
+
+    async def _reconnect_later(self):
+        while self.handler is not None:
+            await asyncio.sleep(self.RECONNECT_DELAY)
+            try:
+                await self._listen()
+                return
+            except Exception as e:
+                print(f"Backplane reconnect failed: {e}")
+
+    def _notify(self, payload: str):
+        with engine.connect() as conn:
+            conn.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": self.channel, "payload": payload})
+            conn.commit()
+
+    def _payload(self, event: dict, topics, key: str) -> str:
+        # ASCII-only JSON, so its length is its size in bytes
+        return json.dumps({"event": event, "topics": list(topics), "key": key})
+
+    def fits(self, event: dict, topics=(), key: str = None) -> bool:
+        return len(self._payload(event, topics, key)) <= self.MAX_PAYLOAD
+
+    async def publish(self, event: dict, topics=(), key: str = None):
+        payload = self._payload(event, topics, key)
+        if len(payload) > self.MAX_PAYLOAD:
+            raise ValueError(f"Backplane payload of {len(payload)} bytes is over the NOTIFY limit")
+        await asyncio.to_thread(self._notify, payload)
+
+
+def create_backplane(kind: str = EVENT_BACKPLANE):
+    if kind == "postgres":
+        return PostgresBackplane()
+    return InMemoryBackplane()
+
+
+backplane = create_backplane()
@@ -0,0 +1,95 @@
+"""Batched inventory events through the Postgres backplane.
+
+Starts several PostgresBackplane listeners on one database, as separate
+workers would, and publishes the per-machine events of one large batch
+(what /restock/bulk, /machines/sync-offline-sales/batch and the reservation
+sweeper send) through inventory.publish. Batches too big for one NOTIFY go
+out in parts. Checks that every worker hears every product exactly once, in
+publish order, and that a failing handler doesn't stop later deliveries.
+
+Needs a Postgres DATABASE_URL. Run from the backend directory:
+    DATABASE_URL=postgresql://... python -m benchmarks.backplane_postgres --products 2000 --machines 5
+"""
+import argparse
+import asyncio
+import os
+import time
+from types import SimpleNamespace
+
+if not os.getenv("DATABASE_URL", "").startswith("postgresql"):
+    raise SystemExit("Set DATABASE_URL to a Postgres database")
+
+import inventory
+from backplane import PostgresBackplane
+
+
+def products(count: int, machines: int):
+    return [
+        SimpleNamespace(id=i + 1, machine_id=i % machines + 1, name=f"Bench product {i + 1}", price=40, stock=20)
+        for i in range(count)
+    ]
+
+
+async def run(count: int, machines: int, workers: int) -> dict:
+    received = [[] for _ in range(workers)]
+    listeners = []
+    for i in range(workers):
+        async def handler(envelope, got=received[i]):
+            got.append(envelope)
+            if len(got) == 1:
+                raise RuntimeError("handler failure on the first event")
+        listener = PostgresBackplane()
+        await listener.start(handler)
+        listeners.append(listener)
+
+    publisher = PostgresBackplane()
+    inventory.backplane = publisher
+    events = inventory.machine_stock_events("inventory_restocked", products(count, machines))
+    start = time.perf_counter()
+    for event in events:
+        await inventory.publish(event)
+    publish_s = time.perf_counter() - start
+
+    # Wait for the listeners to hear every part
+    deadline = time.perf_counter() + 10
+    while time.perf_counter() < deadline and any(
+        sum(len(inventory.event_items(e["event"])) for e in got) < count for got in received
+    ):
+        await asyncio.sleep(0.05)
+    for listener in listeners:
+        await listener.stop()
+
+    sent = [item["product_id"] for event in events for item in event["items"]]
+    failures = []
+    for i, got in enumerate(received):
+        heard = [item["product_id"] for e in got for item in inventory.event_items(e["event"])]
+        if heard != sent:
+            failures.append(f"worker {i} heard {len(heard)} of {len(sent)} products, or out of order")
+        for e in got:
+            expected = inventory.event_topics(e["event"])
+            if e["topics"] != expected:
+                failures.append(f"worker {i} got topics {e['topics']} for a part needing {expected}")
+                break
+
+    return {
+        "products": count,
+        "machines": machines,
+        "events": len(events),
+        "notifies": len(received[0]),
+        "publish_ms": round(publish_s * 1000, 1),
+        "failures": failures,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--machines", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.products, args.machines, args.workers))
+    failures = results.pop("failures")
+    print("  ".join(f"{key}={value}" for key, value in results.items()))
+    if failures:
+        raise SystemExit("Failures:\n  " + "\n  ".join(failures))
@@ -0,0 +1,98 @@
+"""Hot-product purchase storm against crud.buy_product.
+
+Fires many parallel purchases at a single product and checks that the
+number of successful sales never exceeds the starting stock.
+
+Run from the backend directory:
+    python -m benchmarks.buy_concurrency --buyers 500 --stock 200
+"""
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Default to a throwaway SQLite file so the benchmark never touches the real database
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import crud
+import models
+from database import Base, DATABASE_URL
+
+
+def make_engine(url: str):
+    if url.startswith("sqlite"):
+        # Writers queue on SQLite's file lock, give them room instead of failing fast
+        return create_engine(url, connect_args={"timeout": 30, "check_same_thread": False})
+    return create_engine(url, pool_size=20, max_overflow=40)
+
+
+def seed(Session, stock: int) -> int:
+    db = Session()
+    try:
+        machine = models.Machine(name="Bench machine", location="Bench", latitude=26.47, longitude=73.11)
+        db.add(machine)
+        db.flush()
+        product = models.Product(machine_id=machine.id, name="Hot Coke", price=40, stock=stock)
+        db.add(product)
+        db.commit()
+        return product.id
+    finally:
+        db.close()
+
+
+def run(buyers: int, stock: int, workers: int, url: str = DATABASE_URL) -> dict:
+    engine = make_engine(url)
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    product_id = seed(Session, stock)
+
+    def attempt(_):
+        db = Session()
+        try:
+            return crud.buy_product(db, product_id)
+        finally:
+            db.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(attempt, range(buyers)))
+    elapsed = time.perf_counter() - start
+
+    sold = sum(1 for r in results if r not in (None, "Out of stock"))
+    rejected = sum(1 for r in results if r == "Out of stock")
+
+    db = Session()
+    try:
+        final_stock = db.get(models.Product, product_id).stock
+    finally:
+        db.close()
+    engine.dispose()
+
+    return {
+        "buyers": buyers,
+        "initial_stock": stock,
+        "sold": sold,
+        "rejected": rejected,
+        "final_stock": final_stock,
+        "oversold": sold > stock or final_stock < 0 or final_stock != stock - sold,
+        "elapsed_s": round(elapsed, 4),
+        "purchases_per_s": round(buyers / elapsed, 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--buyers", type=int, default=500)
+    parser.add_argument("--stock", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=64)
+    args = parser.parse_args()
+
+    report = run(args.buyers, args.stock, args.workers)
+    for key, value in report.items():
+        print(f"{key:>16}: {value}")
+    if report["oversold"]:
+        raise SystemExit("Oversold: stock accounting is inconsistent")
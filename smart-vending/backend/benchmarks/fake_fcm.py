@@ -0,0 +1,53 @@
+"""Local stand-in for the FCM legacy send endpoint.
+
+Records every request and can inject latency, throttling and server errors,
+so the notification dispatcher can be exercised without talking to Google.
+
+In-process:
+    fake = FakeFCM(latency=0.05, failure_rate=0.1)
+    dispatcher = NotificationDispatcher(url="http://fcm/fcm/send", transport=httpx.ASGITransport(app=fake.app))
+
+Standalone (then point FCM_URL at it):
+    uvicorn benchmarks.fake_fcm:app --port 9001
+"""
+import asyncio
+import random
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+class FakeFCM:
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, throttle_rate: float = 0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.throttle_rate = throttle_rate
+        self.requests = []
+        self.delivered = []
+        self.app = FastAPI()
+        self.app.post("/fcm/send")(self.send)
+
+    async def send(self, request: Request):
+        payload = await request.json()
+        self.requests.append(payload)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        roll = random.random()
+        if roll < self.throttle_rate:
+            return JSONResponse({"error": "QuotaExceeded"}, status_code=429, headers={"Retry-After": "0"})
+        if roll < self.throttle_rate + self.failure_rate:
+            return JSONResponse({"error": "Unavailable"}, status_code=503)
+
+        tokens = payload.get("registration_ids") or [payload.get("to")]
+        self.delivered.extend(tokens)
+        return {
+            "multicast_id": len(self.requests),
+            "success": len(tokens),
+            "failure": 0,
+            "results": [{"message_id": f"fake:{len(self.delivered)}:{i}"} for i in range(len(tokens))]
+        }
+
+
+fake = FakeFCM()
+app = fake.app
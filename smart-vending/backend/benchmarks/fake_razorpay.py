@@ -0,0 +1,66 @@
+"""Local stand-in for the Razorpay orders API.
+
+Creates orders in memory and can inject latency, hangs and server errors,
+so order creation, timeouts and the circuit breaker can be exercised without
+talking to Razorpay. sign() produces the signature checkout would hand back.
+
+In-process:
+    fake = FakeRazorpay(latency=0.2, failure_rate=0.1)
+    gateway = RazorpayGateway(url="http://razorpay/v1", demo=False, transport=httpx.ASGITransport(app=fake.app))
+
+Standalone (then point RAZORPAY_API_URL at http://localhost:9002/v1):
+    uvicorn benchmarks.fake_razorpay:app --port 9002
+"""
+import asyncio
+import hashlib
+import hmac
+import random
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+class FakeRazorpay:
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0, hang_rate: float = 0.0,
+                 hang: float = 30.0, key_secret: str = "test_key_secret"):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.hang_rate = hang_rate
+        self.hang = hang
+        self.key_secret = key_secret
+        self.requests = 0
+        self.orders = {}
+        self.app = FastAPI()
+        self.app.post("/v1/orders")(self.create_order)
+
+    async def create_order(self, request: Request):
+        payload = await request.json()
+        self.requests += 1
+
+        roll = random.random()
+        if roll < self.hang_rate:
+            # Stuck upstream: only the client's timeout gets the caller out
+            await asyncio.sleep(self.hang)
+        elif self.latency:
+            await asyncio.sleep(self.latency)
+        if self.hang_rate <= roll < self.hang_rate + self.failure_rate:
+            return JSONResponse({"error": {"code": "SERVER_ERROR"}}, status_code=502)
+
+        order = {
+            "id": f"order_{uuid.uuid4().hex[:14]}",
+            "entity": "order",
+            "amount": payload["amount"],
+            "currency": payload.get("currency", "INR"),
+            "receipt": payload.get("receipt"),
+            "status": "created",
+        }
+        self.orders[order["id"]] = order
+        return order
+
+    def sign(self, order_id: str, payment_id: str) -> str:
+        return hmac.new(self.key_secret.encode(), f"{order_id}|{payment_id}".encode(), hashlib.sha256).hexdigest()
+
+
+fake = FakeRazorpay()
+app = fake.app
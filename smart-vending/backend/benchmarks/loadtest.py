@@ -0,0 +1,481 @@
+"""Mixed load against the whole API, with per-route latency percentiles.
+
+Boots main.app (lifespan included) on a database seeded from user_seed.sql
+and scaled up to thousands of machines and products, with Razorpay and FCM
+replaced by the fakes in this package, then runs these scenarios side by
+side:
+
+  buy_storm  buyers racing create-order + buy for one hot product
+  search     users typing a product name: autocomplete per keystroke, then search
+  nearest    /machines/nearest-machine from random points around campus
+  restock    /restock on sold-out products with long pending demand queues
+  offline    /machines/sync-offline-sales, one hardware sale per call
+  listeners  WebSocket clients receiving every inventory event the rest causes
+
+and reports throughput and p50/p95/p99 per route. Afterwards the users'
+running purchase totals are checked against the transaction ledger, since
+anonymous hardware sales must never land in them, and a few API edge cases
+the load never hits are checked (conditional inventory GETs for a machine
+that doesn't exist, a bulk restock listing things twice). --out writes the results
+as JSON; --compare checks them against an earlier file and exits non-zero
+on a regression. --quick is a small preset that finishes in seconds, and
+run() can be awaited directly from other code.
+
+Requests go through httpx's ASGI transport and listeners are in-process fake
+sockets registered with the ConnectionManager, so this measures the
+application rather than the network stack.
+
+The default database is a throwaway SQLite file. A dedicated local Postgres
+works too (it is wiped first, so --reset has to be passed).
+
+Run from the backend directory:
+    python -m benchmarks.loadtest --out baseline.json
+    python -m benchmarks.loadtest --compare baseline.json
+    python -m benchmarks.loadtest --quick
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+# Writers queue on SQLite's file lock, give them room instead of failing fast
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db") + "?timeout=30")
+
+import httpx
+from sqlalchemy import func, insert, select
+
+import crud
+import inventory
+import main
+import models
+import notifications
+import payment
+import search
+from benchmarks.fake_fcm import FakeFCM
+from benchmarks.fake_razorpay import FakeRazorpay
+from benchmarks.ws_fanout import FakeWebSocket
+from database import Base, SessionLocal, engine
+from websocket_manager import manager
+
+SEED_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "user_seed.sql")
+MACHINE_ROW = re.compile(r"^\((\d+), '([^']*)', '[^']*', ([\d.]+), ([\d.]+)\)", re.M)
+PRODUCT_ROW = re.compile(r"^\((\d+), '([^']*)', (\d+), (\d+)\)", re.M)
+# Scaled-up machines are scattered this far (degrees) around the seeded ones
+JITTER_DEG = 0.02
+
+PRESETS = {
+    "full": dict(machines=2000, users=5000, buyers=1000, searchers=300, nearest=1000,
+                 restocks=20, demand=1000, offline=500, listeners=2000, concurrency=50),
+    "quick": dict(machines=50, users=100, buyers=100, searchers=20, nearest=100,
+                  restocks=5, demand=50, offline=50, listeners=200, concurrency=20),
+}
+TICK = 0.005
+
+
+def percentile(values, pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def seed_rows():
+    with open(SEED_FILE) as f:
+        sql = f.read()
+    machines = [(int(i), name, float(lat), float(lon)) for i, name, lat, lon in MACHINE_ROW.findall(sql)]
+    products = defaultdict(list)
+    for machine_id, name, price, stock in PRODUCT_ROW.findall(sql):
+        products[int(machine_id)].append((name, float(price), int(stock)))
+    return machines, products
+
+
+def seed(args, rng: random.Random) -> dict:
+    # Every seeded machine is cloned around its original spot with its
+    # original products until there are args.machines of them
+    templates, catalog = seed_rows()
+    templates = [t for t in templates if catalog.get(t[0])]
+    db = SessionLocal()
+    try:
+        conn = db.connection()
+        conn.execute(insert(models.Machine.__table__), [
+            {
+                "name": f"{name} #{n}",
+                "location": f"{name} #{n}",
+                "latitude": lat + rng.uniform(-JITTER_DEG, JITTER_DEG),
+                "longitude": lon + rng.uniform(-JITTER_DEG, JITTER_DEG),
+            }
+            for n, (_, name, lat, lon) in ((n, templates[n % len(templates)]) for n in range(args.machines))
+        ])
+        machine_ids = list(db.execute(select(models.Machine.id).order_by(models.Machine.id)).scalars())
+        conn.execute(insert(models.Product.__table__), [
+            {"machine_id": machine_id, "name": name, "price": price, "stock": stock}
+            for n, machine_id in enumerate(machine_ids)
+            for name, price, stock in catalog[templates[n % len(templates)][0]]
+        ])
+        conn.execute(insert(models.User.__table__), [
+            {"name": f"Bench {i}", "email": f"bench{i}@example.com", "password": "x", "fcm_token": f"bench-token-{i}"}
+            for i in range(args.users)
+        ])
+        user_ids = list(db.execute(select(models.User.id)).scalars())
+
+        products = db.execute(select(models.Product.id, models.Product.machine_id, models.Product.name)).all()
+        hot, *rest = rng.sample(products, args.restocks + 1)
+        db.execute(models.Product.__table__.update().where(models.Product.id == hot.id).values(stock=args.buyers // 2))
+        # Sold out, with a queue of users waiting to hear it is back
+        db.execute(models.Product.__table__.update().where(models.Product.id.in_([p.id for p in rest])).values(stock=0))
+        conn.execute(insert(models.DemandRequest.__table__), [
+            {"user_id": rng.choice(user_ids), "machine_id": p.machine_id, "product_name": p.name, "is_fulfilled": 0}
+            for p in rest for _ in range(args.demand)
+        ])
+        db.commit()
+        crud.rebuild_demand_rollups(db)
+
+        return {
+            "hot_product": hot.id,
+            "hot_stock": args.buyers // 2,
+            "restock_products": [p.id for p in rest],
+            "offline_products": [p.id for p in products if p.id != hot.id and p not in rest],
+            "names": sorted({p.name for p in products}),
+            "user_ids": user_ids,
+            "points": [(lat, lon) for _, _, lat, lon in templates],
+            "machines": len(machine_ids),
+            "products": len(products),
+        }
+    finally:
+        db.close()
+
+
+def reset_database(allow_reset: bool):
+    if engine.dialect.name == "sqlite":
+        return
+    with SessionLocal() as db:
+        if db.scalar(select(func.count(models.Machine.id))) and not allow_reset:
+            raise SystemExit(f"{engine.url.render_as_string()} already has data; pass --reset to wipe it")
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    search.setup(engine)
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.windows = {}
+
+    async def call(self, client: httpx.AsyncClient, label: str, method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+            status = str(response.status_code)
+        except httpx.HTTPError:
+            response, status = None, "error"
+        end = time.perf_counter()
+        self.samples[label].append(end - start)
+        self.statuses[label][status] += 1
+        first, last = self.windows.get(label, (start, end))
+        self.windows[label] = (min(first, start), max(last, end))
+        return response
+
+    def routes(self) -> dict:
+        routes = {}
+        for label, samples in sorted(self.samples.items()):
+            first, last = self.windows[label]
+            routes[label] = {
+                "count": len(samples),
+                "per_s": round(len(samples) / max(last - first, 1e-9), 1),
+                "p50_ms": round(percentile(samples, 50) * 1000, 2),
+                "p95_ms": round(percentile(samples, 95) * 1000, 2),
+                "p99_ms": round(percentile(samples, 99) * 1000, 2),
+                "max_ms": round(max(samples) * 1000, 2),
+                "statuses": dict(self.statuses[label]),
+            }
+        return routes
+
+
+async def gather_limited(concurrency: int, jobs):
+    sem = asyncio.Semaphore(concurrency)
+
+    async def limited(job):
+        async with sem:
+            return await job
+
+    return await asyncio.gather(*(limited(job) for job in jobs))
+
+
+async def buy_storm(client, rec, data, args, razorpay: FakeRazorpay, rng: random.Random):
+    product_id = data["hot_product"]
+
+    async def buyer(i):
+        response = await rec.call(client, "POST /create-order", "POST", f"/create-order/{product_id}")
+        order_id = response.json().get("order_id") if response is not None and response.status_code == 200 else None
+        if order_id is None:
+            return False
+        payment_id = f"pay_bench_{i}"
+        response = await rec.call(
+            client, "POST /buy", "POST", f"/buy/{product_id}",
+            params={"user_id": rng.choice(data["user_ids"])},
+            json={"order_id": order_id, "payment_id": payment_id, "signature": razorpay.sign(order_id, payment_id)},
+        )
+        return response is not None and response.status_code == 200 and "error" not in response.json()
+
+    return sum(await gather_limited(args.concurrency, (buyer(i) for i in range(args.buyers))))
+
+
+async def typing(client, rec, data, args, rng: random.Random):
+    async def searcher(_):
+        name = rng.choice(data["names"])
+        for n in range(1, min(len(name), 6) + 1):
+            await rec.call(client, "GET /search/autocomplete", "GET", "/search/autocomplete", params={"prefix": name[:n]})
+        await rec.call(client, "GET /search", "GET", "/search", params={"name": name})
+
+    await gather_limited(args.concurrency, (searcher(i) for i in range(args.searchers)))
+
+
+async def nearest(client, rec, data, args, rng: random.Random):
+    async def lookup(_):
+        lat, lon = rng.choice(data["points"])
+        await rec.call(client, "POST /machines/nearest-machine", "POST", "/machines/nearest-machine", params={
+            "user_lat": lat + rng.uniform(-JITTER_DEG, JITTER_DEG),
+            "user_lon": lon + rng.uniform(-JITTER_DEG, JITTER_DEG),
+            "k": 5,
+        })
+
+    await gather_limited(args.concurrency, (lookup(i) for i in range(args.nearest)))
+
+
+async def restock(client, rec, data, args):
+    async def one(product_id):
+        await rec.call(client, "POST /restock", "POST", "/restock", json={"product_id": product_id, "amount": 10})
+
+    await gather_limited(args.concurrency, (one(pid) for pid in data["restock_products"]))
+
+
+async def offline(client, rec, data, args, rng: random.Random):
+    async def sale(_):
+        await rec.call(client, "POST /machines/sync-offline-sales", "POST", "/machines/sync-offline-sales",
+                       params={"product_id": rng.choice(data["offline_products"])})
+
+    await gather_limited(args.concurrency, (sale(i) for i in range(args.offline)))
+
+
+def purchase_totals_mismatches():
+    # Users whose running totals disagree with their completed transactions,
+    # including totals rows for users who never bought anything
+    tx = models.Transaction
+    with SessionLocal() as db:
+        ledger = {
+            user_id: (round(spent, 2), count)
+            for user_id, spent, count in db.execute(
+                select(tx.user_id, func.sum(tx.amount), func.count(tx.id))
+                .where(tx.payment_status == "Completed", tx.user_id.isnot(None))
+                .group_by(tx.user_id)
+            )
+        }
+        totals = db.execute(select(
+            models.UserPurchaseTotal.user_id,
+            models.UserPurchaseTotal.total_spent,
+            models.UserPurchaseTotal.purchase_count,
+        )).all()
+    return sum(1 for user_id, spent, count in totals if ledger.get(user_id, (0, 0)) != (round(spent, 2), count))
+
+
+async def api_checks(client) -> list:
+    # Protocol edge cases the load itself never hits; returns what went wrong
+    failures = []
+    with SessionLocal() as db:
+        machine_id = db.scalar(select(func.min(models.Machine.id)))
+        missing_id = db.scalar(select(func.max(models.Machine.id))) + 1
+
+    # Conditional GETs: unchanged inventory is a 304, a machine that doesn't
+    # exist is a 404 even when the client sends that id's version
+    response = await client.get(f"/machines/{machine_id}/products")
+    etag = response.headers.get("etag")
+    response = await client.get(f"/machines/{machine_id}/products", headers={"If-None-Match": etag})
+    if response.status_code != 304:
+        failures.append(f"unchanged machine inventory answered {response.status_code}, not 304")
+    version = inventory.event_log.machine_version(missing_id)
+    for kwargs in ({"headers": {"If-None-Match": f'"{version}"'}}, {"params": {"since": version}}):
+        response = await client.get(f"/machines/{missing_id}/products", **kwargs)
+        if response.status_code != 404:
+            failures.append(f"unknown machine with {list(kwargs)[0]} answered {response.status_code}, not 404")
+
+    # Bulk restock amounts are deltas: a product listed twice, and its machine
+    # listed twice, all add up
+    with SessionLocal() as db:
+        product_id, stock = db.execute(
+            select(models.Product.id, models.Product.stock).where(models.Product.machine_id == machine_id).limit(1)
+        ).one()
+        others = db.scalar(select(func.count(models.Product.id)).where(models.Product.machine_id == machine_id))
+    response = await client.post("/restock/bulk", json={
+        "products": [{"product_id": product_id, "amount": 1}, {"product_id": product_id, "amount": 2}],
+        "machines": [{"machine_id": machine_id, "amount": 3}, {"machine_id": machine_id, "amount": 4}],
+    })
+    restocked = {p["id"]: p["stock"] for p in response.json().get("products", [])}
+    with SessionLocal() as db:
+        now = db.scalar(select(models.Product.stock).where(models.Product.id == product_id))
+    if now != stock + 10 or restocked.get(product_id) != now or len(restocked) != others:
+        failures.append(f"duplicate bulk restock took stock {stock} -> {now} (answered {restocked.get(product_id)}), not {stock + 10}")
+    return failures
+
+
+async def ticker(lags: list, stop: asyncio.Event):
+    # How much later than asked the loop gets back to us
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - start - TICK)
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    reset_database(args.reset)
+    data = seed(args, rng)
+
+    razorpay = FakeRazorpay(latency=args.gateway_latency, key_secret="bench_secret")
+    fcm = FakeFCM(latency=args.gateway_latency)
+    payment.gateway.demo = False
+    payment.gateway.url = "http://razorpay/v1"
+    payment.gateway.key_secret = razorpay.key_secret
+    payment.gateway.transport = httpx.ASGITransport(app=razorpay.app)
+    notifications.dispatcher.url = "http://fcm/fcm/send"
+    notifications.dispatcher.transport = httpx.ASGITransport(app=fcm.app)
+
+    rec = Recorder()
+    lags, stop = [], asyncio.Event()
+    # The app prints per purchase and per alert; keep that out of the report
+    quiet = contextlib.redirect_stdout(sys.stdout if args.verbose else open(os.devnull, "w"))
+    with quiet:
+        async with main.lifespan(main.app):
+            listeners = [FakeWebSocket(0) for _ in range(args.listeners)]
+            for listener in listeners:
+                await manager.connect(listener)
+
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                tick = asyncio.create_task(ticker(lags, stop))
+                start = time.perf_counter()
+                sold, *_ = await asyncio.gather(
+                    buy_storm(client, rec, data, args, razorpay, rng),
+                    typing(client, rec, data, args, rng),
+                    nearest(client, rec, data, args, rng),
+                    restock(client, rec, data, args),
+                    offline(client, rec, data, args, rng),
+                )
+                elapsed = time.perf_counter() - start
+                stop.set()
+                await tick
+                check_failures = await api_checks(client)
+
+            # Let socket writers and the notification queue drain
+            await asyncio.sleep(0.5)
+            delivered = sum(listener.received for listener in listeners)
+            dropped = sum(client.dropped for client in manager.active_connections.values())
+            for listener in listeners:
+                manager.disconnect(listener)
+
+    routes = rec.routes()
+    requests = sum(route["count"] for route in routes.values())
+    return {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "git_revision": git_revision(),
+            "database": engine.dialect.name,
+            "machines": data["machines"],
+            "products": data["products"],
+            "params": {key: value for key, value in vars(args).items() if key not in ("out", "compare", "verbose")},
+        },
+        "summary": {
+            "requests": requests,
+            "elapsed_s": round(elapsed, 2),
+            "requests_per_s": round(requests / elapsed, 1),
+            "loop_lag_p99_ms": round(percentile(lags, 99) * 1000, 2) if lags else None,
+            "hot_item_sold": sold,
+            "hot_item_stock": data["hot_stock"],
+            "oversold": sold > data["hot_stock"],
+            "ws_listeners": args.listeners,
+            "ws_delivered": delivered,
+            "ws_dropped": dropped,
+            "push_sent": notifications.dispatcher.sent,
+            "purchase_totals_mismatches": purchase_totals_mismatches(),
+            "api_check_failures": len(check_failures),
+        },
+        "routes": routes,
+        "api_check_failures": check_failures,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    # Latency up, or throughput down, by more than `tolerance` on any route;
+    # differences under a millisecond are noise at these sizes
+    regressions = []
+    print(f"\n{'route':<32} {'p95 base':>9} {'p95 now':>9} {'per_s base':>11} {'per_s now':>10}")
+    for label, route in results["routes"].items():
+        base = baseline.get("routes", {}).get(label)
+        if base is None:
+            continue
+        print(f"{label:<32} {base['p95_ms']:>9} {route['p95_ms']:>9} {base['per_s']:>11} {route['per_s']:>10}")
+        for key in ("p95_ms", "p99_ms"):
+            if route[key] > base[key] * (1 + tolerance) and route[key] - base[key] > 1.0:
+                regressions.append(f"{label} {key}: {base[key]} -> {route[key]}")
+        if route["per_s"] < base["per_s"] * (1 - tolerance):
+            regressions.append(f"{label} per_s: {base['per_s']} -> {route['per_s']}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="small in-process preset")
+    for name in PRESETS["full"]:
+        parser.add_argument(f"--{name}", type=int)
+    parser.add_argument("--gateway-latency", type=float, default=0.02, help="seconds per fake Razorpay/FCM call")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to check against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--reset", action="store_true", help="allow wiping a non-SQLite DATABASE_URL")
+    parser.add_argument("--verbose", action="store_true", help="let the app's own output through")
+    args = parser.parse_args(argv)
+    for name, value in PRESETS["quick" if args.quick else "full"].items():
+        if getattr(args, name) is None:
+            setattr(args, name, value)
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = asyncio.run(run(args))
+
+    print(f"{'route':<32} {'count':>7} {'per_s':>9} {'p50_ms':>9} {'p95_ms':>9} {'p99_ms':>9}  statuses")
+    for label, route in results["routes"].items():
+        print(f"{label:<32} {route['count']:>7} {route['per_s']:>9} {route['p50_ms']:>9} "
+              f"{route['p95_ms']:>9} {route['p99_ms']:>9}  {route['statuses']}")
+    print("\n" + "  ".join(f"{key}={value}" for key, value in results["summary"].items()))
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    failures = ["hot item oversold"] if results["summary"]["oversold"] else []
+    if results["summary"]["purchase_totals_mismatches"]:
+        failures.append(f"{results['summary']['purchase_totals_mismatches']} users' purchase totals disagree with the ledger")
+    failures += results["api_check_failures"]
+    if args.compare:
+        with open(args.compare) as f:
+            failures += compare(results, json.load(f), args.tolerance)
+    if failures:
+        raise SystemExit("Regressions:\n  " + "\n  ".join(failures))
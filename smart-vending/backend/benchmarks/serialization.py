@@ -0,0 +1,117 @@
+"""Cost of turning product rows into a JSON response body, per 10k rows.
+
+  orm+jsonable   ORM objects through jsonable_encoder + json.dumps (the old
+                 untyped handlers returning db.query(Product).all())
+  dicts+jsonable projected rows as dicts, still untyped
+  rows+model     projected rows through the list[ProductResponse] response
+                 model, serialized straight to bytes by pydantic (what
+                 FastAPI does for routes with a response_model)
+  rows+orjson    projected rows as dicts through orjson, for reference
+                 (only when orjson is installed)
+
+Query and serialization are timed separately; serialization is what this
+change targets, the query column shows what projection saves on the way in.
+
+Run from the backend directory:
+    python -m benchmarks.serialization --rows 10000 --repeat 5
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+from sqlalchemy import select
+
+import crud
+import models
+import schemas
+from database import Base, SessionLocal, engine
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def seed(rows: int):
+    db = SessionLocal()
+    try:
+        machine = models.Machine(name="Bench machine", location="Bench", latitude=26.47, longitude=73.11)
+        db.add(machine)
+        db.flush()
+        db.execute(models.Product.__table__.insert(), [
+            {"machine_id": machine.id, "name": f"Product {i}", "price": 10 + i % 90, "stock": i % 25}
+            for i in range(rows)
+        ])
+        db.commit()
+    finally:
+        db.close()
+
+
+def best_of(repeat: int, fn):
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run(rows: int, repeat: int):
+    Base.metadata.create_all(bind=engine)
+    seed(rows)
+    adapter = TypeAdapter(list[schemas.ProductResponse])
+    scale = 10000 / rows
+
+    def query_orm():
+        db = SessionLocal()
+        try:
+            return db.query(models.Product).all()
+        finally:
+            db.close()
+
+    def query_rows():
+        db = SessionLocal()
+        try:
+            return db.execute(select(*crud.PRODUCT_COLUMNS)).all()
+        finally:
+            db.close()
+
+    cases = [
+        ("orm+jsonable", query_orm, lambda data: json.dumps(jsonable_encoder(data)).encode()),
+        ("dicts+jsonable", query_rows, lambda data: json.dumps(jsonable_encoder([row._asdict() for row in data])).encode()),
+        ("rows+model", query_rows, lambda data: adapter.dump_json(adapter.validate_python(data, from_attributes=True))),
+    ]
+    if orjson is not None:
+        cases.append(("rows+orjson", query_rows, lambda data: orjson.dumps([row._asdict() for row in data])))
+
+    reports = []
+    for name, query, serialize in cases:
+        query_s, data = best_of(repeat, query)
+        serialize_s, body = best_of(repeat, lambda: serialize(data))
+        reports.append({
+            "path": name,
+            "query_ms_per_10k": round(query_s * scale * 1000, 2),
+            "serialize_ms_per_10k": round(serialize_s * scale * 1000, 2),
+            "body_kb": round(len(body) / 1024, 1),
+        })
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    reports = run(args.rows, args.repeat)
+    columns = list(reports[0])
+    print("  ".join(f"{c:>22}" for c in columns))
+    for report in reports:
+        print("  ".join(f"{str(report[c]):>22}" for c in columns))
@@ -0,0 +1,145 @@
+"""Purchase throughput and event-loop stalls: sync vs async database access.
+
+Serves the same purchase three ways from one ASGI app and drives each with
+concurrent requests, while a ticker task measures how late the event loop
+wakes up (a stalled loop also stalls every WebSocket on the worker):
+
+  blocking   async def route calling the sync crud.buy_product (the old /buy)
+  threadpool def route calling crud.buy_product, run in Starlette's threadpool
+  async      async def route awaiting crud.buy_product_async
+
+Point DATABASE_URL at Postgres for representative numbers; the default is a
+throwaway SQLite file.
+
+Run from the backend directory:
+    python -m benchmarks.sync_vs_async --requests 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+import httpx
+from fastapi import Depends, FastAPI
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import crud
+import models
+from database import Base, SessionLocal, async_engine, engine, get_async_db
+
+MODES = ("blocking", "threadpool", "async")
+TICK = 0.005
+
+
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+app = FastAPI()
+
+
+@app.post("/blocking/{product_id}")
+async def buy_blocking(product_id: int, db=Depends(get_db)):
+    result = crud.buy_product(db, product_id)
+    return {"ok": result not in (None, "Out of stock")}
+
+
+@app.post("/threadpool/{product_id}")
+def buy_threadpool(product_id: int, db=Depends(get_db)):
+    result = crud.buy_product(db, product_id)
+    return {"ok": result not in (None, "Out of stock")}
+
+
+@app.post("/async/{product_id}")
+async def buy_async(product_id: int, db: AsyncSession = Depends(get_async_db)):
+    result = await crud.buy_product_async(db, product_id)
+    return {"ok": result not in (None, "Out of stock")}
+
+
+def seed(stock: int) -> int:
+    db = SessionLocal()
+    try:
+        machine = models.Machine(name="Bench machine", location="Bench", latitude=26.47, longitude=73.11)
+        db.add(machine)
+        db.flush()
+        product = models.Product(machine_id=machine.id, name="Hot Coke", price=40, stock=stock)
+        db.add(product)
+        db.commit()
+        return product.id
+    finally:
+        db.close()
+
+
+def percentile(values, pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def ticker(lags: list, stop: asyncio.Event):
+    # How much later than asked the loop gets back to us
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        lags.append(time.perf_counter() - start - TICK)
+
+
+async def run_mode(mode: str, requests: int, concurrency: int) -> dict:
+    product_id = seed(requests)
+    transport = httpx.ASGITransport(app=app)
+    latencies, lags, stop = [], [], asyncio.Event()
+    sem = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def one():
+            async with sem:
+                start = time.perf_counter()
+                response = await client.post(f"/{mode}/{product_id}")
+                latencies.append(time.perf_counter() - start)
+                return response.json()["ok"]
+
+        tick = asyncio.create_task(ticker(lags, stop))
+        start = time.perf_counter()
+        results = await asyncio.gather(*(one() for _ in range(requests)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await tick
+
+    return {
+        "mode": mode,
+        "sold": sum(results),
+        "purchases_per_s": round(requests / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "loop_lag_p99_ms": round(percentile(lags, 99) * 1000, 2) if lags else None,
+        "loop_lag_max_ms": round(max(lags) * 1000, 2) if lags else None,
+    }
+
+
+async def main(modes, requests: int, concurrency: int):
+    Base.metadata.create_all(bind=engine)
+    reports = []
+    for mode in modes:
+        reports.append(await run_mode(mode, requests, concurrency))
+    await async_engine.dispose()
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    args = parser.parse_args()
+
+    reports = asyncio.run(main(args.modes, args.requests, args.concurrency))
+    columns = list(reports[0])
+    print("  ".join(f"{c:>16}" for c in columns))
+    for report in reports:
+        print("  ".join(f"{str(report[c]):>16}" for c in columns))
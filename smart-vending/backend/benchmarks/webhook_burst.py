@@ -0,0 +1,87 @@
+"""Webhook ack latency and database transactions for a burst of deliveries.
+
+Posts a burst of Razorpay webhooks, a share of them retries of earlier
+event ids, straight at /webhook/razorpay and reports how long the route
+took to answer and how many batches (one transaction each) the webhook
+worker needed to journal them.
+
+Run from the backend directory:
+    python -m benchmarks.webhook_burst --events 5000 --retries 0.3 --concurrency 100
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+import httpx
+from fastapi import FastAPI
+
+import webhooks
+from database import Base, engine
+from routers import product
+
+# Just the product routes; no lifespan, so only the webhook worker runs
+app = FastAPI()
+app.include_router(product.router)
+
+
+def percentile(values, pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def deliveries(events: int, retries: float):
+    unique = int(events * (1 - retries))
+    for i in range(events):
+        n = i if i < unique else random.randrange(unique)
+        body = {"event": "payment.captured", "payload": {"payment": {"entity": {"id": f"pay_{n}"}}}}
+        yield f"evt_{n}", json.dumps(body).encode()
+
+
+async def main(events: int, retries: float, concurrency: int):
+    Base.metadata.create_all(bind=engine)
+    await webhooks.webhook_queue.start()
+    latencies = []
+    sem = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        async def one(event_id, body):
+            async with sem:
+                start = time.perf_counter()
+                await client.post("/webhook/razorpay", content=body, headers={"x-razorpay-event-id": event_id})
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(*d) for d in deliveries(events, retries)))
+        acked = time.perf_counter() - start
+        await webhooks.webhook_queue.stop()
+        written = time.perf_counter() - start
+
+    stats = webhooks.webhook_queue.stats()
+    return {
+        "deliveries": events,
+        "recorded": stats["recorded"],
+        "duplicates_acked": stats["duplicates"],
+        "transactions": stats["batches"],
+        "ack_p50_us": round(percentile(latencies, 50) * 1e6),
+        "ack_p99_us": round(percentile(latencies, 99) * 1e6),
+        "all_acked_s": round(acked, 2),
+        "all_written_s": round(written, 2),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--retries", type=float, default=0.3, help="share of deliveries that repeat an event id")
+    parser.add_argument("--concurrency", type=int, default=100)
+    args = parser.parse_args()
+
+    report = asyncio.run(main(args.events, args.retries, args.concurrency))
+    for key, value in report.items():
+        print(f"{key:>18}  {value}")
@@ -0,0 +1,120 @@
+"""/buy latency with thousands of connected WebSocket listeners.
+
+Registers in-process fake sockets with the ConnectionManager (a fraction of
+them deliberately slow), then drives /buy through the ASGI app and reports
+request latency alongside fan-out delivery stats.
+
+Run from the backend directory:
+    python -m benchmarks.ws_fanout --sockets 1000 5000 10000 --buys 200
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+import httpx
+
+import main
+import models
+from backplane import backplane
+from database import SessionLocal
+from websocket_manager import manager
+
+
+class FakeWebSocket:
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.received = 0
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, message: str):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.received += 1
+
+    async def close(self, code: int = 1000):
+        pass
+
+
+def seed(stock: int) -> int:
+    db = SessionLocal()
+    try:
+        machine = models.Machine(name="Bench machine", location="Bench", latitude=26.47, longitude=73.11)
+        db.add(machine)
+        db.flush()
+        product = models.Product(machine_id=machine.id, name="Hot Coke", price=40, stock=stock)
+        user = models.User(name="Bench", email=f"bench{time.time_ns()}@example.com", password="x")
+        db.add_all([product, user])
+        db.commit()
+        return product.id, user.id
+    finally:
+        db.close()
+
+
+def percentile(samples, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+async def run(sockets: int, buys: int, slow_fraction: float, slow_delay: float) -> dict:
+    product_id, user_id = seed(buys)
+    fakes = [
+        FakeWebSocket(slow_delay if i < sockets * slow_fraction else 0)
+        for i in range(sockets)
+    ]
+    for fake in fakes:
+        await manager.connect(fake)
+
+    latencies = []
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        start = time.perf_counter()
+        for i in range(buys):
+            # A fresh payment id per buy, or the idempotency cache replays the first one without a broadcast
+            payment = {"order_id": "order_bench", "payment_id": f"pay_bench_{product_id}_{i}", "signature": "sig"}
+            t0 = time.perf_counter()
+            response = await client.post(f"/buy/{product_id}", params={"user_id": user_id}, json=payment)
+            latencies.append((time.perf_counter() - t0) * 1000)
+            response.raise_for_status()
+        elapsed = time.perf_counter() - start
+
+    # Give writer tasks a moment to drain before reading delivery counts
+    await asyncio.sleep(max(0.2, slow_delay * 2))
+    delivered = sum(fake.received for fake in fakes)
+    dropped = sum(client.dropped for client in manager.active_connections.values())
+    for fake in fakes:
+        manager.disconnect(fake)
+
+    return {
+        "sockets": sockets,
+        "buys": buys,
+        "buy_p50_ms": round(percentile(latencies, 50), 2),
+        "buy_p95_ms": round(percentile(latencies, 95), 2),
+        "buy_p99_ms": round(percentile(latencies, 99), 2),
+        "buys_per_s": round(buys / elapsed, 1),
+        "delivered": delivered,
+        "expected": sockets * buys,
+        "dropped": dropped,
+    }
+
+
+async def main_async(args):
+    # ASGITransport does not run the lifespan, so hook the backplane up by hand
+    await backplane.start(main.deliver_event)
+    for sockets in args.sockets:
+        report = await run(sockets, args.buys, args.slow_fraction, args.slow_delay)
+        print("  ".join(f"{key}={value}" for key, value in report.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sockets", type=int, nargs="+", default=[1000, 5000, 10000])
+    parser.add_argument("--buys", type=int, default=200)
+    parser.add_argument("--slow-fraction", type=float, default=0.05)
+    parser.add_argument("--slow-delay", type=float, default=0.05)
+    asyncio.run(main_async(parser.parse_args()))
@@ -0,0 +1,170 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+import models
+
+# Entries expire after this many seconds even if nothing invalidated them
+CACHE_TTL = float(os.getenv("CACHE_TTL", "60"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+# Set to 0 to turn the read cache off entirely
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "1") not in ("0", "false", "no")
+# Completed /buy responses kept so client retries are answered without touching the database
+PAYMENT_REPLAY_TTL = float(os.getenv("PAYMENT_REPLAY_TTL", "600"))
+PAYMENT_REPLAY_ENTRIES = int(os.getenv("PAYMENT_REPLAY_ENTRIES", "10000"))
+
+
+# In-process read-through cache with TTL and LRU eviction. Every entry is
+# filed under tags ("products", "product:7", "machines", ...) and write paths
+# invalidate by tag, so a purchase only drops the entries that showed that
+# product. Other workers invalidate from the same inventory events they
+# already receive over the backplane, so no shared store is needed.
+class TTLCache:
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL, enabled: bool = CACHE_ENABLED):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, value, tags)
+        self._tags = {}                # tag -> keys filed under it
+
+    def get(self, key):
+        # (found, value)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value, tags=()):
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value, tuple(tags))
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get_or_load(self, key, load, tags=()):
+        # load() returns (value, extra tags known only once the value is built)
+        if not self.enabled:
+            return load()[0]
+        found, value = self.get(key)
+        if found:
+            return value
+        # Entries invalidated while we were loading must not be resurrected
+        generation = self.invalidations
+        value, extra_tags = load()
+        if generation == self.invalidations:
+            self.set(key, value, tuple(tags) + tuple(extra_tags))
+        return value
+
+    def invalidate(self, *tags):
+        with self._lock:
+            self.invalidations += 1
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    if key in self._entries:
+                        self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += 1
+            self._entries.clear()
+            self._tags.clear()
+
+    def _drop(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_s": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+catalog_cache = TTLCache()
+# payment_id -> (signature, response) of recent successful purchases
+recent_payments = TTLCache(max_entries=PAYMENT_REPLAY_ENTRIES, ttl=PAYMENT_REPLAY_TTL, enabled=True)
+
+
+def invalidate_products(product_ids):
+    # Stock or price changed: the full listing and anything showing these products
+    catalog_cache.invalidate("products", *(f"product:{product_id}" for product_id in product_ids))
+
+
+# Machine edits and product inserts/renames/deletes don't go through the
+# inventory events, so they are caught from the ORM and applied on commit
+def _stage(session, tags):
+    session.info.setdefault("cache_invalidations", set()).update(tags)
+
+
+@event.listens_for(models.Machine, "after_insert")
+@event.listens_for(models.Machine, "after_update")
+@event.listens_for(models.Machine, "after_delete")
+def _machine_changed(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        _stage(session, ["machines"])
+
+
+@event.listens_for(models.Product, "after_insert")
+@event.listens_for(models.Product, "after_delete")
+def _product_added_or_removed(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        _stage(session, ["products", "search"])
+
+
+@event.listens_for(models.Product, "after_update")
+def _product_updated(mapper, connection, target):
+    session = object_session(target)
+    if session is None:
+        return
+    tags = ["products", f"product:{target.id}"]
+    attrs = inspect(target).attrs
+    if attrs.name.history.has_changes() or attrs.machine_id.history.has_changes():
+        tags.append("search")
+    _stage(session, tags)
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_staged(session):
+    tags = session.info.pop("cache_invalidations", None)
+    if tags:
+        catalog_cache.invalidate(*tags)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_staged(session):
+    session.info.pop("cache_invalidations", None)
@@ -1,5 +1,48 @@
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import bindparam, case, delete, func, insert, literal, select, tuple_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-import models, schemas, auth
+import models, schemas, auth, search
+from inventory import low_stock, stock_index
+from cache import catalog_cache, invalidate_products
+
+# Sales bucket sizes kept by every write path
+SALES_GRANULARITIES = ("hour", "day")
+
+# WebhookEvent.applied
+WEBHOOK_WAITING, WEBHOOK_APPLIED, WEBHOOK_IGNORED = 0, 1, 2
+
+# Columns handed back by the write paths instead of a full ORM object
+PRODUCT_COLUMNS = (
+    models.Product.id,
+    models.Product.machine_id,
+    models.Product.name,
+    models.Product.price,
+    models.Product.stock,
+)
+
+# Columns of schemas.MachineResponse
+MACHINE_COLUMNS = (
+    models.Machine.id,
+    models.Machine.name,
+    models.Machine.location,
+    models.Machine.latitude,
+    models.Machine.longitude,
+)
+
+# Columns of schemas.ProductSearchResponse
+SEARCH_COLUMNS = (
+    models.Product.id,
+    models.Product.name,
+    models.Product.price,
+    models.Product.stock,
+    models.Machine.id.label("machine_id"),
+    models.Machine.name.label("machine_name"),
+    models.Machine.location,
+    models.Machine.latitude,
+    models.Machine.longitude,
+)
 
 # Create User
 def create_user(db: Session, user: schemas.UserCreate):
@@ -14,49 +57,662 @@ def create_user(db: Session, user: schemas.UserCreate):
     return db_user
 
 
+def _released(db: Session, read):
+    # Runs a read and hands the connection straight back to the pool. Sync routes
+    # with a response_model are serialized in the threadpool, and sessions still
+    # holding connections by then can starve the very threads that would close
+    # them. Results are plain Rows, so nothing needs the transaction afterwards;
+    # one the caller already had open is left alone.
+    owned = not db.in_transaction()
+    try:
+        return read()
+    finally:
+        if owned:
+            db.rollback()
+
 # Get All Products
 def get_products(db: Session):
-    return db.query(models.Product).all()
+    def load():
+        return db.execute(select(*PRODUCT_COLUMNS).order_by(models.Product.id)).all(), ()
+    return catalog_cache.get_or_load(("products",), lambda: _released(db, load), tags=("products",))
+
+def get_machine_products(db: Session, machine_id: int, product_ids=None):
+    # Rows for one machine, optionally only the given products (for deltas)
+    query = select(*PRODUCT_COLUMNS).where(models.Product.machine_id == machine_id)
+    if product_ids is not None:
+        query = query.where(models.Product.id.in_(product_ids))
+    return _released(db, lambda: db.execute(query.order_by(models.Product.id)).all())
+
+def machine_exists(db: Session, machine_id: int) -> bool:
+    query = select(models.Machine.id).where(models.Machine.id == machine_id)
+    return _released(db, lambda: db.scalar(query) is not None)
 
 # Get All Machines
 def get_machines(db: Session):
-    return db.query(models.Machine).all()
+    def load():
+        return db.execute(select(*MACHINE_COLUMNS).order_by(models.Machine.id)).all(), ()
+    return catalog_cache.get_or_load(("machines",), lambda: _released(db, load), tags=("machines",))
+
+def stock_changed(*products):
+    # Every committed stock change goes through here so this worker's stock
+    # index and read cache see it before the response goes out
+    for p in products:
+        stock_index.record(p.id, p.machine_id, p.name, p.price, p.stock)
+        low_stock.record(p.id, p.machine_id, p.name, p.stock)
+    invalidate_products(p.id for p in products)
+
+def _buy_statement(product_id: int):
+    # Single conditional UPDATE so concurrent buyers can never oversell:
+    # the row is only touched when a unit is still available.
+    return (
+        update(models.Product)
+        .where(models.Product.id == product_id, models.Product.stock > 0)
+        .values(stock=models.Product.stock - 1)
+    )
+
+def buy_product(db: Session, product_id: int, commit: bool = True):
+    # With commit=False the caller commits (and reports the stock change)
+    stmt = _buy_statement(product_id)
+
+    if db.get_bind().dialect.update_returning:
+        product = db.execute(stmt.returning(*PRODUCT_COLUMNS)).first()
+    else:
+        # Older SQLite builds have no RETURNING, read the row back in the same transaction
+        updated = db.execute(stmt).rowcount
+        product = None
+        if updated:
+            product = db.execute(
+                select(*PRODUCT_COLUMNS).where(models.Product.id == product_id)
+            ).first()
+
+    if product is None:
+        db.rollback()
+        # Only the failure path pays for a second lookup
+        exists = db.execute(
+            select(models.Product.id).where(models.Product.id == product_id)
+        ).first()
+        return "Out of stock" if exists else None
+
+    if commit:
+        db.commit()
+        stock_changed(product)
+    return product
+
+async def buy_product_async(db: AsyncSession, product_id: int, commit: bool = True):
+    # Same as buy_product on the async engine. With commit=False the caller
+    # commits, so the stock decrement and the purchase record land together.
+    stmt = _buy_statement(product_id)
+
+    if db.bind.dialect.update_returning:
+        product = (await db.execute(stmt.returning(*PRODUCT_COLUMNS))).first()
+    else:
+        updated = (await db.execute(stmt)).rowcount
+        product = None
+        if updated:
+            product = (await db.execute(
+                select(*PRODUCT_COLUMNS).where(models.Product.id == product_id)
+            )).first()
+
+    if product is None:
+        await db.rollback()
+        exists = (await db.execute(
+            select(models.Product.id).where(models.Product.id == product_id)
+        )).first()
+        return "Out of stock" if exists else None
+
+    if commit:
+        await db.commit()
+        stock_changed(product)
+    return product
+
+async def record_offline_sales(db: AsyncSession, sales):
+    # Applies a batch of sales reported by machine hardware in one transaction.
+    # Returns (updated product rows, sales applied, duplicate keys, unknown product ids).
+    # Keys already recorded, or repeated within the batch, are skipped.
+    try:
+        return await _record_offline_sales(db, sales)
+    except IntegrityError:
+        # The same batch is being replayed concurrently; once that commits its
+        # keys are visible and this pass only applies what is left
+        await db.rollback()
+        return await _record_offline_sales(db, sales)
+
+async def _record_offline_sales(db: AsyncSession, sales):
+    batch = {}
+    for sale in sales:
+        batch.setdefault(sale.idempotency_key, sale)
+
+    seen = set((await db.execute(
+        select(models.Transaction.idempotency_key)
+        .where(models.Transaction.idempotency_key.in_(batch))
+    )).scalars())
+    duplicates = [key for key in batch if key in seen]
+    new_sales = [sale for key, sale in batch.items() if key not in seen]
+
+    product_ids = {sale.product_id for sale in new_sales}
+    catalog = {row.id: row for row in (await db.execute(
+        select(models.Product.id, models.Product.price, models.Product.machine_id)
+        .where(models.Product.id.in_(product_ids))
+    )).all()} if product_ids else {}
+    unknown = sorted(product_ids - catalog.keys())
+    new_sales = [sale for sale in new_sales if sale.product_id in catalog]
+    if not new_sales:
+        await db.rollback()
+        return [], 0, duplicates, unknown
+
+    sold = {}
+    for sale in new_sales:
+        sold[sale.product_id] = sold.get(sale.product_id, 0) + 1
+
+    ledger = [
+        {
+            "user_id": None,
+            "product_id": sale.product_id,
+            "machine_id": catalog[sale.product_id].machine_id,
+            "amount": catalog[sale.product_id].price,
+            "payment_status": "Completed",
+            "idempotency_key": sale.idempotency_key,
+            "created_at": _utc_naive(sale.sold_at),
+        }
+        for sale in new_sales
+    ]
+    conn = await db.connection()
+    await conn.execute(insert(models.Transaction.__table__), ledger)
+    buckets = _sales_buckets_write(db.bind.dialect.name, [
+        (row["machine_id"], row["product_id"], row["created_at"], 1, row["amount"]) for row in ledger
+    ])
+    if buckets:
+        await conn.execute(*buckets)
+    # The units already left the machine, so a stale count bottoms out at zero instead of refusing the sale
+    products_table = models.Product.__table__
+    stock = products_table.c.stock
+    await conn.execute(
+        update(products_table)
+        .where(products_table.c.id == bindparam("product_id"))
+        .values(stock=case((stock > bindparam("quantity"), stock - bindparam("quantity")), else_=0)),
+        [{"product_id": pid, "quantity": quantity} for pid, quantity in sold.items()]
+    )
+    products = (await db.execute(
+        select(*PRODUCT_COLUMNS).where(models.Product.id.in_(sold))
+    )).all()
 
-def buy_product(db: Session, product_id: int):
-    product = db.query(models.Product).filter(models.Product.id == product_id).first()
-    
-    if not product:
+    await db.commit()
+    stock_changed(*products)
+    return products, len(new_sales), duplicates, unknown
+
+def _utc_naive(value):
+    # TIMESTAMP columns are stored without a zone
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def _utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def _bucket_start(granularity: str, value: datetime):
+    if granularity == "hour":
+        return value.replace(minute=0, second=0, microsecond=0)
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def _sales_bucket_rows(sales):
+    # [(machine_id, product_id, sold_at, units, revenue)] -> one row per bucket
+    # touched, sorted so concurrent upserts lock buckets in the same order
+    totals = {}
+    for machine_id, product_id, sold_at, units, revenue in sales:
+        if machine_id is None or sold_at is None:
+            continue
+        for granularity in SALES_GRANULARITIES:
+            key = (granularity, _bucket_start(granularity, sold_at), machine_id, product_id)
+            old_units, old_revenue = totals.get(key, (0, 0.0))
+            totals[key] = (old_units + units, old_revenue + revenue)
+    return [
+        {"granularity": g, "bucket_start": start, "machine_id": m, "product_id": p, "units": units, "revenue": revenue}
+        for (g, start, m, p), (units, revenue) in sorted(totals.items())
+    ]
+
+def _sales_buckets_write(dialect: str, sales):
+    # (statement, rows) adding the sales to their buckets in one executemany,
+    # or None when there is nothing to write
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        # No upsert to lean on; rebuild_sales_buckets brings them up to date
+        return None
+    rows = _sales_bucket_rows(sales)
+    if not rows:
         return None
-    
-    if product.stock <= 0:
-        return "Out of stock"
-    
-    product.stock -= 1
+
+    buckets = models.SalesBucket.__table__
+    stmt = insert(buckets)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[buckets.c.granularity, buckets.c.bucket_start, buckets.c.machine_id, buckets.c.product_id],
+        set_={
+            "units": buckets.c.units + stmt.excluded.units,
+            "revenue": buckets.c.revenue + stmt.excluded.revenue,
+        }
+    )
+    return stmt, rows
+
+def reserve_product(db: Session, product_id: int, expires_at: datetime):
+    # Takes one unit out of stock and holds it; returns (product row, reservation id)
+    # or the same "Out of stock"/None failures as buy_product
+    product = buy_product(db, product_id, commit=False)
+    if product is None or product == "Out of stock":
+        return product
+
+    reservation = models.Reservation(
+        product_id=product.id,
+        product_name=product.name,
+        price=product.price,
+        machine_id=product.machine_id,
+        status="held",
+        expires_at=expires_at
+    )
+    db.add(reservation)
+    db.flush()
+    # Read before commit: afterwards it would reload the row and keep a connection
+    # checked out while the caller waits on Razorpay
+    reservation_id = reservation.id
     db.commit()
+    stock_changed(product)
+    return product, reservation_id
+
+def attach_order(db: Session, reservation_id: int, order_id: str):
+    db.execute(
+        update(models.Reservation)
+        .where(models.Reservation.id == reservation_id)
+        .values(order_id=order_id)
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+
+def release_reservations(db: Session, reservation_ids, status: str = "expired"):
+    # Puts the units of still-held reservations back on sale and returns the
+    # updated product rows; reservations already sold or released are left alone
+    reservation = models.Reservation
+    match = reservation.id.in_(list(reservation_ids)) & (reservation.status == "held")
+
+    if db.get_bind().dialect.update_returning:
+        product_ids = db.execute(
+            update(reservation).where(match).values(status=status)
+            .returning(reservation.product_id).execution_options(synchronize_session=False)
+        ).scalars().all()
+    else:
+        rows = db.execute(select(reservation.id, reservation.product_id).where(match)).all()
+        if rows:
+            db.execute(
+                update(reservation).where(reservation.id.in_([r.id for r in rows])).values(status=status)
+                .execution_options(synchronize_session=False)
+            )
+        product_ids = [r.product_id for r in rows]
+
+    if not product_ids:
+        db.rollback()
+        return []
+
+    released = {}
+    for product_id in product_ids:
+        released[product_id] = released.get(product_id, 0) + 1
+    products_table = models.Product.__table__
+    db.connection().execute(
+        update(products_table)
+        .where(products_table.c.id == bindparam("product_id"))
+        .values(stock=products_table.c.stock + bindparam("amount")),
+        [{"product_id": pid, "amount": amount} for pid, amount in released.items()]
+    )
+    products = db.execute(select(*PRODUCT_COLUMNS).where(models.Product.id.in_(released))).all()
+    db.commit()
+    stock_changed(*products)
+    return products
+
+def held_reservations(db: Session):
+    # (id, expires_at) of every reservation still waiting for payment
+    return db.execute(
+        select(models.Reservation.id, models.Reservation.expires_at)
+        .where(models.Reservation.status == "held")
+    ).all()
+
+async def claim_reservation(db: AsyncSession, order_id: str, product_id: int):
+    # Turns the held reservation for this order into a sale; the unit already
+    # left stock, so the product row is not touched. Caller commits.
+    reservation = models.Reservation
+    match = (
+        (reservation.order_id == order_id)
+        & (reservation.product_id == product_id)
+        & (reservation.status == "held")
+    )
+    returned = (
+        reservation.id,
+        reservation.product_id,
+        reservation.product_name.label("name"),
+        reservation.price,
+        reservation.machine_id,
+    )
+
+    if db.bind.dialect.update_returning:
+        return (await db.execute(
+            update(reservation).where(match).values(status="sold")
+            .returning(*returned).execution_options(synchronize_session=False)
+        )).first()
+
+    row = (await db.execute(select(*returned).where(match))).first()
+    if row:
+        await db.execute(
+            update(reservation).where(reservation.id == row.id).values(status="sold")
+            .execution_options(synchronize_session=False)
+        )
+    return row
+
+def _new_transaction(user_id: int, product_id: int, amount: float, payment_id: str = None, machine_id: int = None):
+    return models.Transaction(
+        user_id=user_id,
+        product_id=product_id,
+        machine_id=machine_id,
+        amount=amount,
+        payment_status="Completed",
+        payment_id=payment_id,
+        created_at=_utc_now()
+    )
+
+async def record_purchase_async(db: AsyncSession, user_id: int, product_id: int, amount: float, payment_id: str = None,
+                                machine_id: int = None):
+    # Raises IntegrityError on flush when payment_id was already used
+    if machine_id is None:
+        machine_id = await db.scalar(select(models.Product.machine_id).where(models.Product.id == product_id))
+    transaction = _new_transaction(user_id, product_id, amount, payment_id, machine_id)
+    db.add(transaction)
+    await db.flush()
+    dialect = db.bind.dialect.name
+    # Anonymous hardware sales go in the ledger but belong to no user's totals
+    stmt = _purchase_totals_upsert(dialect, user_id, amount) if user_id is not None else None
+    if stmt is not None:
+        await db.execute(stmt)
+    buckets = _sales_buckets_write(dialect, [(machine_id, product_id, transaction.created_at, 1, amount)])
+    if buckets:
+        await (await db.connection()).execute(*buckets)
+    return transaction
+
+async def record_offline_sale(db: AsyncSession, product_id: int):
+    # One sale reported live by machine hardware: the stock decrement, its
+    # ledger row and the sales buckets in one commit. Returns the product row
+    # or the same "Out of stock"/None failures as buy_product_async.
+    product = await buy_product_async(db, product_id, commit=False)
+    if product is None or product == "Out of stock":
+        return product
+    await record_purchase_async(db, None, product.id, product.price, machine_id=product.machine_id)
+    await db.commit()
+    stock_changed(product)
     return product
 
-def search_product(db: Session, name: str):
-    results = db.query(models.Product, models.Machine).join(
-        models.Machine, models.Product.machine_id == models.Machine.id
-    ).filter(
-        models.Product.name.ilike(f"%{name}%")
+async def get_purchase_by_payment(db: AsyncSession, payment_id: str):
+    # (transaction id, product name) of the purchase already made with this payment
+    return (await db.execute(
+        select(models.Transaction.id, models.Product.name)
+        .join(models.Product, models.Transaction.product_id == models.Product.id)
+        .where(models.Transaction.payment_id == payment_id)
+    )).first()
+
+def record_webhook_events(db: Session, events, retry_window: float):
+    # Journals a batch of Razorpay webhook events and applies their payment
+    # statuses in one transaction. Returns (events recorded, transactions changed).
+    # Events already in the journal are skipped, except ones still waiting for
+    # their transaction: those journaled in the last retry_window seconds (or
+    # redelivered now) are applied first, once their purchase has been recorded.
+    # Called with no events it only retries the waiting ones.
+    try:
+        return _record_webhook_events(db, events, retry_window)
+    except IntegrityError:
+        # Another worker journaled some of these first; retry with what is left
+        db.rollback()
+        return _record_webhook_events(db, events, retry_window)
+
+def _record_webhook_events(db: Session, events, retry_window: float):
+    batch = {}
+    for event in events:
+        batch.setdefault(event["event_id"], event)
+
+    journal = models.WebhookEvent
+    seen = set(db.execute(
+        select(journal.event_id).where(journal.event_id.in_(batch))
+    ).scalars()) if batch else set()
+    new_events = [event for key, event in batch.items() if key not in seen]
+
+    now = _utc_now()
+    waiting = db.execute(
+        select(journal.id, journal.payment_id, journal.status)
+        .join(models.Transaction, models.Transaction.payment_id == journal.payment_id)
+        .where(
+            journal.applied == WEBHOOK_WAITING,
+            (journal.received_at >= now - timedelta(seconds=retry_window)) | journal.event_id.in_(seen),
+        )
+        .order_by(journal.id)
     ).all()
-    
-    # Map to schema-friendly dicts
-    search_results = []
-    for product, machine in results:
-        search_results.append({
-            "id": product.id,
-            "name": product.name,
-            "price": product.price,
-            "stock": product.stock,
-            "machine_id": machine.id,
-            "machine_name": machine.name,
-            "location": machine.location,
-            "latitude": machine.latitude,
-            "longitude": machine.longitude
-        })
-    return search_results
+    if not new_events and not waiting:
+        db.rollback()
+        return 0, 0
+
+    # Last word per payment in arrival order, except that a refund is final
+    statuses = {}
+    arrivals = [(row.payment_id, row.status) for row in waiting]
+    arrivals += [(event["payment_id"], event["status"]) for event in new_events]
+    for payment_id, status in arrivals:
+        if payment_id and status and statuses.get(payment_id) != "Refunded":
+            statuses[payment_id] = status
+
+    transactions = db.execute(
+        select(
+            models.Transaction.id,
+            models.Transaction.user_id,
+            models.Transaction.amount,
+            models.Transaction.payment_id,
+            models.Transaction.payment_status,
+            models.Transaction.machine_id,
+            models.Transaction.product_id,
+            models.Transaction.created_at,
+        ).where(models.Transaction.payment_id.in_(statuses))
+    ).all() if statuses else []
+
+    changes, totals, sales = [], {}, []
+    for tx in transactions:
+        status = statuses[tx.payment_id]
+        if tx.payment_status in (status, "Refunded"):
+            continue
+        changes.append({"tx_id": tx.id, "status": status})
+        # Keep the running purchase totals and sales buckets in step with what counts as completed
+        if "Completed" in (tx.payment_status, status):
+            sign = 1 if status == "Completed" else -1
+            sales.append((tx.machine_id, tx.product_id, tx.created_at, sign, sign * tx.amount))
+            if tx.user_id is not None:
+                spent, count = totals.get(tx.user_id, (0, 0))
+                totals[tx.user_id] = (spent + sign * tx.amount, count + sign)
+
+    known = {tx.payment_id for tx in transactions}
+    conn = db.connection()
+    if new_events:
+        conn.execute(insert(journal.__table__), [
+            {
+                "event_id": event["event_id"],
+                "event": event["event"],
+                "payment_id": event["payment_id"],
+                "status": event["status"],
+                "payload": event["payload"],
+                "applied": (
+                    WEBHOOK_IGNORED if not (event["payment_id"] and event["status"])
+                    else WEBHOOK_APPLIED if event["payment_id"] in known
+                    else WEBHOOK_WAITING
+                ),
+                "received_at": now,
+            }
+            for event in new_events
+        ])
+    if waiting:
+        conn.execute(
+            update(journal.__table__)
+            .where(journal.__table__.c.id.in_([row.id for row in waiting]))
+            .values(applied=WEBHOOK_APPLIED)
+        )
+    if changes:
+        transactions_table = models.Transaction.__table__
+        conn.execute(
+            update(transactions_table)
+            .where(transactions_table.c.id == bindparam("tx_id"))
+            .values(payment_status=bindparam("status")),
+            changes
+        )
+    if totals:
+        # Users without a totals row yet are seeded from their history on their next purchase
+        totals_table = models.UserPurchaseTotal.__table__
+        conn.execute(
+            update(totals_table)
+            .where(totals_table.c.user_id == bindparam("uid"))
+            .values(
+                total_spent=totals_table.c.total_spent + bindparam("spent"),
+                purchase_count=totals_table.c.purchase_count + bindparam("count"),
+            ),
+            [{"uid": uid, "spent": spent, "count": count} for uid, (spent, count) in totals.items()]
+        )
+    buckets = _sales_buckets_write(db.get_bind().dialect.name, sales)
+    if buckets:
+        conn.execute(*buckets)
+
+    db.commit()
+    return len(new_events), len(changes)
+
+def _purchase_totals_upsert(dialect: str, user_id: int, amount: float):
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        # No upsert to lean on; get_purchase_summary falls back to aggregating
+        return None
+
+    # A user's first total is seeded from their history (which already holds
+    # this purchase), later ones are incremented in place
+    totals = models.UserPurchaseTotal.__table__
+    completed = select(
+        literal(user_id),
+        func.coalesce(func.sum(models.Transaction.amount), 0),
+        func.count(models.Transaction.id),
+    ).where(
+        models.Transaction.user_id == user_id,
+        models.Transaction.payment_status == "Completed"
+    )
+    stmt = insert(totals).from_select(["user_id", "total_spent", "purchase_count"], completed)
+    return stmt.on_conflict_do_update(
+        index_elements=[totals.c.user_id],
+        set_={
+            "total_spent": totals.c.total_spent + amount,
+            "purchase_count": totals.c.purchase_count + 1,
+        }
+    )
+
+def get_purchase_summary(db: Session, user_id: int):
+    # (total_spent, purchase_count)
+    totals = db.get(models.UserPurchaseTotal, user_id)
+    if totals is not None:
+        return totals.total_spent, totals.purchase_count
+
+    row = db.execute(
+        select(
+            func.coalesce(func.sum(models.Transaction.amount), 0),
+            func.count(models.Transaction.id),
+        ).where(
+            models.Transaction.user_id == user_id,
+            models.Transaction.payment_status == "Completed"
+        )
+    ).one()
+    return row[0], row[1]
+
+def get_purchase_history(db: Session, user_id: int, limit: int = 20, before: int = None):
+    # Keyset pagination, newest first: pass the returned cursor back as `before`
+    query = select(
+        models.Transaction.id,
+        models.Product.name.label("product_name"),
+        models.Transaction.amount,
+        models.Transaction.payment_status.label("status"),
+    ).join(
+        models.Product, models.Transaction.product_id == models.Product.id
+    ).where(
+        models.Transaction.user_id == user_id,
+        models.Transaction.payment_status == "Completed"
+    )
+    if before is not None:
+        query = query.where(models.Transaction.id < before)
+
+    rows = db.execute(query.order_by(models.Transaction.id.desc()).limit(limit + 1)).all()
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def search_product(db: Session, name: str, limit: int = 50, offset: int = 0):
+    def load():
+        # The search backend ranks product ids, then only that page is joined to machines
+        product_ids = search.backend.search(db, name, limit, offset)
+        if not product_ids:
+            return [], ()
+
+        rows = db.execute(
+            select(*SEARCH_COLUMNS)
+            .join(models.Machine, models.Product.machine_id == models.Machine.id)
+            .where(models.Product.id.in_(product_ids))
+        ).all()
+        by_id = {row.id: row for row in rows}
+
+        # Dropped when any listed product's stock changes, or on renames and new products
+        return [by_id[i] for i in product_ids if i in by_id], [f"product:{i}" for i in product_ids]
+
+    key = ("search", search.normalize(name), limit, offset)
+    return catalog_cache.get_or_load(key, lambda: _released(db, load), tags=("search", "machines"))
+
+def autocomplete_product(db: Session, prefix: str, limit: int = 10):
+    key = ("autocomplete", search.normalize(prefix), limit)
+    def load():
+        return search.backend.autocomplete(db, prefix, limit), ()
+    return catalog_cache.get_or_load(key, lambda: _released(db, load), tags=("search",))
+
+def get_sales_buckets(db: Session, granularity: str, start: datetime, end: datetime, machine_id: int = None,
+                      product_id: int = None, by_machine: bool = False, by_product: bool = False):
+    # Units and revenue per bucket in [start, end), summed over whatever is not
+    # split out; reads sales_buckets only
+    bucket = models.SalesBucket
+    keys = [bucket.bucket_start]
+    if by_machine:
+        keys.append(bucket.machine_id)
+    if by_product:
+        keys.append(bucket.product_id)
+    query = select(*keys, func.sum(bucket.units).label("units"), func.sum(bucket.revenue).label("revenue")).where(
+        bucket.granularity == granularity,
+        bucket.bucket_start >= _bucket_start(granularity, _utc_naive(start)),
+        bucket.bucket_start < _utc_naive(end),
+    )
+    if machine_id is not None:
+        query = query.where(bucket.machine_id == machine_id)
+    if product_id is not None:
+        query = query.where(bucket.product_id == product_id)
+    query = query.group_by(*keys).order_by(*keys)
+    return _released(db, lambda: db.execute(query).all())
+
+def rebuild_sales_buckets(db: Session):
+    # Recount every bucket from the completed transactions in the ledger, e.g.
+    # after backfilling machine_id on old rows. Sales from before transactions
+    # had created_at have no time to bucket by; they are left out and counted.
+    # Returns (buckets written, undated sales skipped).
+    tx = models.Transaction
+    completed = tx.payment_status == "Completed"
+    undated = db.scalar(select(func.count(tx.id)).where(completed, tx.created_at.is_(None)))
+    sales = db.execute(
+        select(tx.machine_id, tx.product_id, tx.created_at, tx.amount)
+        .where(completed, tx.created_at.is_not(None))
+        .execution_options(yield_per=5000)
+    )
+    rows = _sales_bucket_rows((machine_id, product_id, sold_at, 1, amount) for machine_id, product_id, sold_at, amount in sales)
+    db.execute(delete(models.SalesBucket))
+    if rows:
+        db.connection().execute(insert(models.SalesBucket.__table__), rows)
+    db.commit()
+    return len(rows), undated
 
 def update_fcm_token(db: Session, user_id: int, fcm_token: str):
     user = db.query(models.User).filter(models.User.id == user_id).first()
@@ -66,39 +722,213 @@ def update_fcm_token(db: Session, user_id: int, fcm_token: str):
     return user
 
 def create_demand_request(db: Session, user_id: int, request: schemas.DemandRequestCreate):
+    product_name = " ".join(request.product_name.split())
+    name_key = product_name.lower()
+
+    # Asking again for something already pending ("Coke", "coke ", ...) is the
+    # same demand, so repeated clicks count once
+    demand = models.DemandRequest
+    existing = db.execute(
+        select(demand).where(
+            demand.machine_id == request.machine_id,
+            func.lower(demand.product_name) == name_key,
+            demand.is_fulfilled == 0,
+            demand.user_id == user_id,
+        ).limit(1)
+    ).scalar()
+    if existing is not None:
+        return existing
+
     db_demand = models.DemandRequest(
         user_id=user_id,
         machine_id=request.machine_id,
-        product_name=request.product_name,
+        product_name=product_name,
         is_fulfilled=0
     )
     db.add(db_demand)
+    _add_pending_demand(db, request.machine_id, name_key, product_name)
     db.commit()
     db.refresh(db_demand)
     return db_demand
 
+def _add_pending_demand(db: Session, machine_id: int, name_key: str, product_name: str):
+    rollups = models.DemandRollup.__table__
+    dialect = db.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as upsert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as upsert
+        db.execute(
+            upsert(rollups)
+            .values(machine_id=machine_id, name_key=name_key, product_name=product_name, pending=1)
+            .on_conflict_do_update(
+                index_elements=[rollups.c.machine_id, rollups.c.name_key],
+                set_={"pending": rollups.c.pending + 1, "updated_at": func.now()},
+            )
+        )
+        return
+
+    updated = db.execute(
+        update(rollups)
+        .where(rollups.c.machine_id == machine_id, rollups.c.name_key == name_key)
+        .values(pending=rollups.c.pending + 1)
+    )
+    if not updated.rowcount:
+        db.execute(insert(rollups).values(
+            machine_id=machine_id, name_key=name_key, product_name=product_name, pending=1
+        ))
+
+def top_demands(db: Session, machine_id: int = None, limit: int = 10):
+    # Reads at most `limit` rows off the rollup indexes, never demand_requests
+    rollup = models.DemandRollup
+    query = select(rollup.machine_id, rollup.product_name, rollup.pending).where(rollup.pending > 0)
+    if machine_id is not None:
+        query = query.where(rollup.machine_id == machine_id)
+    query = query.order_by(rollup.pending.desc(), rollup.machine_id, rollup.name_key).limit(limit)
+    return _released(db, lambda: db.execute(query).all())
+
+def pending_demand_by_machine(db: Session, machine_ids=None):
+    # {machine_id: pending demands}, from the rollups
+    rollup = models.DemandRollup
+    query = select(rollup.machine_id, func.sum(rollup.pending)).where(rollup.pending > 0)
+    if machine_ids is not None:
+        query = query.where(rollup.machine_id.in_(machine_ids))
+    return _released(db, lambda: dict(db.execute(query.group_by(rollup.machine_id)).all()))
+
+def rebuild_demand_rollups(db: Session):
+    # Recount every rollup from the pending rows in demand_requests
+    demand = models.DemandRequest
+    db.execute(delete(models.DemandRollup))
+    db.execute(
+        insert(models.DemandRollup).from_select(
+            ["machine_id", "name_key", "product_name", "pending"],
+            select(
+                demand.machine_id,
+                func.lower(demand.product_name),
+                func.min(demand.product_name),
+                func.count(demand.id),
+            )
+            .where(demand.is_fulfilled == 0, demand.machine_id.isnot(None), demand.product_name.isnot(None))
+            .group_by(demand.machine_id, func.lower(demand.product_name))
+        )
+    )
+    db.commit()
+    return db.scalar(select(func.count()).select_from(models.DemandRollup))
+
 def restock_product(db: Session, product_id: int, amount: int):
-    product = db.query(models.Product).filter(models.Product.id == product_id).first()
-    if not product:
+    restocked, _ = restock_products(db, {product_id: amount})
+    if not restocked:
         return None, []
-    
-    # Increase stock
-    product.stock += amount
-    
-    # Find all pending demands for this product at this machine
-    pending_demands = db.query(models.DemandRequest).filter(
-        models.DemandRequest.machine_id == product.machine_id,
-        models.DemandRequest.product_name.ilike(product.name),
-        models.DemandRequest.is_fulfilled == 0
+    return restocked[0]
+
+def restock_products(db: Session, amounts: dict):
+    # {product_id: amount} -> ([(product, fcm_tokens)], missing product ids), all in
+    # one transaction and a fixed number of statements however many demands are queued
+    product_ids = list(amounts)
+    products_table = models.Product.__table__
+    # Core executemany: one prepared UPDATE for every product in the batch
+    db.connection().execute(
+        update(products_table)
+        .where(products_table.c.id == bindparam("product_id"))
+        .values(stock=products_table.c.stock + bindparam("amount")),
+        [{"product_id": pid, "amount": amount} for pid, amount in amounts.items()]
+    )
+    products = db.execute(
+        select(*PRODUCT_COLUMNS, func.lower(models.Product.name).label("name_key"))
+        .where(models.Product.id.in_(product_ids))
     ).all()
-    
-    users_to_notify = []
-    for demand in pending_demands:
-        demand.is_fulfilled = 1
-        # Fetch user's FCM token
-        user = db.query(models.User).filter(models.User.id == demand.user_id).first()
-        if user and user.fcm_token:
-            users_to_notify.append(user.fcm_token)
-            
+    found = {p.id for p in products}
+    missing = [pid for pid in product_ids if pid not in found]
+    if not products:
+        db.rollback()
+        return [], missing
+
+    fulfilled = _fulfil_pending_demands(db, list(found))
+
+    # Distinct tokens of the users behind those demands, in one lookup
+    user_ids = {user_id for user_id, _, _ in fulfilled}
+    tokens = dict(db.execute(
+        select(models.User.id, models.User.fcm_token)
+        .where(models.User.id.in_(user_ids), models.User.fcm_token.isnot(None))
+    ).all()) if user_ids else {}
+
+    tokens_by_key = {}
+    fulfilled_counts = {}
+    for user_id, machine_id, name_key in fulfilled:
+        fulfilled_counts[(machine_id, name_key)] = fulfilled_counts.get((machine_id, name_key), 0) + 1
+        if user_id in tokens:
+            tokens_by_key.setdefault((machine_id, name_key), set()).add(tokens[user_id])
+    if fulfilled_counts:
+        _remove_pending_demand(db, fulfilled_counts)
+
     db.commit()
-    return product, users_to_notify
\ No newline at end of file
+    stock_changed(*products)
+    restocked = []
+    for p in products:
+        restocked.append((p, sorted(tokens_by_key.get((p.machine_id, p.name_key), ()))))
+    return restocked, missing
+
+def bulk_restock_amounts(db: Session, restock: schemas.BulkRestock):
+    # Flatten product and whole-machine restocks into {product_id: total amount}.
+    # Amounts are deltas, so anything listed more than once (directly, or via
+    # its machine) gets the sum of them.
+    amounts = {}
+    for item in restock.products:
+        amounts[item.product_id] = amounts.get(item.product_id, 0) + item.amount
+
+    machine_amounts = {}
+    for m in restock.machines:
+        machine_amounts[m.machine_id] = machine_amounts.get(m.machine_id, 0) + m.amount
+    if machine_amounts:
+        rows = db.execute(
+            select(models.Product.id, models.Product.machine_id)
+            .where(models.Product.machine_id.in_(machine_amounts))
+        )
+        for product_id, machine_id in rows:
+            amounts[product_id] = amounts.get(product_id, 0) + machine_amounts[machine_id]
+    return amounts
+
+def _remove_pending_demand(db: Session, counts: dict):
+    # {(machine_id, name_key): demands fulfilled}; rollups that reach zero are dropped
+    rollups = models.DemandRollup.__table__
+    conn = db.connection()
+    conn.execute(
+        update(rollups)
+        .where(rollups.c.machine_id == bindparam("mid"), rollups.c.name_key == bindparam("key"))
+        .values(pending=rollups.c.pending - bindparam("n")),
+        [{"mid": machine_id, "key": name_key, "n": n} for (machine_id, name_key), n in counts.items()]
+    )
+    conn.execute(
+        delete(rollups).where(
+            rollups.c.machine_id.in_({machine_id for machine_id, _ in counts}),
+            rollups.c.pending <= 0,
+        )
+    )
+
+def _fulfil_pending_demands(db: Session, product_ids):
+    # Flip every pending demand for these products (same machine, same name
+    # ignoring case) in a single UPDATE and report (user_id, machine_id, name key)
+    demand = models.DemandRequest
+    match = (
+        (demand.is_fulfilled == 0)
+        & tuple_(demand.machine_id, func.lower(demand.product_name)).in_(
+            select(models.Product.machine_id, func.lower(models.Product.name))
+            .where(models.Product.id.in_(product_ids))
+        )
+    )
+    returned = (demand.user_id, demand.machine_id, func.lower(demand.product_name))
+
+    if db.get_bind().dialect.update_returning:
+        return db.execute(
+            update(demand).where(match).values(is_fulfilled=1)
+            .returning(*returned).execution_options(synchronize_session=False)
+        ).all()
+
+    rows = db.execute(select(demand.id, *returned).where(match)).all()
+    if rows:
+        db.execute(
+            update(demand).where(demand.id.in_([r[0] for r in rows])).values(is_fulfilled=1)
+            .execution_options(synchronize_session=False)
+        )
+    return [tuple(r[1:]) for r in rows]
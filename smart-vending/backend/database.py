@@ -1,13 +1,62 @@
 import os
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 from dotenv import load_dotenv
 
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Connection pool, shared by the sync and async engines (SQLite keeps its own pooling)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
 
-engine = create_engine(DATABASE_URL)
+# Async drivers for the sync URLs we already support
+ASYNC_DRIVERS = {
+    "postgresql": "asyncpg",
+    "sqlite": "aiosqlite",
+}
+
+
+def async_database_url(url: str) -> str:
+    # ASYNC_DATABASE_URL wins; otherwise swap the driver, e.g. postgresql+psycopg2 -> postgresql+asyncpg
+    if os.getenv("ASYNC_DATABASE_URL"):
+        return os.getenv("ASYNC_DATABASE_URL")
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError(f"No async driver configured for {backend}, set ASYNC_DATABASE_URL")
+    return parsed.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}").render_as_string(hide_password=False)
+
+
+def engine_options(url: str) -> dict:
+    options = {"pool_pre_ping": DB_POOL_PRE_PING}
+    if make_url(url).get_backend_name() != "sqlite":
+        options.update(
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+        )
+    return options
+
+
+engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
 SessionLocal = sessionmaker(bind=engine)
 
-Base = declarative_base()
\ No newline at end of file
+# Async routes use this engine so their queries never block the event loop
+ASYNC_DATABASE_URL = async_database_url(DATABASE_URL)
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **engine_options(ASYNC_DATABASE_URL))
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+Base = declarative_base()
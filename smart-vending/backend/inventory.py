@@ -0,0 +1,274 @@
+import os
+import threading
+import uuid
+from collections import defaultdict, deque
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import models
+from backplane import backplane
+
+# How many inventory events a reconnecting client can catch up on before it gets a snapshot
+INVENTORY_EVENT_LOG_SIZE = int(os.getenv("INVENTORY_EVENT_LOG_SIZE", "1024"))
+# Stock below this is low and alerts the vendor; products are tracked up to
+# LOW_STOCK_MAX_THRESHOLD so the restock planner can be asked for more headroom
+LOW_STOCK_THRESHOLD = int(os.getenv("LOW_STOCK_THRESHOLD", "5"))
+LOW_STOCK_MAX_THRESHOLD = int(os.getenv("LOW_STOCK_MAX_THRESHOLD", "20"))
+
+
+def product_key(name: str) -> str:
+    return " ".join(name.lower().split())
+
+
+# Per-product index of machines that currently stock an item:
+# normalized product name -> {product_id: (machine_id, name, price, stock)}.
+# Only rows with stock > 0 are kept, so lookups never see empty slots.
+class StockIndex:
+    def __init__(self):
+        self.loaded = False
+        self._lock = threading.RLock()
+        self._by_name = defaultdict(dict)
+        self._keys = {}  # product_id -> name key it is filed under
+
+    def ensure_loaded(self, db: Session):
+        if self.loaded:
+            return
+        with self._lock:
+            if self.loaded:
+                return
+            rows = db.execute(select(
+                models.Product.id,
+                models.Product.machine_id,
+                models.Product.name,
+                models.Product.price,
+                models.Product.stock,
+            ).where(models.Product.stock > 0)).all()
+            for row in rows:
+                self.record(*row)
+            self.loaded = True
+
+    def record(self, product_id: int, machine_id: int, name: str, price: float, stock: int):
+        # Called by every write path that changes a product's stock
+        with self._lock:
+            old_key = self._keys.pop(product_id, None)
+            if old_key is not None:
+                self._by_name[old_key].pop(product_id, None)
+                if not self._by_name[old_key]:
+                    del self._by_name[old_key]
+
+            if stock is not None and stock > 0 and machine_id is not None:
+                key = product_key(name)
+                self._by_name[key][product_id] = (machine_id, name, price, stock)
+                self._keys[product_id] = key
+
+    def find(self, query: str):
+        # Stocked entries whose name contains the query, scanning distinct names only
+        needle = product_key(query)
+        with self._lock:
+            return [
+                (product_id,) + entry
+                for key, entries in self._by_name.items()
+                if needle in key
+                for product_id, entry in entries.items()
+            ]
+
+
+stock_index = StockIndex()
+
+
+# Products running low, by machine: machine_id -> {product_id: (name, stock)}.
+# Fed by the same writes as StockIndex, so finding machines that need a visit
+# never scans products.
+class LowStockTracker:
+    def __init__(self, max_threshold: int = LOW_STOCK_MAX_THRESHOLD):
+        self.max_threshold = max_threshold
+        self.loaded = False
+        self._lock = threading.RLock()
+        self._by_machine = defaultdict(dict)
+        self._machines = {}  # product_id -> machine_id it is filed under
+
+    def ensure_loaded(self, db: Session):
+        if self.loaded:
+            return
+        with self._lock:
+            if self.loaded:
+                return
+            rows = db.execute(select(
+                models.Product.id,
+                models.Product.machine_id,
+                models.Product.name,
+                models.Product.stock,
+            ).where(models.Product.stock < self.max_threshold)).all()
+            for row in rows:
+                self.record(*row)
+            self.loaded = True
+
+    def record(self, product_id: int, machine_id: int, name: str, stock: int):
+        with self._lock:
+            old_machine = self._machines.pop(product_id, None)
+            if old_machine is not None:
+                self._by_machine[old_machine].pop(product_id, None)
+                if not self._by_machine[old_machine]:
+                    del self._by_machine[old_machine]
+
+            if stock is not None and stock < self.max_threshold and machine_id is not None:
+                self._by_machine[machine_id][product_id] = (name, stock)
+                self._machines[product_id] = machine_id
+
+    def low(self, threshold: int = LOW_STOCK_THRESHOLD):
+        # machine_id -> [(product_id, name, stock)] for products below threshold
+        with self._lock:
+            machines = {}
+            for machine_id, products in self._by_machine.items():
+                low = [(pid, name, stock) for pid, (name, stock) in products.items() if stock < threshold]
+                if low:
+                    machines[machine_id] = low
+            return machines
+
+
+low_stock = LowStockTracker()
+
+
+def event_items(event: dict):
+    # Events either describe one product or carry a list of per-product items
+    return event.get("items") or [event]
+
+
+def event_topics(event: dict):
+    topics = {f"machine:{event['machine_id']}"}
+    topics.update(f"product:{item['product_id']}" for item in event_items(event))
+    return sorted(topics)
+
+
+def _visible(event: dict, topics) -> bool:
+    return "all" in topics or any(topic in topics for topic in event_topics(event))
+
+
+# Bounded log of inventory changes with a per-process sequence. The epoch is
+# regenerated on every start, so sequences from another process or an earlier
+# run are never mistaken for this one's.
+class InventoryEventLog:
+    def __init__(self, size: int = INVENTORY_EVENT_LOG_SIZE):
+        self.epoch = uuid.uuid4().hex[:12]
+        self.seq = 0
+        self.events = deque(maxlen=size)
+        self.machine_seqs = {}  # machine_id -> seq of its latest change
+        self._lock = threading.Lock()
+
+    def append(self, event: dict) -> dict:
+        with self._lock:
+            self.seq += 1
+            event = dict(event, seq=self.seq, epoch=self.epoch)
+            self.events.append(event)
+            self.machine_seqs[event["machine_id"]] = self.seq
+            return event
+
+    def machine_version(self, machine_id: int) -> str:
+        # Changes only when this machine's inventory does; used as its ETag
+        return f"{self.epoch}-{self.machine_seqs.get(machine_id, 0)}"
+
+    def changed_since(self, version: str, machine_id: int):
+        # Product ids of the machine changed after `version`, or None when the
+        # log can no longer tell and the caller has to send everything
+        epoch, _, seq = (version or "").partition("-")
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        with self._lock:
+            if seq > self.seq or (self.events and seq < self.events[0]["seq"] - 1):
+                return None
+            return {
+                item["product_id"]
+                for e in self.events
+                if e["seq"] > seq and e["machine_id"] == machine_id
+                for item in event_items(e)
+            }
+
+    def replay(self, epoch: str, last_seq: int, topics):
+        # Missed events visible to the client, or None when only a snapshot can catch it up
+        with self._lock:
+            if epoch != self.epoch or not isinstance(last_seq, int) or last_seq > self.seq:
+                return None
+            if self.events and last_seq < self.events[0]["seq"] - 1:
+                return None
+            missed = [e for e in self.events if e["seq"] > last_seq and _visible(e, topics)]
+            return {"action": "replay", "epoch": self.epoch, "seq": self.seq, "events": missed}
+
+
+event_log = InventoryEventLog()
+
+
+def record_event(event: dict) -> dict:
+    # Every worker runs this for every published change: sequence it and keep
+    # the local stock index and low-stock tracker in step with writes made by
+    # other workers.
+    event = event_log.append(event)
+    for item in event_items(event):
+        stock_index.record(item["product_id"], event["machine_id"], item["name"], item["price"], item["stock"])
+        low_stock.record(item["product_id"], event["machine_id"], item["name"], item["stock"])
+    return event
+
+
+def snapshot(db: Session, topics) -> dict:
+    # Absolute stock for everything the client is subscribed to. The sequence is
+    # read before the query so any change racing it is still replayed after.
+    seq = event_log.seq
+    query = select(models.Product.id, models.Product.machine_id, models.Product.stock)
+    if "all" not in topics:
+        machine_ids = [int(t.split(":")[1]) for t in topics if t.startswith("machine:")]
+        product_ids = [int(t.split(":")[1]) for t in topics if t.startswith("product:")]
+        query = query.where(
+            models.Product.machine_id.in_(machine_ids) | models.Product.id.in_(product_ids)
+        )
+    products = [
+        {"product_id": product_id, "machine_id": machine_id, "stock": stock}
+        for product_id, machine_id, stock in db.execute(query)
+    ]
+    return {"action": "snapshot", "epoch": event_log.epoch, "seq": seq, "products": products}
+
+
+def stock_event(action: str, product, **extra) -> dict:
+    # Inventory change payload carrying the new absolute stock
+    return dict(
+        action=action,
+        product_id=product.id,
+        machine_id=product.machine_id,
+        name=product.name,
+        price=product.price,
+        stock=product.stock,
+        **extra
+    )
+
+
+def machine_stock_events(action: str, products, **extra):
+    # One event per machine listing every product that changed there, so a
+    # batch of changes reaches subscribers as a single message per machine
+    by_machine = {}
+    for product in products:
+        by_machine.setdefault(product.machine_id, []).append(dict(
+            product_id=product.id,
+            name=product.name,
+            price=product.price,
+            stock=product.stock,
+        ))
+    return [
+        dict(action=action, machine_id=machine_id, items=items, **extra)
+        for machine_id, items in by_machine.items()
+    ]
+
+
+async def publish(event: dict):
+    # Payloads carry absolute stock, so a newer event for the same product can
+    # safely replace an older one still queued for a slow client
+    items = event_items(event)
+    key = f"product:{items[0]['product_id']}" if len(items) == 1 else None
+    topics = event_topics(event)
+    if len(items) > 1 and not backplane.fits(event, topics, key):
+        # Too big for the backplane (Postgres NOTIFY): send it in halves. Every
+        # worker sequences what it receives, so the parts are ordinary events.
+        half = len(items) // 2
+        await publish(dict(event, items=items[:half]))
+        await publish(dict(event, items=items[half:]))
+        return
+    await backplane.publish(event, topics=topics, key=key)
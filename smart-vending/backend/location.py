@@ -0,0 +1,300 @@
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, object_session
+
+import models
+
+EARTH_RADIUS_KM = 6371.0
+GRID_CELL_DEG = 0.05     # ~5.5 km buckets for radius queries
+# Distance matrix rows computed per block, to bound numpy temporaries for big plans
+MATRIX_BLOCK_ROWS = 256
+# Wall-clock cap on 2-opt improvement for one route plan
+ROUTE_TIME_BUDGET = float(os.getenv("ROUTE_TIME_BUDGET", "2.0"))
+
+
+def haversine_km(lat, lon, lats, lons):
+    # Vectorized great-circle distance from one point to arrays of points (all in degrees)
+    lat1 = np.radians(lat)
+    lon1 = np.radians(lon)
+    lat2 = np.radians(lats)
+    lon2 = np.radians(lons)
+
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def distance_matrix(lats, lons):
+    # Pairwise great-circle distances (km) between points, one broadcast per block of rows
+    phi = np.radians(np.asarray(lats, dtype=np.float64))
+    lam = np.radians(np.asarray(lons, dtype=np.float64))
+    cos_phi = np.cos(phi)
+    n = len(phi)
+    matrix = np.empty((n, n), dtype=np.float64)
+    for start in range(0, n, MATRIX_BLOCK_ROWS):
+        rows = slice(start, start + MATRIX_BLOCK_ROWS)
+        a = (
+            np.sin((phi[None, :] - phi[rows, None]) / 2) ** 2
+            + cos_phi[rows, None] * cos_phi[None, :] * np.sin((lam[None, :] - lam[rows, None]) / 2) ** 2
+        )
+        matrix[rows] = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+    return matrix
+
+
+def nearest_neighbour_tour(distances, start: int = 0):
+    # Greedy tour: always drive to the closest stop not yet visited
+    n = len(distances)
+    visited = np.zeros(n, dtype=bool)
+    tour = np.empty(n, dtype=np.int64)
+    tour[0] = current = start
+    visited[start] = True
+    for step in range(1, n):
+        current = int(np.where(visited, np.inf, distances[current]).argmin())
+        tour[step] = current
+        visited[current] = True
+    return tour
+
+
+def two_opt(distances, tour, time_budget: float = ROUTE_TIME_BUDGET):
+    # Improves a closed tour by reversing segments while that shortens it. For
+    # each edge (a, b) every later edge (c, e) is scored in one vectorized pass
+    # and the best reversal is applied. tour[0] never moves, so the depot stays first.
+    n = len(tour)
+    if n < 4:
+        return tour
+    closed = np.append(tour, tour[0])
+    deadline = time.monotonic() + time_budget
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+        for i in range(n - 2):
+            a, b = closed[i], closed[i + 1]
+            c, e = closed[i + 2:n], closed[i + 3:n + 1]
+            gains = distances[a, b] + distances[c, e] - distances[a, c] - distances[b, e]
+            best = int(gains.argmax())
+            if gains[best] > 1e-9:
+                j = i + 2 + best
+                closed[i + 1:j + 1] = closed[i + 1:j + 1][::-1]
+                improved = True
+    return closed[:n]
+
+
+def plan_route(depot_lat: float, depot_lon: float, lats, lons, time_budget: float = ROUTE_TIME_BUDGET):
+    # Round trip from the depot through every stop. Returns the stop indices in
+    # visiting order, the length of the leg into each stop, and the total km
+    # including the drive back.
+    if len(lats) == 0:
+        return [], [], 0.0
+    distances = distance_matrix(np.append(depot_lat, lats), np.append(depot_lon, lons))
+    tour = two_opt(distances, nearest_neighbour_tour(distances), time_budget)
+    legs = distances[tour, np.roll(tour, -1)]
+    return [int(node) - 1 for node in tour[1:]], [float(leg) for leg in legs[:-1]], float(legs.sum())
+
+
+# In-memory index of machine coordinates. Coordinates live in contiguous numpy
+# arrays so distance queries are a single vectorized pass, and every machine is
+# also bucketed into a lat/lon grid so radius queries only look at nearby cells.
+class MachineIndex:
+    def __init__(self, cell_deg: float = GRID_CELL_DEG):
+        self.cell_deg = cell_deg
+        self.loaded = False
+        self._lock = threading.RLock()
+        self._ids = np.empty(16, dtype=np.int64)
+        self._lats = np.empty(16, dtype=np.float64)
+        self._lons = np.empty(16, dtype=np.float64)
+        self._size = 0
+        self._slots = {}               # machine id -> array slot
+        self._meta = {}                # machine id -> (name, location)
+        self._cells = defaultdict(set) # grid cell -> machine ids
+
+    def __len__(self):
+        return self._size
+
+    def _cell(self, lat: float, lon: float):
+        return (math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg))
+
+    def ensure_loaded(self, db: Session):
+        if self.loaded:
+            return
+        with self._lock:
+            if self.loaded:
+                return
+            rows = db.execute(select(
+                models.Machine.id,
+                models.Machine.name,
+                models.Machine.location,
+                models.Machine.latitude,
+                models.Machine.longitude,
+            )).all()
+            for row in rows:
+                self.upsert(*row)
+            self.loaded = True
+
+    def upsert(self, machine_id: int, name: str, location: str, latitude: float, longitude: float):
+        with self._lock:
+            self.remove(machine_id)
+            if latitude is None or longitude is None:
+                return
+
+            if self._size == len(self._ids):
+                capacity = len(self._ids) * 2
+                self._ids = np.resize(self._ids, capacity)
+                self._lats = np.resize(self._lats, capacity)
+                self._lons = np.resize(self._lons, capacity)
+
+            slot = self._size
+            self._ids[slot] = machine_id
+            self._lats[slot] = latitude
+            self._lons[slot] = longitude
+            self._size += 1
+            self._slots[machine_id] = slot
+            self._meta[machine_id] = (name, location)
+            self._cells[self._cell(latitude, longitude)].add(machine_id)
+
+    def remove(self, machine_id: int):
+        with self._lock:
+            slot = self._slots.pop(machine_id, None)
+            if slot is None:
+                return
+            cell = self._cell(self._lats[slot], self._lons[slot])
+            self._cells[cell].discard(machine_id)
+            if not self._cells[cell]:
+                del self._cells[cell]
+            self._meta.pop(machine_id, None)
+
+            # Keep the arrays dense by moving the last entry into the freed slot
+            last = self._size - 1
+            if slot != last:
+                moved_id = int(self._ids[last])
+                self._ids[slot] = moved_id
+                self._lats[slot] = self._lats[last]
+                self._lons[slot] = self._lons[last]
+                self._slots[moved_id] = slot
+            self._size = last
+
+    def describe(self, machine_id: int, distance_km: float) -> dict:
+        name, location = self._meta[machine_id]
+        slot = self._slots[machine_id]
+        return {
+            "id": machine_id,
+            "name": name,
+            "location": location,
+            "latitude": float(self._lats[slot]),
+            "longitude": float(self._lons[slot]),
+            "distance_km": round(float(distance_km), 2),
+        }
+
+    def distances_to(self, lat: float, lon: float, machine_ids):
+        # Distances to a specific set of machines, skipping ids that are not indexed
+        with self._lock:
+            ids = [m for m in machine_ids if m in self._slots]
+            slots = np.fromiter((self._slots[m] for m in ids), dtype=np.int64, count=len(ids))
+            return np.array(ids, dtype=np.int64), haversine_km(lat, lon, self._lats[slots], self._lons[slots])
+
+    def coordinates(self, machine_ids):
+        # (ids, lats, lons) of the given machines, skipping ids that are not indexed
+        with self._lock:
+            ids = [m for m in machine_ids if m in self._slots]
+            slots = np.fromiter((self._slots[m] for m in ids), dtype=np.int64, count=len(ids))
+            return ids, self._lats[slots], self._lons[slots]
+
+    def _slots_near(self, lat: float, lon: float, radius_km: float):
+        # Bounding box of the circle on the sphere; polar or antimeridian crossings
+        # fall back to the full longitude range and only the latitude band narrows it
+        angular = radius_km / EARTH_RADIUS_KM
+        dlat = math.degrees(angular)
+        full_lon = (self._cell(0.0, -180.0)[1], self._cell(0.0, 180.0)[1])
+
+        lat_lo = self._cell(max(lat - dlat, -90.0), 0.0)[0]
+        lat_hi = self._cell(min(lat + dlat, 90.0), 0.0)[0]
+        ratio = math.sin(angular) / max(math.cos(math.radians(lat)), 1e-12)
+        if angular >= math.pi / 2 or abs(lat) + dlat >= 90.0 or ratio >= 1.0:
+            lon_lo, lon_hi = full_lon
+        else:
+            dlon = math.degrees(math.asin(ratio))
+            if lon - dlon < -180.0 or lon + dlon > 180.0:
+                lon_lo, lon_hi = full_lon
+            else:
+                lon_lo = self._cell(0.0, lon - dlon)[1]
+                lon_hi = self._cell(0.0, lon + dlon)[1]
+
+        # Large radii cover more cells than are occupied, walk the occupied ones instead
+        if (lat_hi - lat_lo + 1) * (lon_hi - lon_lo + 1) > len(self._cells):
+            cells = [c for c in self._cells if lat_lo <= c[0] <= lat_hi and lon_lo <= c[1] <= lon_hi]
+        else:
+            cells = [
+                (i, j)
+                for i in range(lat_lo, lat_hi + 1)
+                for j in range(lon_lo, lon_hi + 1)
+                if (i, j) in self._cells
+            ]
+        return [self._slots[m] for cell in cells for m in self._cells[cell]]
+
+    def nearest(self, lat: float, lon: float, k: int = 1, radius_km: float = None):
+        # Returns [(machine_id, distance_km)] sorted by distance
+        with self._lock:
+            if self._size == 0 or k <= 0:
+                return []
+
+            if radius_km is not None:
+                slots = np.array(self._slots_near(lat, lon, radius_km), dtype=np.int64)
+                if len(slots) == 0:
+                    return []
+                distances = haversine_km(lat, lon, self._lats[slots], self._lons[slots])
+                keep = distances <= radius_km
+                slots, distances = slots[keep], distances[keep]
+            else:
+                slots = np.arange(self._size)
+                distances = haversine_km(lat, lon, self._lats[:self._size], self._lons[:self._size])
+
+            if len(distances) > k:
+                top = np.argpartition(distances, k - 1)[:k]
+                slots, distances = slots[top], distances[top]
+            order = np.argsort(distances, kind="stable")
+            return [(int(self._ids[slots[i]]), float(distances[i])) for i in order]
+
+
+machine_index = MachineIndex()
+
+
+# Keep the index in step with Machine writes. Changes are staged per session
+# and only applied once the transaction commits, so rollbacks never leak in.
+def _stage(target, op):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("machine_index_changes", []).append(
+            (op, target.id, target.name, target.location, target.latitude, target.longitude)
+        )
+
+
+@event.listens_for(models.Machine, "after_insert")
+@event.listens_for(models.Machine, "after_update")
+def _machine_saved(mapper, connection, target):
+    _stage(target, "upsert")
+
+
+@event.listens_for(models.Machine, "after_delete")
+def _machine_deleted(mapper, connection, target):
+    _stage(target, "remove")
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_machine_changes(session):
+    changes = session.info.pop("machine_index_changes", None)
+    if not changes or not machine_index.loaded:
+        return
+    for op, machine_id, name, location, latitude, longitude in changes:
+        if op == "upsert":
+            machine_index.upsert(machine_id, name, location, latitude, longitude)
+        else:
+            machine_index.remove(machine_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_machine_changes(session):
+    session.info.pop("machine_index_changes", None)
@@ -1,16 +1,58 @@
+import json
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Depends, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-import models, crud, schemas
-from database import engine, SessionLocal, Base
+import models, crud, schemas, search, inventory, notifications, cache, reservations, payment, webhooks, metrics
+from database import engine, async_engine, SessionLocal, Base
 from routers import user, product
 from routers import machine
 from websocket_manager import manager
+from backplane import backplane
 
 from fastapi.middleware.cors import CORSMiddleware
 
 Base.metadata.create_all(bind=engine)
+search.setup(engine)
+metrics.instrument_engine(engine)
+metrics.instrument_engine(async_engine.sync_engine)
 
-app = FastAPI()
+# Read when /metrics is scraped
+metrics.gauge("ws_connections", "Open WebSocket connections on this worker", lambda: manager.stats()["connections"])
+metrics.gauge("ws_queued_messages", "Messages waiting in all WebSocket client queues", lambda: manager.stats()["queued_messages"])
+metrics.gauge("ws_client_queue_depth_p99", "99th percentile of WebSocket client queue depth", lambda: manager.stats()["queue_depth_p99"])
+metrics.gauge("ws_client_queue_depth_max", "Deepest WebSocket client queue", lambda: manager.stats()["queue_depth_max"])
+metrics.gauge("ws_dropped_messages", "Messages dropped for slow clients still connected", lambda: manager.stats()["dropped_messages"])
+metrics.gauge("notification_queue_depth", "Push notification batches waiting to be sent", lambda: notifications.dispatcher.stats()["queued"])
+metrics.gauge("webhook_queue_depth", "Razorpay webhooks waiting to be written", lambda: webhooks.webhook_queue.stats()["queued"])
+metrics.gauge("razorpay_breaker_open", "1 while the Razorpay circuit breaker is not closed", lambda: int(payment.gateway.breaker.state != "closed"))
+
+async def deliver_event(envelope: dict):
+    # Every worker receives every published event, sequences it in its own
+    # event log and fans it out to its own sockets
+    event = inventory.record_event(envelope["event"])
+    cache.invalidate_products(item["product_id"] for item in inventory.event_items(event))
+    await manager.broadcast(json.dumps(event), topics=envelope["topics"], key=envelope.get("key"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await backplane.start(deliver_event)
+    await notifications.dispatcher.start()
+    await payment.gateway.start()
+    await reservations.sweeper.start()
+    await webhooks.webhook_queue.start()
+    metrics.profiler.start()
+    yield
+    metrics.profiler.stop()
+    await webhooks.webhook_queue.stop()
+    await reservations.sweeper.stop()
+    await payment.gateway.stop()
+    await notifications.dispatcher.stop()
+    await backplane.stop()
+    await async_engine.dispose()
+
+app = FastAPI(lifespan=lifespan)
 
 # Configure CORS
 origins = [
@@ -25,14 +67,18 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.MetricsMiddleware)
 
 app.include_router(user.router)
 app.include_router(product.router)
 app.include_router(machine.router, prefix="/machines", tags=["Machines"])
 
 
-# DB Dependency
-def get_db():
+# DB Dependency. Async so the session is opened and closed on the event loop:
+# a session keeps its pooled connection until it is closed, and a close that
+# had to wait for a threadpool thread could wait forever once every thread is
+# blocked on a checkout only that close would satisfy.
+async def get_db():
     db = SessionLocal()
     try:
         yield db
@@ -44,24 +90,65 @@ def get_db():
 def root():
     return {"message": "Smart Vending Backend Running"}
 
+@app.get("/cache/stats")
+def cache_stats():
+    return cache.catalog_cache.stats()
+
+@app.get("/payments/gateway")
+def payment_gateway_stats():
+    return payment.gateway.stats()
+
+@app.get("/payments/webhooks")
+def payment_webhook_stats():
+    return webhooks.webhook_queue.stats()
+
+# Prometheus scrape endpoint; async so the gauges read the WebSocket queues on the loop
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+# Stack profiles of recent requests slower than SLOW_REQUEST_MS (when set)
+@app.get("/metrics/slow-requests")
+def slow_requests():
+    return {"enabled": metrics.profiler.enabled, "threshold_ms": metrics.SLOW_REQUEST_MS,
+            "requests": list(metrics.profiler.recent)}
+
 # Register route
-@app.post("/register")
+@app.post("/register", response_model=schemas.UserResponse)
 def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
     return crud.create_user(db, user)
 
 # Get products route
-@app.get("/products")
+@app.get("/products", response_model=list[schemas.ProductResponse])
 def get_products(db: Session = Depends(get_db)):
     return crud.get_products(db)
 
+def load_snapshot(topics):
+    db = SessionLocal()
+    try:
+        return inventory.snapshot(db, topics)
+    finally:
+        db.close()
+
+async def resume_client(websocket: WebSocket, request: dict):
+    # {"action": "resume", "epoch": ..., "last_seq": n} -> the missed events, or
+    # a snapshot of absolute stock when the gap is no longer in the event log
+    topics = manager.topics_of(websocket)
+    message = inventory.event_log.replay(request.get("epoch"), request.get("last_seq"), topics)
+    if message is None:
+        message = await run_in_threadpool(load_snapshot, topics)
+    manager.send(websocket, json.dumps(message))
+
 # WebSocket connection endpoint
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
     try:
         while True:
-            # We don't expect the frontend to send us text data, just listen.
-            # But we must hold the connection open.
+            # Clients send topic subscription changes and resume requests
             data = await websocket.receive_text()
+            request = manager.handle_message(websocket, data)
+            if request and request.get("action") == "resume":
+                await resume_client(websocket, request)
     except WebSocketDisconnect:
         manager.disconnect(websocket)
@@ -0,0 +1,300 @@
+import contextvars
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, deque
+
+from sqlalchemy import event
+
+# Seconds; the usual Prometheus default buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+FANOUT_BUCKETS = (0, 1, 10, 100, 1000, 5000, 10000, 50000)
+SQL_KINDS = {"select", "insert", "update", "delete"}
+# Requests slower than this many milliseconds get a sampled stack profile; 0 turns the profiler off
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0"))
+SLOW_REQUEST_SAMPLE_INTERVAL = float(os.getenv("SLOW_REQUEST_SAMPLE_INTERVAL", "0.005"))
+SLOW_REQUEST_PROFILES_KEPT = 20
+PROFILE_MAX_DEPTH = 40
+PROFILE_TOP_STACKS = 15
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Just enough of the Prometheus data model for /metrics: labelled histograms
+# and counters updated from any thread, and gauges read from callbacks at
+# scrape time. Label sets are kept small (route templates, not raw paths).
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}  # name -> (help, buckets, {labels: Histogram})
+        self._counters = {}    # name -> (help, {labels: value})
+        self._gauges = {}      # name -> (help, callback returning a number)
+
+    def histogram(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self._histograms[name] = (help, buckets, {})
+
+    def counter(self, name: str, help: str):
+        self._counters[name] = (help, {})
+
+    def gauge(self, name: str, help: str, callback):
+        self._gauges[name] = (help, callback)
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        _, buckets, series = self._histograms[name]
+        with self._lock:
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        _, series = self._counters[name]
+        with self._lock:
+            series[key] = series.get(key, 0) + amount
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        lines = []
+        with self._lock:
+            for name, (help, buckets, series) in self._histograms.items():
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+                for key, histogram in series.items():
+                    cumulative = 0
+                    for bound, count in zip(buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_labels(key + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(key)} {histogram.sum}")
+                    lines.append(f"{name}_count{_labels(key)} {histogram.count}")
+            for name, (help, series) in self._counters.items():
+                lines += [f"# HELP {name} {help}", f"# TYPE {name} counter"]
+                lines += [f"{name}{_labels(key)} {value}" for key, value in series.items()]
+        for name, (help, callback) in self._gauges.items():
+            try:
+                value = callback()
+            except Exception as e:
+                print(f"Failed to read gauge {name}: {e}")
+                continue
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+def _labels(key) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in key) + "}"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+registry = Registry()
+registry.histogram("http_request_duration_seconds", "Time to serve a request, by route")
+registry.histogram("http_request_sql_statements", "SQL statements run while serving a request, by route", STATEMENT_BUCKETS)
+registry.histogram("http_request_sql_seconds", "Time spent in SQL while serving a request, by route")
+registry.counter("http_requests_total", "Requests served, by route and status")
+registry.histogram("sql_statement_seconds", "Time per SQL statement, by statement kind")
+registry.histogram("ws_broadcast_seconds", "Time to queue one broadcast for all its recipients")
+registry.histogram("ws_broadcast_recipients", "Clients a broadcast was queued for", FANOUT_BUCKETS)
+registry.histogram("outbound_request_seconds", "Calls to Razorpay and FCM, by service and outcome")
+
+
+def observe(name: str, value: float, **labels):
+    registry.observe(name, value, **labels)
+
+
+def gauge(name: str, help: str, callback):
+    registry.gauge(name, help, callback)
+
+
+# SQL done on behalf of the current request. Context variables follow the
+# request into threadpool calls and async engine greenlets, so statements are
+# counted wherever the route runs them.
+class RequestStats:
+    __slots__ = ("statements", "sql_seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.sql_seconds = 0.0
+
+
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+def instrument_engine(engine):
+    # For async engines pass engine.sync_engine
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._metrics_start
+        kind = statement.lstrip()[:6].lower()
+        registry.observe("sql_statement_seconds", elapsed, kind=kind if kind in SQL_KINDS else "other")
+        stats = current_request.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.sql_seconds += elapsed
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware: times each HTTP request up to its last body chunk
+    # (background tasks run after that and are not billed to the request) and
+    # labels it by route template, so /buy/7 and /buy/8 share a series.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        profile = profiler.begin(scope) if profiler.enabled else None
+        start = time.perf_counter()
+        status = 500
+        finished = None
+
+        async def send_wrapper(message):
+            nonlocal status, finished
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                finished = (time.perf_counter() - start, stats.statements, stats.sql_seconds)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_request.reset(token)
+            elapsed, statements, sql_seconds = finished or (time.perf_counter() - start, stats.statements, stats.sql_seconds)
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            method = scope["method"]
+            registry.observe("http_request_duration_seconds", elapsed, method=method, route=path)
+            registry.observe("http_request_sql_statements", statements, method=method, route=path)
+            registry.observe("http_request_sql_seconds", sql_seconds, method=method, route=path)
+            registry.inc("http_requests_total", method=method, route=path, status=status)
+            if profile is not None:
+                profiler.end(profile, elapsed, f"{method} {path}", statements)
+
+
+# Opt-in sampling profiler for slow requests. A background thread snapshots
+# every thread's stack each SLOW_REQUEST_SAMPLE_INTERVAL seconds while
+# requests are in flight, and files a sample under a request when its route's
+# endpoint function is on that stack: in a threadpool worker for sync routes,
+# on the event loop thread for async ones. Ticks where the endpoint is on no
+# stack are counted as waiting (awaiting I/O, or queued for a thread).
+# Concurrent requests to the same route share samples. When a request ends
+# slower than SLOW_REQUEST_MS its hottest stacks are printed and kept for
+# /metrics/slow-requests.
+class SlowRequestProfiler:
+    def __init__(self, threshold_ms: float = SLOW_REQUEST_MS, interval: float = SLOW_REQUEST_SAMPLE_INTERVAL):
+        self.enabled = threshold_ms > 0
+        self.threshold = threshold_ms / 1000
+        self.interval = interval
+        self.recent = deque(maxlen=SLOW_REQUEST_PROFILES_KEPT)
+        self._active = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.enabled and self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="slow-request-profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def begin(self, scope):
+        entry = {"scope": scope, "samples": Counter(), "waiting": 0}
+        with self._lock:
+            self._active.append(entry)
+        return entry
+
+    def end(self, entry, elapsed: float, label: str, statements: int):
+        with self._lock:
+            self._active.remove(entry)
+        if elapsed < self.threshold:
+            return
+
+        sampled = sum(entry["samples"].values())
+        profile = {
+            "route": label,
+            "duration_ms": round(elapsed * 1000, 1),
+            "sql_statements": statements,
+            "samples": sampled,
+            "waiting_samples": entry["waiting"],
+            "stacks": [
+                {"stack": stack, "count": count}
+                for stack, count in entry["samples"].most_common(PROFILE_TOP_STACKS)
+            ],
+        }
+        self.recent.append(profile)
+        print(f"Slow request {label}: {profile['duration_ms']} ms, {statements} SQL statements, "
+              f"{sampled} samples running / {entry['waiting']} waiting")
+        for stack in profile["stacks"][:5]:
+            print(f"  {stack['count']:>5}  {stack['stack']}")
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                entries = list(self._active)
+            if not entries:
+                continue
+
+            stacks = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                frames = []  # innermost first
+                while frame is not None:
+                    frames.append(frame)
+                    frame = frame.f_back
+                stacks.append(frames)
+
+            for entry in entries:
+                code = getattr(entry["scope"].get("endpoint"), "__code__", None)
+                hit = False
+                for frames in stacks:
+                    for depth, frame in enumerate(frames):
+                        if frame.f_code is code:
+                            entry["samples"][_collapse(frames[:depth + 1])] += 1
+                            hit = True
+                            break
+                if not hit:
+                    entry["waiting"] += 1
+
+
+def _collapse(frames) -> str:
+    # Endpoint first, flamegraph "collapsed" style, keeping the innermost frames of deep stacks
+    return ";".join(
+        f"{f.f_code.co_name} ({os.path.basename(f.f_code.co_filename)}:{f.f_lineno})"
+        for f in reversed(frames[:PROFILE_MAX_DEPTH])
+    )
+
+
+profiler = SlowRequestProfiler()
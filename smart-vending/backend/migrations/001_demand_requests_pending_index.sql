@@ -0,0 +1,6 @@
+-- create_all() only creates missing tables, so indexes added to existing
+-- tables have to be applied by hand on databases created before them.
+
+-- Restock fulfils pending demands by machine and case-insensitive product name
+CREATE INDEX IF NOT EXISTS ix_demand_requests_pending
+    ON demand_requests (machine_id, lower(product_name), is_fulfilled);
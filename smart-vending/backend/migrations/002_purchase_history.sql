@@ -0,0 +1,12 @@
+-- Purchase history pages walk a user's completed transactions newest first by id
+CREATE INDEX IF NOT EXISTS ix_transactions_user_history
+    ON transactions (user_id, payment_status, id);
+
+-- create_all() creates user_purchase_totals itself; seed it from the
+-- existing history so summaries match before the next purchase
+INSERT INTO user_purchase_totals (user_id, total_spent, purchase_count)
+SELECT user_id, SUM(amount), COUNT(id)
+FROM transactions
+WHERE payment_status = 'Completed' AND user_id IS NOT NULL
+GROUP BY user_id
+ON CONFLICT (user_id) DO NOTHING;
@@ -0,0 +1,2 @@
+-- Per-machine inventory reads filter products by machine
+CREATE INDEX IF NOT EXISTS ix_products_machine_id ON products (machine_id);
@@ -0,0 +1,12 @@
+-- Offline sales replayed by machine hardware carry a client-generated key
+ALTER TABLE transactions ADD COLUMN idempotency_key VARCHAR(100);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_transactions_idempotency_key ON transactions (idempotency_key);
+
+-- When the sale happened (for replayed offline sales, when the machine made it).
+-- Nothing recorded that for existing rows, so they stay NULL rather than all
+-- getting the migration time; /sales/rebuild leaves them out of the buckets
+-- and reports how many it skipped. The app sets created_at on every new sale;
+-- the default only covers rows inserted by hand (Postgres; SQLite cannot
+-- alter a column default, so skip that statement there).
+ALTER TABLE transactions ADD COLUMN created_at TIMESTAMP;
+ALTER TABLE transactions ALTER COLUMN created_at SET DEFAULT CURRENT_TIMESTAMP;
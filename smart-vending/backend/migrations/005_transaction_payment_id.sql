@@ -0,0 +1,3 @@
+-- Razorpay payment behind each app purchase; unique so a retried /buy can't charge stock twice
+ALTER TABLE transactions ADD COLUMN payment_id VARCHAR(100);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_transactions_payment_id ON transactions (payment_id);
@@ -0,0 +1,8 @@
+-- create_all() creates demand_rollups itself; seed it from the demands
+-- still pending so the top-demand endpoint is right from the start
+INSERT INTO demand_rollups (machine_id, name_key, product_name, pending, updated_at)
+SELECT machine_id, lower(product_name), MIN(product_name), COUNT(id), CURRENT_TIMESTAMP
+FROM demand_requests
+WHERE is_fulfilled = 0 AND machine_id IS NOT NULL AND product_name IS NOT NULL
+GROUP BY machine_id, lower(product_name)
+ON CONFLICT (machine_id, name_key) DO NOTHING;
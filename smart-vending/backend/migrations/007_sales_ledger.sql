@@ -0,0 +1,10 @@
+-- Every sale records the machine it happened at. create_all() creates
+-- sales_buckets itself, and reservations (new in this release) already
+-- come with their machine_id column.
+ALTER TABLE transactions ADD COLUMN machine_id INTEGER REFERENCES machines (id);
+
+-- Backfill existing sales from their product; afterwards fill the buckets
+-- with POST /sales/rebuild
+UPDATE transactions
+SET machine_id = (SELECT products.machine_id FROM products WHERE products.id = transactions.product_id)
+WHERE machine_id IS NULL;
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, TIMESTAMP
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Index, Text, TIMESTAMP
 from sqlalchemy.sql import func
 from database import Base
 
@@ -26,7 +26,7 @@ class Product(Base):
     __tablename__ = "products"
 
     id = Column(Integer, primary_key=True, index=True)
-    machine_id = Column(Integer, ForeignKey("machines.id"))
+    machine_id = Column(Integer, ForeignKey("machines.id"), index=True)
     name = Column(String(100))
     price = Column(Float)
     stock = Column(Integer)
@@ -40,6 +40,45 @@ class Transaction(Base):
     product_id = Column(Integer, ForeignKey("products.id"))
     amount = Column(Float)
     payment_status = Column(String(50))
+    # Client-generated key for sales replayed by machine hardware, so a resent batch is not counted twice
+    idempotency_key = Column(String(100), unique=True, index=True, nullable=True)
+    created_at = Column(TIMESTAMP, server_default=func.now())
+    # Razorpay payment behind an app purchase; unique so a retried /buy can't charge stock twice
+    payment_id = Column(String(100), unique=True, index=True, nullable=True)
+    # Where the sale happened, copied from the product at sale time
+    machine_id = Column(Integer, ForeignKey("machines.id"), nullable=True)
+
+    __table_args__ = (
+        # Purchase history pages walk a user's completed transactions newest first by id
+        Index("ix_transactions_user_history", user_id, payment_status, id),
+    )
+
+# Completed sales per machine and product in hourly and daily buckets (UTC),
+# bumped in the same transaction as every sale and payment status change, so
+# sales-over-time reads never touch transactions
+class SalesBucket(Base):
+    __tablename__ = "sales_buckets"
+
+    granularity = Column(String(10), primary_key=True)  # hour | day
+    bucket_start = Column(TIMESTAMP, primary_key=True)
+    machine_id = Column(Integer, ForeignKey("machines.id"), primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id"), primary_key=True)
+    units = Column(Integer, default=0)
+    revenue = Column(Float, default=0)
+
+    __table_args__ = (
+        Index("ix_sales_buckets_machine", granularity, machine_id, bucket_start),
+        Index("ix_sales_buckets_product", granularity, product_id, bucket_start),
+    )
+
+# Running totals of a user's completed purchases, bumped in the same
+# transaction as each purchase so the profile summary is a primary key lookup
+class UserPurchaseTotal(Base):
+    __tablename__ = "user_purchase_totals"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    total_spent = Column(Float, default=0)
+    purchase_count = Column(Integer, default=0)
 
 class DemandRequest(Base):
     __tablename__ = "demand_requests"
@@ -49,4 +88,70 @@ class DemandRequest(Base):
     machine_id = Column(Integer, ForeignKey("machines.id"))
     product_name = Column(String(100))
     is_fulfilled = Column(Integer, default=0) # 0 for pending, 1 for fulfilled
-    requested_at = Column(TIMESTAMP, server_default=func.now())
\ No newline at end of file
+    requested_at = Column(TIMESTAMP, server_default=func.now())
+
+    __table_args__ = (
+        # Restock looks up pending demands by machine and case-insensitive product name
+        Index("ix_demand_requests_pending", machine_id, func.lower(product_name), is_fulfilled),
+    )
+
+# Pending demand per machine and product name, kept in step with
+# demand_requests: +1 when a user asks for something they weren't already
+# waiting on, -n when a restock fulfils n of them. name_key is the lowercased
+# name restocks match demands on. Rebuildable with crud.rebuild_demand_rollups.
+class DemandRollup(Base):
+    __tablename__ = "demand_rollups"
+
+    machine_id = Column(Integer, ForeignKey("machines.id"), primary_key=True)
+    name_key = Column(String(100), primary_key=True)
+    product_name = Column(String(100))
+    pending = Column(Integer, default=0)
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        # Top-N reads walk these in order and stop after N rows
+        Index("ix_demand_rollups_top", pending.desc(), machine_id, name_key),
+        Index("ix_demand_rollups_machine_top", machine_id, pending.desc(), name_key),
+    )
+
+# A unit of stock held for a checkout between /create-order and /buy. The
+# unit leaves products.stock when the reservation is made, so stock always
+# means "available to new buyers"; expired holds are put back by the sweeper.
+class Reservation(Base):
+    __tablename__ = "reservations"
+
+    id = Column(Integer, primary_key=True, index=True)
+    product_id = Column(Integer, ForeignKey("products.id"))
+    order_id = Column(String(100), unique=True, index=True, nullable=True)
+    # What the buyer was quoted, so /buy never has to read the product again
+    product_name = Column(String(100))
+    price = Column(Float)
+    machine_id = Column(Integer, ForeignKey("machines.id"), nullable=True)
+    status = Column(String(20), default="held")  # held | sold | expired
+    expires_at = Column(TIMESTAMP)
+    created_at = Column(TIMESTAMP, server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_reservations_status_expires", status, expires_at),
+    )
+
+# Journal of Razorpay webhook deliveries. event_id is unique, so a delivery
+# the gateway retries is recorded (and applied) once. An event that arrives
+# before the purchase it settles waits in the journal and is applied by a
+# later batch once the transaction exists.
+class WebhookEvent(Base):
+    __tablename__ = "webhook_events"
+
+    id = Column(Integer, primary_key=True, index=True)
+    event_id = Column(String(100), unique=True, index=True)
+    event = Column(String(50))
+    payment_id = Column(String(100), index=True, nullable=True)
+    # Transaction status the event sets, if it settles a payment
+    status = Column(String(20), nullable=True)
+    payload = Column(Text)
+    applied = Column(Integer, default=0) # 0 waiting for its transaction | 1 applied | 2 nothing to apply
+    received_at = Column(TIMESTAMP, server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_webhook_events_applied_received", applied, received_at),
+    )
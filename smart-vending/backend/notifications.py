@@ -1,35 +1,172 @@
+import asyncio
+import json
 import os
+import random
+import time
 from dotenv import load_dotenv
-import requests
+import httpx
+
+import metrics
 
 load_dotenv()
 
-# We can use Firebase Admin SDK or direct HTTP v1 API. 
+# We can use Firebase Admin SDK or direct HTTP v1 API.
 # Here we provide a mock/HTTP based implementation for simplicity in phase 1.
 
 FCM_SERVER_KEY = os.getenv("FCM_SERVER_KEY", "your_api_key_here")
+FCM_URL = os.getenv("FCM_URL", "https://fcm.googleapis.com/fcm/send")
+FCM_TIMEOUT = float(os.getenv("FCM_TIMEOUT", "5"))
+FCM_MAX_RETRIES = int(os.getenv("FCM_MAX_RETRIES", "3"))
+FCM_BACKOFF = float(os.getenv("FCM_BACKOFF", "0.5"))
+FCM_MAX_CONNECTIONS = int(os.getenv("FCM_MAX_CONNECTIONS", "20"))
+NOTIFICATION_QUEUE_SIZE = int(os.getenv("NOTIFICATION_QUEUE_SIZE", "10000"))
 
-def send_push_notification(device_token: str, title: str, body: str, data: dict = None):
-    url = "https://fcm.googleapis.com/fcm/send"
-    
-    headers = {
-        "Authorization": f"key={FCM_SERVER_KEY}",
-        "Content-Type": "application/json"
-    }
-    
-    payload = {
-        "to": device_token,
-        "notification": {
-            "title": title,
-            "body": body
-        },
-        "data": data or {}
-    }
-    
-    try:
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"Failed to send push notification: {e}")
+# The legacy endpoint accepts at most this many registration_ids per request
+FCM_MULTICAST_LIMIT = 1000
+# Queued notifications the worker picks up in one go before sending
+DISPATCH_BATCH = 500
+
+
+# Purchase and restock handlers only enqueue; a background worker groups
+# identical messages into multicast requests and sends them over one pooled
+# keep-alive client, retrying transient failures with exponential backoff.
+class NotificationDispatcher:
+    def __init__(self, url: str = FCM_URL, transport: httpx.AsyncBaseTransport = None):
+        self.url = url
+        self.transport = transport
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self._queue = None
+        self._loop = None
+        self._client = None
+        self._worker = None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=NOTIFICATION_QUEUE_SIZE)
+        self._client = httpx.AsyncClient(
+            transport=self.transport,
+            timeout=FCM_TIMEOUT,
+            limits=httpx.Limits(max_connections=FCM_MAX_CONNECTIONS, max_keepalive_connections=FCM_MAX_CONNECTIONS),
+            headers={"Authorization": f"key={FCM_SERVER_KEY}"},
+        )
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self, drain_timeout: float = 5.0):
+        if self._worker is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"Notification queue did not drain within {drain_timeout}s, dropping what is left")
+        self._worker.cancel()
+        await self._client.aclose()
+        self._worker = None
+        self._loop = None
+
+    def notify(self, tokens, title: str, body: str, data: dict = None):
+        # Safe to call from the event loop or from a threadpool route; never blocks
+        tokens = tuple(t for t in tokens if t)
+        if not tokens:
+            return
+        if self._loop is None:
+            print("Notification dispatcher is not running, dropping notification")
+            self.dropped += len(tokens)
+            return
+
+        item = (tokens, title, body, data or {})
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._put(item)
+        else:
+            self._loop.call_soon_threadsafe(self._put, item)
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            print("Notification queue full, dropping notification")
+            self.dropped += len(item[0])
+
+    async def _run(self):
+        while True:
+            items = [await self._queue.get()]
+            while len(items) < DISPATCH_BATCH and not self._queue.empty():
+                items.append(self._queue.get_nowait())
+
+            # Same title/body/data -> one multicast request per 1000 tokens
+            groups = {}
+            for tokens, title, body, data in items:
+                key = (title, body, json.dumps(data, sort_keys=True))
+                groups.setdefault(key, {}).update(dict.fromkeys(tokens))
+
+            sends = []
+            for (title, body, data), tokens in groups.items():
+                tokens = list(tokens)
+                for i in range(0, len(tokens), FCM_MULTICAST_LIMIT):
+                    sends.append(self._send(tokens[i:i + FCM_MULTICAST_LIMIT], title, body, json.loads(data)))
+            results = await asyncio.gather(*sends, return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    print(f"Failed to send push notification: {result!r}")
+            for _ in items:
+                self._queue.task_done()
+
+    async def _send(self, tokens, title: str, body: str, data: dict):
+        payload = {
+            "registration_ids": tokens,
+            "notification": {
+                "title": title,
+                "body": body
+            },
+            "data": data
+        }
+
+        for attempt in range(FCM_MAX_RETRIES + 1):
+            retry_after = None
+            start = time.perf_counter()
+            try:
+                response = await self._client.post(self.url, json=payload)
+                metrics.observe("outbound_request_seconds", time.perf_counter() - start,
+                                service="fcm", outcome=f"{response.status_code // 100}xx")
+                if response.status_code < 400:
+                    self.sent += len(tokens)
+                    return response.json()
+                if response.status_code != 429 and response.status_code < 500:
+                    # Bad key or malformed request, retrying won't help
+                    print(f"Failed to send push notification: HTTP {response.status_code}")
+                    break
+                retry_after = response.headers.get("Retry-After")
+            except httpx.HTTPError as e:
+                metrics.observe("outbound_request_seconds", time.perf_counter() - start, service="fcm", outcome="error")
+                print(f"Failed to send push notification: {e}")
+
+            if attempt < FCM_MAX_RETRIES:
+                delay = float(retry_after) if retry_after and retry_after.isdigit() else FCM_BACKOFF * 2 ** attempt
+                await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+
+        self.failed += len(tokens)
         return None
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
+
+
+dispatcher = NotificationDispatcher()
+
+
+def send_push_notification(device_token: str, title: str, body: str, data: dict = None):
+    dispatcher.notify([device_token], title, body, data)
+
+
+def send_multicast(device_tokens, title: str, body: str, data: dict = None):
+    dispatcher.notify(device_tokens, title, body, data)
@@ -1,43 +1,195 @@
-import razorpay
+import asyncio
+import hashlib
+import hmac
 import os
 import time
+import uuid
 from dotenv import load_dotenv
+import httpx
+
+import metrics
 
 load_dotenv()
 
 RAZORPAY_KEY_ID = os.getenv("RAZORPAY_KEY_ID", "test_key_id")
 RAZORPAY_KEY_SECRET = os.getenv("RAZORPAY_KEY_SECRET", "test_key_secret")
+# Set on the dashboard per webhook; separate from the API key secret
+RAZORPAY_WEBHOOK_SECRET = os.getenv("RAZORPAY_WEBHOOK_SECRET", "")
+RAZORPAY_API_URL = os.getenv("RAZORPAY_API_URL", "https://api.razorpay.com/v1")
+RAZORPAY_TIMEOUT = float(os.getenv("RAZORPAY_TIMEOUT", "5"))
+RAZORPAY_CONNECT_TIMEOUT = float(os.getenv("RAZORPAY_CONNECT_TIMEOUT", "2"))
+RAZORPAY_MAX_CONNECTIONS = int(os.getenv("RAZORPAY_MAX_CONNECTIONS", "20"))
+# Consecutive gateway failures that open the breaker, and how long it stays open
+RAZORPAY_BREAKER_FAILURES = int(os.getenv("RAZORPAY_BREAKER_FAILURES", "5"))
+RAZORPAY_BREAKER_RESET = float(os.getenv("RAZORPAY_BREAKER_RESET", "30"))
 
-razorpay_client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET))
+# With the dummy test keys (and no gateway URL of our own) orders are faked
+# and every signature passes, so the demo checkout works offline
+DEMO_MODE = RAZORPAY_KEY_ID == "test_key_id" and "RAZORPAY_API_URL" not in os.environ
 
-def create_razorpay_order(amount: float):
-    # If using test dummy keys for a DEMO, intercept the real API call to prevent a 500 Auth exception
-    if RAZORPAY_KEY_ID == "test_key_id":
-        return {
-            "id": f"order_DEMO_{int(time.time())}",
-            "amount": int(amount * 100),
+
+class GatewayError(Exception):
+    pass
+
+
+class GatewayUnavailable(GatewayError):
+    # Raised without calling Razorpay while the breaker is open
+    pass
+
+
+class CircuitBreaker:
+    # closed: calls go through. After `failures` consecutive failures it opens
+    # and every call fails fast for `reset_timeout` seconds; then a single trial
+    # call is let through (half-open) and its outcome closes or reopens it.
+    def __init__(self, failures: int = RAZORPAY_BREAKER_FAILURES, reset_timeout: float = RAZORPAY_BREAKER_RESET):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_started = None
+        self.rejected = 0
+        self.opened = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def before_call(self):
+        state = self.state
+        now = time.monotonic()
+        # A trial that never reported back (e.g. its request was cancelled) doesn't block forever
+        trial_running = self.trial_started is not None and now - self.trial_started < self.reset_timeout
+        if state == "open" or (state == "half_open" and trial_running):
+            self.rejected += 1
+            raise GatewayUnavailable("Payment gateway is unavailable, try again shortly")
+        if state == "half_open":
+            self.trial_started = now
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_started = None
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        trial_failed = self.trial_started is not None
+        if trial_failed or self.consecutive_failures >= self.failures:
+            if self.opened_at is None or trial_failed:
+                self.opened += 1
+            self.opened_at = time.monotonic()
+        self.trial_started = None
+
+
+class RazorpayGateway:
+    # One pooled keep-alive client for all order calls, with explicit timeouts
+    # so a slow gateway costs a request at most `timeout` seconds
+    def __init__(self, url: str = RAZORPAY_API_URL, key_id: str = RAZORPAY_KEY_ID, key_secret: str = RAZORPAY_KEY_SECRET,
+                 demo: bool = DEMO_MODE, timeout: float = RAZORPAY_TIMEOUT, transport: httpx.AsyncBaseTransport = None,
+                 webhook_secret: str = RAZORPAY_WEBHOOK_SECRET):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.key_id = key_id
+        self.key_secret = key_secret
+        self.webhook_secret = webhook_secret
+        self.demo = demo
+        self.transport = transport
+        self.breaker = CircuitBreaker()
+        self._client = None
+
+    async def start(self):
+        self._client = httpx.AsyncClient(
+            transport=self.transport,
+            auth=(self.key_id, self.key_secret),
+            timeout=httpx.Timeout(self.timeout, connect=RAZORPAY_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=RAZORPAY_MAX_CONNECTIONS, max_keepalive_connections=RAZORPAY_MAX_CONNECTIONS),
+        )
+
+    async def stop(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def create_order(self, amount: float, receipt: str = None) -> dict:
+        if self.demo:
+            return {
+                "id": f"order_DEMO_{uuid.uuid4().hex[:14]}",
+                "amount": int(amount * 100),
+                "currency": "INR",
+                "status": "created"
+            }
+
+        data = {
+            "amount": int(amount * 100),  # Razorpay expects amount in paise
             "currency": "INR",
-            "status": "created"
+            "payment_capture": 1
         }
+        if receipt:
+            data["receipt"] = receipt
+
+        self.breaker.before_call()
+        start = time.perf_counter()
+        try:
+            # httpx timeouts are per phase (a trickling response keeps resetting
+            # the read timeout), so the whole call also gets a hard deadline
+            async with asyncio.timeout(self.timeout + RAZORPAY_CONNECT_TIMEOUT):
+                response = await self._client.post(f"{self.url}/orders", json=data)
+        except (httpx.HTTPError, TimeoutError) as e:
+            metrics.observe("outbound_request_seconds", time.perf_counter() - start, service="razorpay", outcome="error")
+            self.breaker.record_failure()
+            raise GatewayError(f"Razorpay order request failed: {e!r}") from e
+        metrics.observe("outbound_request_seconds", time.perf_counter() - start,
+                        service="razorpay", outcome=f"{response.status_code // 100}xx")
+
+        if response.status_code == 429 or response.status_code >= 500:
+            self.breaker.record_failure()
+            raise GatewayError(f"Razorpay order request failed: HTTP {response.status_code}")
+        # The gateway answered; a 4xx is our request's fault, not its health
+        self.breaker.record_success()
+        if response.status_code >= 400:
+            raise GatewayError(f"Razorpay rejected the order: HTTP {response.status_code} {response.text}")
+        return response.json()
+
+    def verify_payment(self, order_id: str, payment_id: str, signature: str) -> bool:
+        # Checkout signs "order_id|payment_id" with our key secret; pure CPU, no network
+        if self.demo:
+            return True
+        expected = hmac.new(
+            self.key_secret.encode(), f"{order_id}|{payment_id}".encode(), hashlib.sha256
+        ).hexdigest()
+        return hmac.compare_digest(expected, signature or "")
+
+    def verify_webhook(self, body: bytes, signature: str) -> bool:
+        # Webhooks sign the raw request body with the webhook secret. Without a
+        # secret only the demo setup accepts them.
+        if not self.webhook_secret:
+            return self.demo
+        expected = hmac.new(self.webhook_secret.encode(), body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature or "")
+
+    def stats(self) -> dict:
+        return {
+            "demo": self.demo,
+            "breaker": self.breaker.state,
+            "consecutive_failures": self.breaker.consecutive_failures,
+            "times_opened": self.breaker.opened,
+            "rejected_while_open": self.breaker.rejected,
+        }
+
+
+gateway = RazorpayGateway()
+
+
+async def create_razorpay_order(amount: float, receipt: str = None):
+    return await gateway.create_order(amount, receipt)
 
-    data = {
-        "amount": int(amount * 100),  # Razorpay expects amount in paise
-        "currency": "INR",
-        "payment_capture": "1"
-    }
-    return razorpay_client.order.create(data=data)
 
 def verify_razorpay_payment(order_id: str, payment_id: str, signature: str):
-    # Mock verification for DEMO keys
-    if RAZORPAY_KEY_ID == "test_key_id":
-        return True
-        
-    try:
-        razorpay_client.utility.verify_payment_signature({
-            'razorpay_order_id': order_id,
-            'razorpay_payment_id': payment_id,
-            'razorpay_signature': signature
-        })
-        return True
-    except razorpay.errors.SignatureVerificationError:
-        return False
+    return gateway.verify_payment(order_id, payment_id, signature)
+
+
+def verify_razorpay_webhook(body: bytes, signature: str):
+    return gateway.verify_webhook(body, signature)
@@ -0,0 +1,124 @@
+import asyncio
+import heapq
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import crud
+import inventory
+from database import SessionLocal
+
+# How long a unit stays held for a checkout before it goes back on sale
+RESERVATION_TTL = float(os.getenv("RESERVATION_TTL", "300"))
+RELEASE_RETRY_DELAY = 5.0
+
+
+def expiry_time(ttl: float = RESERVATION_TTL):
+    # (unix timestamp for the heap, naive UTC datetime for the database)
+    expires = time.time() + ttl
+    return expires, datetime.fromtimestamp(expires, timezone.utc).replace(tzinfo=None)
+
+
+# Min-heap of (expires_at, reservation id). The sweeper sleeps until the
+# earliest expiry, releases everything due in one statement and tells the
+# dashboards. Releasing only touches reservations still "held", so a hold
+# that was paid for meanwhile, or already released by another worker, is
+# skipped.
+class ReservationSweeper:
+    def __init__(self):
+        self._heap = []
+        self._lock = threading.Lock()
+        self._task = None
+        self._wakeup = None
+        self._loop = None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        # Holds left behind by a restart or a crashed worker still expire
+        for reservation_id, expires_at in await asyncio.to_thread(self._load):
+            self.track(reservation_id, expires_at.replace(tzinfo=timezone.utc).timestamp())
+        self._spawn()
+
+    def _spawn(self):
+        self._task = asyncio.create_task(self._run())
+        self._task.add_done_callback(self._on_done)
+
+    def _on_done(self, task):
+        # _run only ends by being cancelled; anything else is a bug that must not
+        # leave holds unexpired until the next restart, so say so and carry on
+        if task.cancelled() or task is not self._task:
+            return
+        print(f"Reservation sweeper died, restarting it: {task.exception()!r}")
+        task.get_loop().call_later(RELEASE_RETRY_DELAY, self._restart, task)
+
+    def _restart(self, dead):
+        if self._task is dead:  # not stopped meanwhile
+            self._spawn()
+
+    async def stop(self):
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+        self._loop = None
+
+    def track(self, reservation_id: int, expires_at: float):
+        # Safe to call from threadpool routes
+        with self._lock:
+            earliest = self._heap[0][0] if self._heap else None
+            heapq.heappush(self._heap, (expires_at, reservation_id))
+        if self._loop is not None and (earliest is None or expires_at < earliest):
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _due(self, now: float):
+        with self._lock:
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap)[1])
+            next_expiry = self._heap[0][0] if self._heap else None
+        return due, next_expiry
+
+    async def _run(self):
+        while True:
+            due, next_expiry = self._due(time.time())
+            if due:
+                try:
+                    products = await asyncio.to_thread(self._release, due)
+                except Exception as e:
+                    print(f"Failed to release expired reservations, retrying shortly: {e}")
+                    for reservation_id in due:
+                        self.track(reservation_id, time.time() + RELEASE_RETRY_DELAY)
+                    products = []
+                try:
+                    for event in inventory.machine_stock_events("inventory_released", products):
+                        await inventory.publish(event)
+                except Exception as e:
+                    # The units are back on sale either way; dashboards catch up on their next change
+                    print(f"Failed to publish released reservations: {e}")
+                continue
+
+            # Sleep until the earliest expiry, or until track() adds an earlier one
+            self._wakeup.clear()
+            timeout = max(next_expiry - time.time(), 0) if next_expiry is not None else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _load(self):
+        db = SessionLocal()
+        try:
+            return crud.held_reservations(db)
+        finally:
+            db.close()
+
+    def _release(self, reservation_ids):
+        db = SessionLocal()
+        try:
+            return crud.release_reservations(db, reservation_ids)
+        finally:
+            db.close()
+
+
+sweeper = ReservationSweeper()
@@ -1,70 +1,169 @@
-from fastapi import APIRouter, Depends
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from database import SessionLocal
-import models
-import math
+from database import SessionLocal, get_async_db
 import crud
-import json
-from websocket_manager import manager
+import inventory
+import schemas
+from location import machine_index, plan_route
 
 router = APIRouter()
 
-def get_db():
+async def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
 
-def calculate_distance(lat1, lon1, lat2, lon2):
-    R = 6371  # Radius of Earth in KM
-
-    lat1 = math.radians(lat1)
-    lon1 = math.radians(lon1)
-    lat2 = math.radians(lat2)
-    lon2 = math.radians(lon2)
-
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-
-    a = math.sin(dlat / 2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-
-    return R * c
-
-@router.get("/")
+@router.get("/", response_model=list[schemas.MachineResponse])
 def get_all_machines(db: Session = Depends(get_db)):
-    import crud
     return crud.get_machines(db)
 
-@router.post("/nearest-machine")
-def find_nearest(user_lat: float, user_lon: float, db: Session = Depends(get_db)):
-    machines = db.query(models.Machine).all()
+@router.get("/{machine_id}/products", response_model=schemas.MachineInventoryResponse)
+def get_machine_products(
+    machine_id: int,
+    request: Request,
+    response: Response,
+    since: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    # Unknown machines never changed either, so check before answering 304
+    if not crud.machine_exists(db, machine_id):
+        raise HTTPException(status_code=404, detail="Machine not found")
+
+    # The version is read before querying, so a change racing this request
+    # shows up again in the client's next delta rather than being lost
+    version = inventory.event_log.machine_version(machine_id)
+    etag = f'"{version}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if request.headers.get("if-none-match") == etag or since == version:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+
+    changed = inventory.event_log.changed_since(since, machine_id) if since else None
+    if changed is not None:
+        products = crud.get_machine_products(db, machine_id, changed) if changed else []
+        return {"version": version, "full": False, "products": products}
+
+    products = crud.get_machine_products(db, machine_id)
+    return {"version": version, "full": True, "products": products}
 
-    nearest = None
-    min_distance = float("inf")
+@router.post("/nearest-machine")
+def find_nearest(
+    user_lat: float,
+    user_lon: float,
+    k: int = Query(1, ge=1, le=100),
+    radius_km: Optional[float] = Query(None, gt=0),
+    db: Session = Depends(get_db),
+):
+    machine_index.ensure_loaded(db)
+    hits = machine_index.nearest(user_lat, user_lon, k=k, radius_km=radius_km)
+
+    if not hits:
+        return {"error": "No machines found"}
 
-    for machine in machines:
-        distance = calculate_distance(user_lat, user_lon, machine.latitude, machine.longitude)
+    machines = [machine_index.describe(machine_id, distance) for machine_id, distance in hits]
+    nearest = machines[0]
 
-        if distance < min_distance:
-            min_distance = distance
-            nearest = machine
+    return {
+        "nearest_machine": nearest["name"],
+        "location": nearest["location"],
+        "distance_km": nearest["distance_km"],
+        "machines": machines
+    }
 
-    if not nearest:
-        return {"error": "No machines found"}
+@router.get("/nearest-with-product")
+def find_nearest_with_product(
+    name: str,
+    user_lat: float,
+    user_lon: float,
+    limit: int = Query(5, ge=1, le=50),
+    db: Session = Depends(get_db),
+):
+    # Only machines that stock a matching item get a distance computed
+    inventory.stock_index.ensure_loaded(db)
+    machine_index.ensure_loaded(db)
+
+    products_by_machine = {}
+    for product_id, machine_id, product_name, price, stock in inventory.stock_index.find(name):
+        products_by_machine.setdefault(machine_id, []).append({
+            "id": product_id,
+            "name": product_name,
+            "price": price,
+            "stock": stock
+        })
+
+    if not products_by_machine:
+        return []
+
+    machine_ids, distances = machine_index.distances_to(user_lat, user_lon, products_by_machine)
+    results = []
+    for i in distances.argsort(kind="stable")[:limit]:
+        machine_id = int(machine_ids[i])
+        result = machine_index.describe(machine_id, distances[i])
+        result["products"] = products_by_machine[machine_id]
+        results.append(result)
+    return results
+
+@router.get("/restock-plan")
+def restock_plan(
+    depot_lat: float,
+    depot_lon: float,
+    threshold: int = Query(inventory.LOW_STOCK_THRESHOLD, ge=1, le=inventory.LOW_STOCK_MAX_THRESHOLD),
+    max_stops: int = Query(50, ge=1, le=2000),
+    demand_weight: float = Query(1.0, ge=0),
+    db: Session = Depends(get_db),
+):
+    # Machines with products below `threshold` or users waiting on something,
+    # the most urgent `max_stops` of them, in a short round trip from the depot
+    inventory.low_stock.ensure_loaded(db)
+    machine_index.ensure_loaded(db)
+    low = inventory.low_stock.low(threshold)
+    demand = crud.pending_demand_by_machine(db)
+
+    # Units short of the threshold, plus waiting users scaled by demand_weight
+    priority = {
+        machine_id: sum(threshold - stock for _, _, stock in products)
+        for machine_id, products in low.items()
+    }
+    for machine_id, pending in demand.items():
+        priority[machine_id] = priority.get(machine_id, 0) + demand_weight * pending
+    ids = sorted((m for m, p in priority.items() if p > 0), key=lambda m: (-priority[m], m))
+    needing_restock = len(ids)
+
+    ids, lats, lons = machine_index.coordinates(ids)
+    ids, lats, lons = ids[:max_stops], lats[:max_stops], lons[:max_stops]
+    order, legs, total_km = plan_route(depot_lat, depot_lon, lats, lons)
+
+    stops = []
+    for stop, (i, leg) in enumerate(zip(order, legs), start=1):
+        machine_id = ids[i]
+        result = machine_index.describe(machine_id, leg)
+        result["leg_km"] = result.pop("distance_km")
+        result["stop"] = stop
+        result["priority"] = round(float(priority[machine_id]), 2)
+        result["pending_demand"] = int(demand.get(machine_id, 0))
+        result["low_stock"] = [
+            {"id": product_id, "name": name, "stock": stock}
+            for product_id, name, stock in sorted(low.get(machine_id, ()), key=lambda p: p[2])
+        ]
+        stops.append(result)
 
     return {
-        "nearest_machine": nearest.name,
-        "location": nearest.location,
-        "distance_km": round(min_distance, 2)
+        "threshold": threshold,
+        "machines_needing_restock": needing_restock,
+        "total_km": round(total_km, 2),
+        "stops": stops,
     }
 
 @router.post("/sync-offline-sales")
-async def sync_offline_sales(product_id: int, db: Session = Depends(get_db)):
+async def sync_offline_sales(product_id: int, db: AsyncSession = Depends(get_async_db)):
     # This endpoint acts as the physical Vending Machine Hardware Hook.
     # In real life, the UPI software on the machine calls this when a physical user pays.
-    result = crud.buy_product(db, product_id)
+    result = await crud.record_offline_sale(db, product_id)
     
     if result is None:
         return {"error": "Product not found"}
@@ -72,11 +171,23 @@ async def sync_offline_sales(product_id: int, db: Session = Depends(get_db)):
         return {"error": "Out of stock physically"}
         
     # Instantly blast to all open React Dashboards that a physical sale occurred!
-    await manager.broadcast(json.dumps({
-        "action": "inventory_deducted",
-        "product_id": product_id,
-        "machine_id": result.machine_id if hasattr(result, 'machine_id') else None,
-        "source": "offline_hardware"
-    }))
-
-    return {"message": "Hardware Sync Successful", "product": result.name}
\ No newline at end of file
+    await inventory.publish(inventory.stock_event("inventory_deducted", result, source="offline_hardware"))
+
+    return {"message": "Hardware Sync Successful", "product": result.name}
+
+@router.post("/sync-offline-sales/batch")
+async def sync_offline_sales_batch(batch: schemas.OfflineSalesBatch, db: AsyncSession = Depends(get_async_db)):
+    # Machines that were offline replay everything they sold in one call. Every
+    # sale carries its own idempotency key, so resending a batch is harmless.
+    products, applied, duplicates, unknown = await crud.record_offline_sales(db, batch.sales)
+
+    for event in inventory.machine_stock_events("inventory_deducted", products, source="offline_hardware"):
+        await inventory.publish(event)
+
+    return {
+        "message": "Hardware Sync Successful",
+        "applied": applied,
+        "duplicates": duplicates,
+        "unknown_products": unknown,
+        "products": [{"id": p.id, "stock": p.stock} for p in products]
+    }
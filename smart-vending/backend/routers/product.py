@@ -1,40 +1,89 @@
-from fastapi import APIRouter, Depends
+import hashlib
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from fastapi import APIRouter, BackgroundTasks, Depends, Query
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-import crud
-from database import SessionLocal
+import crud, schemas
+from database import SessionLocal, get_async_db
 from fastapi import Request, HTTPException
+from fastapi.concurrency import run_in_threadpool
 import notifications
-import json
-from websocket_manager import manager
+import inventory
+from cache import recent_payments
 
 router = APIRouter()
 
-def get_db():
+# Longest range /sales answers per bucket size
+SALES_MAX_RANGE = {"hour": timedelta(days=31), "day": timedelta(days=366)}
+
+async def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
 
-@router.get("/products")
+@router.get("/products", response_model=list[schemas.ProductResponse])
 def get_products(db: Session = Depends(get_db)):
     return crud.get_products(db)
 
-import schemas, payment, models
+import payment, models, reservations, webhooks
 
 @router.post("/create-order/{product_id}")
-def create_order(product_id: int, db: Session = Depends(get_db)):
-    product = db.query(models.Product).filter(models.Product.id == product_id).first()
-    if not product:
+async def create_order(product_id: int, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+    # Hold a unit before talking to Razorpay, so nobody pays for stock that is already spoken for
+    expires_ts, expires_at = reservations.expiry_time()
+    reserved = await run_in_threadpool(crud.reserve_product, db, product_id, expires_at)
+    if reserved is None:
         return {"error": "Product not found"}
-    if product.stock <= 0:
+    if reserved == "Out of stock":
         return {"error": "Out of stock"}
-    
-    order = payment.create_razorpay_order(product.price)
-    return {"order_id": order["id"], "amount": order["amount"], "currency": order["currency"]}
+    product, reservation_id = reserved
+    # Tracked straight away, so a hold whose request dies anywhere below
+    # (cancelled, or a failure nothing here catches) still expires
+    reservations.sweeper.track(reservation_id, expires_ts)
+
+    # Awaited on the event loop, so a slow gateway no longer ties up a threadpool worker
+    try:
+        order = await payment.create_razorpay_order(product.price, receipt=f"rsv_{reservation_id}")
+        await run_in_threadpool(crud.attach_order, db, reservation_id, order["id"])
+    except payment.GatewayError as e:
+        await run_in_threadpool(crud.release_reservations, db, [reservation_id], "cancelled")
+        print(f"Could not create Razorpay order: {e}")
+        raise HTTPException(status_code=503, detail="Payment gateway unavailable, please try again")
+    except Exception:
+        # E.g. an unreadable gateway response or a failed attach: give the unit back now
+        await run_in_threadpool(db.rollback)
+        await run_in_threadpool(crud.release_reservations, db, [reservation_id], "cancelled")
+        raise
+
+    if product.stock < inventory.LOW_STOCK_THRESHOLD:
+        print(f"ALERT: Stock for {product.name} is low ({product.stock} left).")
+    background_tasks.add_task(inventory.publish, inventory.stock_event("inventory_reserved", product))
+
+    return {
+        "order_id": order["id"],
+        "amount": order["amount"],
+        "currency": order["currency"],
+        "reserved_for_seconds": int(reservations.RESERVATION_TTL)
+    }
+
+def _remember_purchase(payment_data: schemas.PaymentVerification, product_name: str):
+    response = {"message": "Purchase successful", "product": product_name}
+    recent_payments.set(payment_data.payment_id, (payment_data.signature, response))
+    return response
 
 @router.post("/buy/{product_id}")
-async def buy(product_id: int, payment_data: schemas.PaymentVerification, user_id: int, db: Session = Depends(get_db)):
+async def buy(product_id: int, payment_data: schemas.PaymentVerification, user_id: int, db: AsyncSession = Depends(get_async_db)):
+    # Retries and double taps resend the same payment: answer with the original
+    # response. An identical request was already verified, so skip the signature.
+    found, replay = recent_payments.get(payment_data.payment_id)
+    if found and replay[0] == payment_data.signature:
+        return replay[1]
+
     # Verify payment signature
     is_valid = payment.verify_razorpay_payment(
         payment_data.order_id, 
@@ -44,8 +93,17 @@ async def buy(product_id: int, payment_data: schemas.PaymentVerification, user_i
     
     if not is_valid:
         return {"error": "Invalid payment signature"}
+
+    # Not in this worker's cache: restarted, or the first attempt went to another worker
+    previous = await crud.get_purchase_by_payment(db, payment_data.payment_id)
+    if previous:
+        return _remember_purchase(payment_data, previous.name)
     
-    result = crud.buy_product(db, product_id)
+    # Normally the unit was held at /create-order; only an expired or missing hold takes stock now
+    result = await crud.claim_reservation(db, payment_data.order_id, product_id)
+    reserved = result is not None
+    if not reserved:
+        result = await crud.buy_product_async(db, product_id, commit=False)
     
     if result is None:
         return {"error": "Product not found"}
@@ -53,69 +111,158 @@ async def buy(product_id: int, payment_data: schemas.PaymentVerification, user_i
     if result == "Out of stock":
         return {"error": "Out of stock"}
         
-    # Create the persistent transaction record for Profile History
-    transaction = models.Transaction(
-        user_id=user_id,
-        product_id=product_id,
-        amount=result.price,
-        payment_status="Completed"
-    )
-    db.add(transaction)
-    db.commit()
+    # Create the persistent transaction record for Profile History, in the same commit as the stock change
+    try:
+        await crud.record_purchase_async(db, user_id, product_id, result.price, payment_data.payment_id, result.machine_id)
+    except IntegrityError:
+        # A concurrent retry of this payment won; undo our claim or decrement and answer like it did
+        await db.rollback()
+        previous = await crud.get_purchase_by_payment(db, payment_data.payment_id)
+        if previous is None:
+            # Some other constraint failed, not a duplicate payment
+            raise
+        return _remember_purchase(payment_data, previous.name)
+    fcm_token = (await db.execute(
+        select(models.User.fcm_token).where(models.User.id == user_id)
+    )).scalar()
+    await db.commit()
 
-    # FCM Notification on successful purchase (and alert if low stock)
-    user = db.query(models.User).filter(models.User.id == user_id).first()
-    if user and user.fcm_token:
+    # FCM Notification on successful purchase, queued so we never wait on Google
+    if fcm_token:
         notifications.send_push_notification(
-            user.fcm_token, 
+            fcm_token, 
             "Purchase Successful", 
             f"You have successfully bought {result.name}!"
         )
-        if result.stock < 5:
+
+    # A claimed reservation left stock (and was broadcast) at /create-order
+    if not reserved:
+        crud.stock_changed(result)
+        if result.stock < inventory.LOW_STOCK_THRESHOLD:
             # Low stock alert (Mock sending to vendor)
             print(f"ALERT: Stock for {result.name} is low ({result.stock} left).")
+        # Broadcast the new absolute stock to every dashboard watching this machine or product
+        await inventory.publish(inventory.stock_event("inventory_deducted", result))
 
-    # Broadcast to all connected WebSockets that inventory changed
-    await manager.broadcast(json.dumps({
-        "action": "inventory_deducted",
-        "product_id": product_id,
-        "machine_id": result.machine_id if hasattr(result, 'machine_id') else None
-    }))
+    return _remember_purchase(payment_data, result.name)
 
-    return {"message": "Purchase successful", "product": result.name}
 
+@router.get("/search", response_model=list[schemas.ProductSearchResponse])
+def search(
+    name: str,
+    limit: int = Query(50, ge=1, le=200),
+    offset: int = Query(0, ge=0),
+    db: Session = Depends(get_db),
+):
+    return crud.search_product(db, name, limit, offset)
 
-@router.get("/search")
-def search(name: str, db: Session = Depends(get_db)):
-    return crud.search_product(db, name)
+@router.get("/search/autocomplete", response_model=list[str])
+def autocomplete(prefix: str, limit: int = Query(10, ge=1, le=50), db: Session = Depends(get_db)):
+    return crud.autocomplete_product(db, prefix, limit)
 
 @router.post("/demand")
 def submit_demand(user_id: int, request: schemas.DemandRequestCreate, db: Session = Depends(get_db)):
     return crud.create_demand_request(db, user_id, request)
 
+# Most-requested products not yet restocked, for one machine or across all of them
+@router.get("/demand/top", response_model=list[schemas.DemandRollupResponse])
+def top_demand(machine_id: int = None, limit: int = Query(10, ge=1, le=100), db: Session = Depends(get_db)):
+    return crud.top_demands(db, machine_id, limit)
+
+# Sales over time for dashboards, read from the hourly/daily buckets (UTC).
+# Defaults to the last day of hours or the last 30 days.
+@router.get("/sales", response_model=list[schemas.SalesBucketResponse])
+def sales_over_time(
+    granularity: str = Query("hour", pattern="^(hour|day)$"),
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    machine_id: Optional[int] = None,
+    product_id: Optional[int] = None,
+    by_machine: bool = False,
+    by_product: bool = False,
+    db: Session = Depends(get_db),
+):
+    end = end or datetime.now(timezone.utc)
+    start = start or end - (timedelta(days=1) if granularity == "hour" else timedelta(days=30))
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    if end.tzinfo is None:
+        end = end.replace(tzinfo=timezone.utc)
+    if end - start > SALES_MAX_RANGE[granularity]:
+        raise HTTPException(status_code=400, detail=f"Range too long for {granularity} buckets")
+    return crud.get_sales_buckets(db, granularity, start, end, machine_id, product_id, by_machine, by_product)
+
+# Recount the sales buckets from the transaction ledger
+@router.post("/sales/rebuild")
+def rebuild_sales_buckets(db: Session = Depends(get_db)):
+    buckets, undated = crud.rebuild_sales_buckets(db)
+    return {"buckets": buckets, "undated_sales": undated}
+
+# Recount the demand rollups from demand_requests, e.g. after editing demands by hand
+@router.post("/demand/rollups/rebuild")
+def rebuild_demand_rollups(db: Session = Depends(get_db)):
+    return {"rollups": crud.rebuild_demand_rollups(db)}
+
 @router.post("/restock")
-def restock(restock_data: schemas.ProductRestock, db: Session = Depends(get_db)):
+def restock(restock_data: schemas.ProductRestock, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
     product, tokens_to_notify = crud.restock_product(db, restock_data.product_id, restock_data.amount)
     
     if not product:
         return {"error": "Product not found"}
+
+    background_tasks.add_task(inventory.publish, inventory.stock_event("inventory_restocked", product))
         
-    for token in set(tokens_to_notify): # Use set to avoid duplicate notifications to same user
-        notifications.send_push_notification(
-            token,
-            "Item Restocked! 🎉",
-            f"The item '{product.name}' you requested has been restocked at the vending machine!"
-        )
+    # Queued and sent as one multicast in the background, duplicates are collapsed
+    notifications.send_multicast(
+        set(tokens_to_notify),
+        "Item Restocked! 🎉",
+        f"The item '{product.name}' you requested has been restocked at the vending machine!"
+    )
         
     return {
         "message": f"Successfully restocked {product.name}. New stock: {product.stock}",
         "users_notified": len(set(tokens_to_notify))
     }
 
+@router.post("/restock/bulk")
+def bulk_restock(restock_data: schemas.BulkRestock, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+    amounts = crud.bulk_restock_amounts(db, restock_data)
+    if not amounts:
+        return {"error": "Nothing to restock"}
+
+    restocked, missing = crud.restock_products(db, amounts)
+
+    results = []
+    users_notified = 0
+    for product, tokens in restocked:
+        background_tasks.add_task(inventory.publish, inventory.stock_event("inventory_restocked", product))
+        notifications.send_multicast(
+            tokens,
+            "Item Restocked! 🎉",
+            f"The item '{product.name}' you requested has been restocked at the vending machine!"
+        )
+        users_notified += len(tokens)
+        results.append({"id": product.id, "name": product.name, "stock": product.stock, "users_notified": len(tokens)})
+
+    return {
+        "message": f"Successfully restocked {len(results)} products",
+        "products": results,
+        "not_found": missing,
+        "users_notified": users_notified
+    }
+
 @router.post("/webhook/razorpay")
 async def razorpay_webhook(request: Request):
-    # Webhook signature verification should be here
-    # For Phase 1, we mock standard webhook consumption
-    body = await request.json()
-    print("Received Razorpay Webhook:", body)
-    return {"status": "ok"}
\ No newline at end of file
+    # Ack as soon as the delivery is verified and queued; the webhook worker
+    # journals it and updates the transaction in its next batch
+    body = await request.body()
+    if not payment.verify_razorpay_webhook(body, request.headers.get("x-razorpay-signature")):
+        raise HTTPException(status_code=400, detail="Invalid webhook signature")
+
+    # Retries of a delivery carry the same event id
+    event_id = request.headers.get("x-razorpay-event-id") or hashlib.sha256(body).hexdigest()
+    try:
+        queued = webhooks.webhook_queue.submit(event_id, body)
+    except webhooks.QueueFull:
+        raise HTTPException(status_code=503, detail="Webhook queue full, retry later")
+    return {"status": "ok" if queued else "duplicate"}
\ No newline at end of file
@@ -1,4 +1,5 @@
-from fastapi import APIRouter, Depends
+from typing import Optional
+from fastapi import APIRouter, Depends, Query
 from sqlalchemy.orm import Session
 import schemas, crud
 from database import SessionLocal
@@ -7,14 +8,14 @@ import models, auth
 
 router = APIRouter()
 
-def get_db():
+async def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
 
-@router.post("/register")
+@router.post("/register", response_model=schemas.UserResponse)
 def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
     try:
         return crud.create_user(db, user)
@@ -42,26 +43,25 @@ def update_token(user_id: int, token_data: schemas.FCMTokenUpdate, db: Session =
     return {"message": "FCM token updated successfully"}
 
 @router.get("/{user_id}/purchases")
-def get_user_purchases(user_id: int, db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+def get_user_purchases(
+    user_id: int,
+    limit: int = Query(20, ge=1, le=100),
+    before: Optional[int] = Query(None, ge=1),
+    db: Session = Depends(get_db),
+):
+    user = db.get(models.User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    transactions = db.query(models.Transaction, models.Product).join(
-        models.Product, models.Transaction.product_id == models.Product.id
-    ).filter(
-        models.Transaction.user_id == user_id,
-        models.Transaction.payment_status == "Completed"
-    ).all()
-
-    total_spent = sum(t.Transaction.amount for t in transactions)
+    total_spent, purchase_count = crud.get_purchase_summary(db, user_id)
+    transactions, next_cursor = crud.get_purchase_history(db, user_id, limit, before)
 
     history = [
         {
-            "id": t.Transaction.id,
-            "product_name": t.Product.name,
-            "amount": t.Transaction.amount,
-            "status": t.Transaction.payment_status
+            "id": t.id,
+            "product_name": t.product_name,
+            "amount": t.amount,
+            "status": t.status
         }
         for t in transactions
     ]
@@ -72,5 +72,7 @@ def get_user_purchases(user_id: int, db: Session = Depends(get_db)):
             "email": user.email
         },
         "total_spent": total_spent,
-        "history": history
-    }
\ No newline at end of file
+        "purchase_count": purchase_count,
+        "history": history,
+        "next_cursor": next_cursor
+    }
@@ -1,3 +1,5 @@
+from datetime import datetime
+from typing import Optional
 from pydantic import BaseModel
 
 class UserCreate(BaseModel):
@@ -6,8 +8,27 @@ class UserCreate(BaseModel):
     password: str
 
 
+class UserResponse(BaseModel):
+    id: int
+    name: str
+    email: str
+
+    class Config:
+        from_attributes = True
+
+class MachineResponse(BaseModel):
+    id: int
+    name: str
+    location: str
+    latitude: float
+    longitude: float
+
+    class Config:
+        from_attributes = True
+
 class ProductResponse(BaseModel):
     id: int
+    machine_id: Optional[int] = None
     name: str
     price: float
     stock: int
@@ -15,6 +36,11 @@ class ProductResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class MachineInventoryResponse(BaseModel):
+    version: str
+    full: bool
+    products: list[ProductResponse]
+
 class ProductSearchResponse(BaseModel):
     id: int
     name: str
@@ -41,6 +67,41 @@ class DemandRequestCreate(BaseModel):
     machine_id: int
     product_name: str
 
+class SalesBucketResponse(BaseModel):
+    bucket_start: datetime
+    machine_id: Optional[int] = None
+    product_id: Optional[int] = None
+    units: int
+    revenue: float
+
+    class Config:
+        from_attributes = True
+
+class DemandRollupResponse(BaseModel):
+    machine_id: int
+    product_name: str
+    pending: int
+
+    class Config:
+        from_attributes = True
+
 class ProductRestock(BaseModel):
     product_id: int
-    amount: int
\ No newline at end of file
+    amount: int
+
+class MachineRestock(BaseModel):
+    machine_id: int
+    amount: int
+
+class BulkRestock(BaseModel):
+    products: list[ProductRestock] = []
+    # Adds `amount` to every product in each listed machine
+    machines: list[MachineRestock] = []
+
+class OfflineSale(BaseModel):
+    product_id: int
+    idempotency_key: str
+    sold_at: datetime
+
+class OfflineSalesBatch(BaseModel):
+    sales: list[OfflineSale]
@@ -0,0 +1,276 @@
+import bisect
+import os
+import threading
+from collections import defaultdict
+
+from sqlalchemy import event, inspect, select, text
+from sqlalchemy.orm import Session, object_session
+
+import models
+
+# Minimum trigram overlap (Dice coefficient) for a fuzzy match to count
+FUZZY_THRESHOLD = 0.3
+# Rows pulled from FTS5 before re-ranking; bm25 already puts the closest names first
+MIN_CANDIDATES = 200
+
+
+def normalize(name: str) -> str:
+    return " ".join(name.lower().split())
+
+
+def trigrams(value: str) -> set:
+    # Same padding pg_trgm uses: two spaces before each word, one after
+    grams = set()
+    for word in normalize(value).split(" "):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+# Postgres: pg_trgm GIN index handles substring LIKE and typo-tolerant
+# word_similarity matches. The index lives in the database, so it stays in
+# sync with inserts and updates on its own.
+class PostgresTrigramBackend:
+    name = "postgres"
+
+    def setup(self, engine):
+        with engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_products_name_trgm "
+                "ON products USING gin (lower(name) gin_trgm_ops)"
+            ))
+
+    def search(self, db: Session, query: str, limit: int, offset: int):
+        q = normalize(query)
+        rows = db.execute(text(
+            "SELECT id FROM products "
+            "WHERE lower(name) LIKE :contains OR :q <% lower(name) "
+            "ORDER BY lower(name) LIKE :prefix DESC, lower(name) LIKE :contains DESC, "
+            "word_similarity(:q, lower(name)) DESC, id "
+            "LIMIT :limit OFFSET :offset"
+        ), {"q": q, "contains": f"%{_escape_like(q)}%", "prefix": f"{_escape_like(q)}%",
+            "limit": limit, "offset": offset})
+        return [row.id for row in rows]
+
+    def autocomplete(self, db: Session, prefix: str, limit: int):
+        rows = db.execute(text(
+            "SELECT name FROM products WHERE lower(name) LIKE :prefix "
+            "GROUP BY name ORDER BY name LIMIT :limit"
+        ), {"prefix": f"{_escape_like(normalize(prefix))}%", "limit": limit})
+        return [row.name for row in rows]
+
+
+# SQLite: an external-content FTS5 table with the trigram tokenizer, kept in
+# sync with `products` by triggers. Typo tolerance comes from OR-ing the
+# query's trigrams and ranking by bm25, which favours names sharing the most.
+class SQLiteFTS5Backend:
+    name = "sqlite"
+
+    def setup(self, engine):
+        with engine.begin() as conn:
+            exists = conn.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE name = 'products_fts'"
+            )).first()
+            if exists:
+                return
+            conn.execute(text(
+                "CREATE VIRTUAL TABLE products_fts USING fts5("
+                "name, content='products', content_rowid='id', tokenize='trigram')"
+            ))
+            conn.execute(text(
+                "CREATE TRIGGER products_fts_ai AFTER INSERT ON products BEGIN "
+                "INSERT INTO products_fts(rowid, name) VALUES (new.id, new.name); END"
+            ))
+            conn.execute(text(
+                "CREATE TRIGGER products_fts_ad AFTER DELETE ON products BEGIN "
+                "INSERT INTO products_fts(products_fts, rowid, name) VALUES ('delete', old.id, old.name); END"
+            ))
+            conn.execute(text(
+                "CREATE TRIGGER products_fts_au AFTER UPDATE OF name ON products BEGIN "
+                "INSERT INTO products_fts(products_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+                "INSERT INTO products_fts(rowid, name) VALUES (new.id, new.name); END"
+            ))
+            conn.execute(text("INSERT INTO products_fts(products_fts) VALUES ('rebuild')"))
+
+    def search(self, db: Session, query: str, limit: int, offset: int):
+        q = normalize(query)
+        if len(q) < 3:
+            # The trigram tokenizer cannot match anything shorter than three characters
+            rows = db.execute(text(
+                "SELECT id FROM products WHERE lower(name) LIKE :contains ESCAPE '\\' "
+                "ORDER BY lower(name) LIKE :prefix ESCAPE '\\' DESC, id LIMIT :limit OFFSET :offset"
+            ), {"contains": f"%{_escape_like(q)}%", "prefix": f"{_escape_like(q)}%",
+                "limit": limit, "offset": offset})
+            return [row.id for row in rows]
+
+        # Exact substring hits rank first, then names that share enough trigrams
+        match = " OR ".join(_fts_phrase(gram) for gram in sorted(_plain_trigrams(q)))
+        rows = db.execute(text(
+            "SELECT rowid AS id, lower(name) AS name FROM products_fts "
+            "WHERE products_fts MATCH :match ORDER BY bm25(products_fts) LIMIT :candidates"
+        ), {"match": match, "candidates": max(MIN_CANDIDATES, (offset + limit) * 5)}).all()
+        return _rank(q, rows, limit, offset)
+
+    def autocomplete(self, db: Session, prefix: str, limit: int):
+        p = normalize(prefix)
+        rows = db.execute(text(
+            "SELECT name FROM products WHERE lower(name) LIKE :prefix ESCAPE '\\' "
+            "GROUP BY name ORDER BY name LIMIT :limit"
+        ), {"prefix": f"{_escape_like(p)}%", "limit": limit})
+        return [row.name for row in rows]
+
+
+# Fallback for any other database: an in-process trigram inverted index over
+# distinct product names, kept current by Product mapper events.
+class NgramIndexBackend:
+    name = "memory"
+
+    def __init__(self):
+        self.loaded = False
+        self._lock = threading.RLock()
+        self._postings = defaultdict(set)  # trigram -> name keys
+        self._products = defaultdict(set)  # name key -> product ids
+        self._names = {}                   # product id -> name key
+        self._display = {}                 # name key -> original name
+        self._sorted = []                  # sorted name keys for prefix lookups
+
+    def setup(self, engine):
+        event.listen(models.Product, "after_insert", _stage_product)
+        event.listen(models.Product, "after_update", _stage_product)
+        event.listen(models.Product, "after_delete", _stage_product_delete)
+        event.listen(Session, "after_commit", self._apply_staged)
+        event.listen(Session, "after_rollback", lambda session: session.info.pop("search_changes", None))
+
+    def ensure_loaded(self, db: Session):
+        if self.loaded:
+            return
+        with self._lock:
+            if self.loaded:
+                return
+            for product_id, name in db.execute(select(models.Product.id, models.Product.name)):
+                self.index_product(product_id, name)
+            self.loaded = True
+
+    def index_product(self, product_id: int, name: str):
+        with self._lock:
+            self.remove_product(product_id)
+            if not name:
+                return
+            key = normalize(name)
+            if key not in self._products:
+                for gram in trigrams(key):
+                    self._postings[gram].add(key)
+                bisect.insort(self._sorted, key)
+                self._display[key] = name
+            self._products[key].add(product_id)
+            self._names[product_id] = key
+
+    def remove_product(self, product_id: int):
+        with self._lock:
+            key = self._names.pop(product_id, None)
+            if key is None:
+                return
+            self._products[key].discard(product_id)
+            if self._products[key]:
+                return
+            del self._products[key]
+            del self._display[key]
+            self._sorted.pop(bisect.bisect_left(self._sorted, key))
+            for gram in trigrams(key):
+                self._postings[gram].discard(key)
+                if not self._postings[gram]:
+                    del self._postings[gram]
+
+    def _apply_staged(self, session):
+        changes = session.info.pop("search_changes", None)
+        if not changes or not self.loaded:
+            return
+        for product_id, name in changes:
+            if name is None:
+                self.remove_product(product_id)
+            else:
+                self.index_product(product_id, name)
+
+    def search(self, db: Session, query: str, limit: int, offset: int):
+        self.ensure_loaded(db)
+        q = normalize(query)
+        with self._lock:
+            if len(q) < 3:
+                # Too short to share a trigram with a mid-word match, check names directly
+                keys = [key for key in self._products if q in key]
+            else:
+                keys = set()
+                for gram in trigrams(q):
+                    keys.update(self._postings.get(gram, ()))
+            rows = [(product_id, key) for key in keys for product_id in self._products[key]]
+        return _rank(q, rows, limit, offset)
+
+    def autocomplete(self, db: Session, prefix: str, limit: int):
+        self.ensure_loaded(db)
+        p = normalize(prefix)
+        with self._lock:
+            start = bisect.bisect_left(self._sorted, p)
+            names = []
+            for key in self._sorted[start:start + limit]:
+                if not key.startswith(p):
+                    break
+                names.append(self._display[key])
+            return names
+
+
+def _stage_product(mapper, connection, target):
+    session = object_session(target)
+    if session is not None and inspect(target).attrs.name.history.has_changes():
+        session.info.setdefault("search_changes", []).append((target.id, target.name))
+
+
+def _stage_product_delete(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("search_changes", []).append((target.id, None))
+
+
+def _rank(q: str, rows, limit: int, offset: int):
+    # rows are (product_id, lowercase name); prefix > substring > trigram similarity
+    q_grams = trigrams(q)
+    ranked = []
+    for product_id, name in rows:
+        grams = trigrams(name)
+        similarity = 2 * len(q_grams & grams) / (len(q_grams) + len(grams))
+        if q in name or similarity >= FUZZY_THRESHOLD:
+            ranked.append((not name.startswith(q), q not in name, -similarity, product_id))
+    ranked.sort()
+    return [row[-1] for row in ranked[offset:offset + limit]]
+
+
+def _plain_trigrams(q: str) -> set:
+    # FTS5's trigram tokenizer indexes raw character windows, without padding
+    return {q[i:i + 3] for i in range(len(q) - 2)}
+
+
+def _fts_phrase(value: str) -> str:
+    return '"' + value.replace('"', '""') + '"'
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def create_backend(engine):
+    choice = os.getenv("SEARCH_BACKEND") or engine.dialect.name
+    if choice in ("postgres", "postgresql"):
+        return PostgresTrigramBackend()
+    if choice == "sqlite":
+        return SQLiteFTS5Backend()
+    return NgramIndexBackend()
+
+
+backend = None
+
+
+def setup(engine):
+    global backend
+    backend = create_backend(engine)
+    backend.setup(engine)
+    return backend
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import os
+
+import crud
+from cache import TTLCache
+from database import SessionLocal
+
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "10000"))
+# A burst is written in batches of up to this many events, gathered for at most this long
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "500"))
+WEBHOOK_BATCH_DELAY = float(os.getenv("WEBHOOK_BATCH_DELAY", "0.05"))
+WEBHOOK_RETRY_DELAY = 5.0
+# How long shutdown waits for queued events to be written
+WEBHOOK_DRAIN_TIMEOUT = 10.0
+# Event ids seen recently on this worker; retries inside this window are acked without queueing
+WEBHOOK_DEDUPE_TTL = float(os.getenv("WEBHOOK_DEDUPE_TTL", "600"))
+# Events that arrive before their purchase is recorded are retried by every
+# batch for this many seconds, and after this many seconds without deliveries
+WEBHOOK_WAITING_WINDOW = float(os.getenv("WEBHOOK_WAITING_WINDOW", "86400"))
+WEBHOOK_WAITING_INTERVAL = float(os.getenv("WEBHOOK_WAITING_INTERVAL", "30"))
+
+# Razorpay events that settle a payment, and the transaction status they set
+PAYMENT_STATUSES = {
+    "payment.captured": "Completed",
+    "payment.failed": "Failed",
+    "refund.processed": "Refunded",
+}
+
+
+class QueueFull(Exception):
+    pass
+
+
+def parse_event(event_id: str, body: bytes):
+    # The journal row for one delivery; the payment id is where Razorpay puts it
+    # for payment and refund events alike
+    data = json.loads(body)
+    name = data.get("event")
+    entities = data.get("payload") or {}
+    payment = (entities.get("payment") or {}).get("entity") or {}
+    refund = (entities.get("refund") or {}).get("entity") or {}
+    return {
+        "event_id": event_id,
+        "event": name,
+        "payment_id": payment.get("id") or refund.get("payment_id"),
+        "status": PAYMENT_STATUSES.get(name),
+        "payload": body.decode(),
+    }
+
+
+# The webhook route only verifies the signature and drops the raw body on
+# this queue, so Razorpay gets its 200 straight away. One worker drains the
+# queue, parses events off the request path and journals each burst in a
+# single transaction. When the queue is full the route answers 503 and
+# Razorpay retries the delivery later.
+class WebhookQueue:
+    def __init__(self, maxsize: int = WEBHOOK_QUEUE_SIZE, batch_size: int = WEBHOOK_BATCH_SIZE,
+                 batch_delay: float = WEBHOOK_BATCH_DELAY):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.recent = TTLCache(max_entries=maxsize, ttl=WEBHOOK_DEDUPE_TTL, enabled=True)
+        self._queue = None
+        self._task = None
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.batches = 0
+        self.recorded = 0
+        self.applied = 0
+
+    async def start(self):
+        self._queue = asyncio.Queue(self.maxsize)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        # Write out what was already acknowledged before going away
+        try:
+            await asyncio.wait_for(self._queue.join(), WEBHOOK_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"Shutting down with {self._queue.qsize()} Razorpay webhooks unwritten")
+        self._task.cancel()
+        self._task = None
+
+    def submit(self, event_id: str, body: bytes) -> bool:
+        # False if this event was already taken in recently
+        self.received += 1
+        if self.recent.get(event_id)[0]:
+            self.duplicates += 1
+            return False
+        try:
+            self._queue.put_nowait((event_id, body))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise QueueFull()
+        self.recent.set(event_id, True)
+        return True
+
+    async def _run(self):
+        while True:
+            try:
+                batch = [await asyncio.wait_for(self._queue.get(), WEBHOOK_WAITING_INTERVAL)]
+            except asyncio.TimeoutError:
+                # A quiet spell: give events still waiting for their purchase another go
+                await self._write([])
+                continue
+            # Let the rest of a burst arrive, then take as much as one batch holds
+            if self._queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.batch_delay)
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _write(self, batch):
+        events = []
+        for event_id, body in batch:
+            try:
+                events.append(parse_event(event_id, body))
+            except (ValueError, AttributeError) as e:
+                print(f"Dropping unreadable Razorpay webhook {event_id}: {e}")
+        if batch and not events:
+            return
+        while True:
+            try:
+                recorded, applied = await asyncio.to_thread(self._record, events)
+                break
+            except Exception as e:
+                print(f"Failed to record Razorpay webhooks, retrying shortly: {e}")
+                await asyncio.sleep(WEBHOOK_RETRY_DELAY)
+        self.batches += 1
+        self.recorded += recorded
+        self.applied += applied
+
+    def _record(self, events):
+        db = SessionLocal()
+        try:
+            return crud.record_webhook_events(db, events, WEBHOOK_WAITING_WINDOW)
+        finally:
+            db.close()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "rejected_queue_full": self.rejected,
+            "batches": self.batches,
+            "recorded": self.recorded,
+            "applied": self.applied,
+        }
+
+
+webhook_queue = WebhookQueue()
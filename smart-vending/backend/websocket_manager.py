@@ -1,23 +1,195 @@
+import asyncio
+import json
+import os
+import re
+import time
+from collections import deque
 from fastapi import WebSocket
 
+import metrics
+
+# Outbound messages buffered per client before the slow-consumer policy kicks in
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "64"))
+# drop_oldest | coalesce | disconnect
+WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "drop_oldest")
+# A single send that takes longer than this marks the client as dead
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "5"))
+
+# Topics a client can subscribe to; "all" receives every broadcast
+ALL_TOPIC = "all"
+TOPIC_PATTERN = re.compile(r"^(all|machine:\d+|product:\d+)$")
+
+
+class ClientConnection:
+    def __init__(self, websocket: WebSocket, max_queue: int):
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.pending = deque()  # (coalesce key, message)
+        self.topics = set()
+        self.dropped = 0
+        self.writer = None
+        self._wakeup = asyncio.Event()
+
+    def offer(self, message: str, key: str = None, policy: str = "drop_oldest") -> bool:
+        # Never blocks; returns False when the client should be disconnected
+        if len(self.pending) >= self.max_queue:
+            if policy == "disconnect":
+                return False
+            if policy == "coalesce" and key is not None:
+                # A newer message about the same thing replaces the queued one
+                for i, (queued_key, _) in enumerate(self.pending):
+                    if queued_key == key:
+                        self.pending[i] = (key, message)
+                        self.dropped += 1
+                        return True
+            self.pending.popleft()
+            self.dropped += 1
+
+        self.pending.append((key, message))
+        self._wakeup.set()
+        return True
+
+    async def run(self, manager: "ConnectionManager"):
+        try:
+            while True:
+                while not self.pending:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                _, message = self.pending.popleft()
+                async with asyncio.timeout(WS_SEND_TIMEOUT):
+                    await self.websocket.send_text(message)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"Failed to send to a websocket client: {e}")
+            manager.disconnect(self.websocket)
+            # Close it too, so the client notices, reconnects and resumes from its last event
+            await _close_quietly(self.websocket, code=1013 if isinstance(e, TimeoutError) else 1011)
+        finally:
+            manager.disconnect(self.websocket)
+
+    def close(self):
+        if self.writer is not None and self.writer is not asyncio.current_task():
+            self.writer.cancel()
+        self.pending.clear()
+
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
+    # Every client gets its own bounded queue and writer task, so broadcast only
+    # enqueues and one slow or dead socket never holds up the others. Routing
+    # goes through a topic -> sockets index, so a broadcast only touches the
+    # subscribers of its topics.
+    def __init__(self, queue_size: int = WS_QUEUE_SIZE, policy: str = WS_SLOW_CONSUMER_POLICY):
+        self.queue_size = queue_size
+        self.policy = policy
+        self.active_connections: dict[WebSocket, ClientConnection] = {}
+        self.topics: dict[str, set[WebSocket]] = {}
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        client = ClientConnection(websocket, self.queue_size)
+        client.writer = asyncio.create_task(client.run(self))
+        self.active_connections[websocket] = client
+        # Clients that never send a subscription keep receiving everything
+        self.subscribe(websocket, [ALL_TOPIC])
 
     def disconnect(self, websocket: WebSocket):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except Exception as e:
-                print(f"Failed to send to a websocket client: {e}")
-                self.disconnect(connection)
+        client = self.active_connections.pop(websocket, None)
+        if client:
+            self.unsubscribe(websocket, list(client.topics))
+            client.close()
+
+    def subscribe(self, websocket: WebSocket, topics):
+        client = self.active_connections.get(websocket)
+        if client is None:
+            return
+        for topic in topics:
+            client.topics.add(topic)
+            self.topics.setdefault(topic, set()).add(websocket)
+
+    def unsubscribe(self, websocket: WebSocket, topics):
+        client = self.active_connections.get(websocket)
+        for topic in topics:
+            if client is not None:
+                client.topics.discard(topic)
+            subscribers = self.topics.get(topic)
+            if subscribers is not None:
+                subscribers.discard(websocket)
+                if not subscribers:
+                    del self.topics[topic]
+
+    def topics_of(self, websocket: WebSocket):
+        client = self.active_connections.get(websocket)
+        return set(client.topics) if client else set()
+
+    def send(self, websocket: WebSocket, message: str):
+        # Queue a message for one client, behind anything already pending for it
+        client = self.active_connections.get(websocket)
+        if client is not None:
+            client.offer(message, policy=self.policy)
+
+    def handle_message(self, websocket: WebSocket, data: str):
+        # Handles {"action": "subscribe" | "unsubscribe", "topics": [...]} and
+        # hands any other well-formed request back to the caller
+        try:
+            request = json.loads(data)
+            action = request.get("action")
+            topics = request.get("topics", [])
+        except (ValueError, AttributeError):
+            return None
+
+        if action not in ("subscribe", "unsubscribe"):
+            return request
+        if not isinstance(topics, list):
+            return None
+        topics = [t for t in topics if isinstance(t, str) and TOPIC_PATTERN.match(t)]
+        if action == "subscribe":
+            self.subscribe(websocket, topics)
+        else:
+            self.unsubscribe(websocket, topics)
+
+        self.send(websocket, json.dumps({"action": "subscriptions", "topics": sorted(self.topics_of(websocket))}))
+        return None
+
+    def stats(self) -> dict:
+        depths = sorted(len(client.pending) for client in self.active_connections.values())
+        return {
+            "connections": len(depths),
+            "queued_messages": sum(depths),
+            "queue_depth_p99": depths[int(len(depths) * 0.99)] if depths else 0,
+            "queue_depth_max": depths[-1] if depths else 0,
+            "dropped_messages": sum(client.dropped for client in self.active_connections.values()),
+        }
+
+    async def broadcast(self, message: str, topics=(), key: str = None):
+        start = time.perf_counter()
+        recipients = set(self.topics.get(ALL_TOPIC, ()))
+        for topic in topics:
+            recipients.update(self.topics.get(topic, ()))
+
+        slow = []
+        for websocket in recipients:
+            client = self.active_connections.get(websocket)
+            if client is not None and not client.offer(message, key, self.policy):
+                slow.append(websocket)
+
+        for websocket in slow:
+            print("Disconnecting slow websocket client")
+            self.disconnect(websocket)
+            asyncio.create_task(_close_quietly(websocket))
+
+        metrics.observe("ws_broadcast_seconds", time.perf_counter() - start)
+        metrics.observe("ws_broadcast_recipients", len(recipients))
+
+
+async def _close_quietly(websocket: WebSocket, code: int = 1013):
+    # 1013: try again later, 1011: server error. A stuck socket may not take
+    # the close frame either, so give up on it after WS_SEND_TIMEOUT.
+    try:
+        async with asyncio.timeout(WS_SEND_TIMEOUT):
+            await websocket.close(code=code)
+    except Exception:
+        pass
+
 
 manager = ConnectionManager()